@@ -2,7 +2,26 @@
 set -e
 python manage.py collectstatic --noinput
 python manage.py migrate --noinput
+
+# Workers write their metrics files here (see webapp/metrics.py); start every deploy from zero.
+rm -rf "${METRICS_DIR:-/tmp/pizza_solver_metrics}"
+
+# SERVER_MODE=wsgi (default) runs classic sync gunicorn workers.
+# SERVER_MODE=asgi runs uvicorn workers under gunicorn, so the async guest views
+# (order_join, order_people_partial, order_results) can overlap their DB waits
+# during invite bursts. Under ASGI each request may run on a different thread,
+# so set DB_CONN_MAX_AGE=0 to avoid leaking persistent connections.
+WEB_WORKERS="${WEB_WORKERS:-2}"
+
+if [ "${SERVER_MODE:-wsgi}" = "asgi" ]; then
+  exec gunicorn pizza_solver.asgi:application \
+    --worker-class uvicorn_worker.UvicornWorker \
+    --bind 0.0.0.0:8000 \
+    --workers "$WEB_WORKERS" \
+    --timeout 120
+fi
+
 exec gunicorn pizza_solver.wsgi:application \
   --bind 0.0.0.0:8000 \
-  --workers 2 \
+  --workers "$WEB_WORKERS" \
   --timeout 120
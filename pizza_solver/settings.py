@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/6.0/ref/settings/
 """
 
 import os
+import tempfile
 from pathlib import Path
 
 import dj_database_url
@@ -63,20 +64,42 @@ CONSTANCE_CONFIG = {
     'DISLIKE_WEIGHT': (-1.0, 'Score weight applied to dislikes in the solver objective (e.g. -1.5 penalizes dislikes more)'),
     'SITE_TITLE': ('Pizza Solver', 'Site title shown in the navbar and sign-in page'),
     'DETERMINISTIC': (False, 'When enabled, skips topping shuffling so the solver always returns the same result for a given input'),
+    'SOLVER_MIP_GAP': (0.01, 'Relative optimality gap at which balanced solves stop early (0.01 = within 1% of the best possible score); fast solves allow five times this, exact solves none'),
 }
 
 MIDDLEWARE = [
+    'webapp.middleware.metrics_middleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'webapp.middleware.person_context_middleware',
+    'webapp.middleware.profiling_middleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'allauth.account.middleware.AccountMiddleware',  # Required for django-allauth 0.56.0+
 ]
 
+# QUERY_BUDGET=True adds X-DB-Queries / X-DB-Time-Ms / X-DB-Duplicate-Queries
+# and Server-Timing headers to every response and logs the same numbers, plus the
+# most repeated statements, to the webapp.queries logger.
+if os.environ.get('QUERY_BUDGET', 'False').lower() == 'true':
+    MIDDLEWARE.insert(0, 'webapp.middleware.query_budget_middleware')
+    LOGGING = {
+        'version': 1,
+        'disable_existing_loggers': False,
+        'handlers': {'console': {'class': 'logging.StreamHandler'}},
+        'loggers': {'webapp.queries': {'handlers': ['console'], 'level': 'INFO'}},
+    }
+
+# Request profiling (webapp/profiling.py): staff can add ?_profile=1 to any URL.
+# PROFILE_SAMPLE_RATE additionally profiles that fraction of all requests
+# (e.g. 0.01); PROFILE_KEEP is how many stored profiles are kept.
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', '200'))
+
 ROOT_URLCONF = 'pizza_solver.urls'
 
 TEMPLATES = [
@@ -104,10 +127,109 @@ WSGI_APPLICATION = 'pizza_solver.wsgi.application'
 DATABASES = {
     'default': dj_database_url.config(
         default=f'sqlite:///{BASE_DIR / "db.sqlite3"}',
-        conn_max_age=600,
+        conn_max_age=int(os.environ.get('DB_CONN_MAX_AGE', '600')),
+        conn_health_checks=os.environ.get('DB_CONN_HEALTH_CHECKS', 'True').lower() == 'true',
     )
 }
 
+# Connection pooling (PostgreSQL with psycopg 3 only). With DB_POOL=True each
+# worker process keeps one psycopg_pool pool that all its threads and async
+# tasks borrow from per query block, instead of one persistent connection per
+# thread. Connections are checked on checkout and recycled after DB_POOL_MAX_IDLE
+# idle seconds. Keep WEB_WORKERS * DB_POOL_MAX_SIZE under the server's
+# max_connections. Pool counters are served at /staff/db-pool/ and /metrics.
+DB_POOL = os.environ.get('DB_POOL', 'False').lower() == 'true'
+
+
+def _pooled(db):
+    if not DB_POOL or db['ENGINE'] != 'django.db.backends.postgresql':
+        return db
+    db['CONN_MAX_AGE'] = 0  # Django refuses persistent connections with a pool.
+    db['CONN_HEALTH_CHECKS'] = True  # Django then passes ConnectionPool.check_connection as the pool's check.
+    db.setdefault('OPTIONS', {})['pool'] = {
+        'min_size': int(os.environ.get('DB_POOL_MIN_SIZE', '2')),
+        'max_size': int(os.environ.get('DB_POOL_MAX_SIZE', '10')),
+        'timeout': float(os.environ.get('DB_POOL_TIMEOUT', '10')),
+        'max_idle': float(os.environ.get('DB_POOL_MAX_IDLE', '300')),
+    }
+    return db
+
+
+DATABASES['default'] = _pooled(DATABASES['default'])
+
+# Optional read replica (see webapp/routers.py). Read-only pages read from it;
+# writes, solves and reads right after a write use the primary. To try it
+# locally with SQLite, copy db.sqlite3 to replica.sqlite3 and set
+# DATABASE_REPLICA_URL=sqlite:///replica.sqlite3.
+if os.environ.get('DATABASE_REPLICA_URL'):
+    DATABASES['replica'] = _pooled(dj_database_url.parse(
+        os.environ['DATABASE_REPLICA_URL'],
+        conn_max_age=int(os.environ.get('DB_CONN_MAX_AGE', '600')),
+        conn_health_checks=os.environ.get('DB_CONN_HEALTH_CHECKS', 'True').lower() == 'true',
+    ))
+    # Tests run against one database; the replica alias points at it.
+    DATABASES['replica']['TEST'] = {'MIRROR': 'default'}
+    DATABASE_ROUTERS = ['webapp.routers.ReplicaRouter']
+    MIDDLEWARE.insert(1, 'webapp.middleware.replica_pin_middleware')
+
+# Seconds a user's reads stay on the primary after a request of theirs wrote,
+# to cover replication lag.
+REPLICA_PIN_SECONDS = int(os.environ.get('REPLICA_PIN_SECONDS', '5'))
+
+
+# Cache
+# https://docs.djangoproject.com/en/6.0/topics/cache/
+# File-based by default so every gunicorn worker on a host shares cached fragments
+# and the version counters that invalidate them (see webapp/caching.py). Set
+# CACHE_BACKEND/CACHE_LOCATION to use e.g. Redis or Memcached instead.
+# Every person has their own version counter, context and ratings entries, plus
+# fragments per order and group, so Django's default of 300 entries would cull
+# live counters and ratings on every write. Size CACHE_MAX_ENTRIES to roughly
+# 10x the number of people (the file cache culls a third of it when full).
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', os.path.join(tempfile.gettempdir(), 'pizza_solver_cache')),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.environ.get('CACHE_MAX_ENTRIES', '100000')),
+        },
+    }
+}
+
+# Seconds a rendered page fragment stays cached. Fragments are keyed on object
+# versions, so this only bounds how long superseded entries linger.
+FRAGMENT_CACHE_TIMEOUT = int(os.environ.get('FRAGMENT_CACHE_TIMEOUT', '3600'))
+
+# Seconds each person's topping ratings stay cached for the solver and scoring
+# (see webapp/preferences.py). Invalidated on every preference write.
+PREFERENCE_CACHE_TIMEOUT = int(os.environ.get('PREFERENCE_CACHE_TIMEOUT', '3600'))
+
+# Also keep each person's ratings as one packed PersonPreferenceVector and read
+# those on cache misses. Run `manage.py pack_preferences` after turning this on.
+PACKED_PREFERENCES = os.environ.get('PACKED_PREFERENCES', 'False').lower() == 'true'
+
+
+# Solver concurrency governor (see webapp/governor.py). Caps concurrent CBC runs
+# across all gunicorn workers; 0 means half the available cores.
+SOLVER_MAX_CONCURRENT = int(os.environ.get('SOLVER_MAX_CONCURRENT', '0'))
+SOLVER_QUEUE_TIMEOUT = float(os.environ.get('SOLVER_QUEUE_TIMEOUT', '60'))
+SOLVER_LOCK_DIR = os.environ.get('SOLVER_LOCK_DIR', os.path.join(tempfile.gettempdir(), 'pizza_solver_locks'))
+
+# Metrics (webapp/metrics.py), served at /metrics in Prometheus text format to
+# staff and to METRICS_ALLOWED_IPS. Workers on one host share METRICS_DIR; each
+# writes its numbers there at most every METRICS_FLUSH_INTERVAL seconds.
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'pizza_solver_metrics'))
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+METRICS_ALLOWED_IPS = [
+    ip.strip() for ip in os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',') if ip.strip()
+]
+
+
+# Seconds to cache each user's Person and group memberships across requests
+# (0 = resolve once per request only). Invalidated by webapp.signals.
+PERSON_CONTEXT_CACHE_TIMEOUT = int(os.environ.get('PERSON_CONTEXT_CACHE_TIMEOUT', '0'))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
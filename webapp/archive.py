@@ -0,0 +1,170 @@
+"""
+Cold storage for old solved orders.
+
+archive_orders() replaces each order's hot rows (the Order, its OrderedPizza
+rows and their M2M through rows, guest Persons and their preferences) with a
+single ArchivedOrder row holding a zlib-compressed JSON snapshot. Snapshots
+keep everything the results page shows, including the staff pizza scores as
+they were at archive time, so archived orders stay viewable.
+
+load_archived_order() turns a snapshot back into lightweight objects with the
+attributes order_results.html reads (order.people.all, pizza.toppings.count, ...).
+"""
+
+import json
+import zlib
+from datetime import datetime
+
+from django.db import connection, transaction
+
+from .models import ArchivedOrder, Order, Person, PersonToppingPreference
+from .preferences import invalidate_preferences
+from .utils import compute_pizza_scores
+
+SNAPSHOT_VERSION = 1
+
+
+def snapshot(order, scores):
+    """JSON-serialisable dict of an order with prefetched people, guests and pizzas."""
+    guests = {g.pk: g for g in order.guest_persons.all()}
+    return {
+        'version': SNAPSHOT_VERSION,
+        'id': order.pk,
+        'group_id': order.group_id,
+        'restaurant': order.restaurant.name,
+        'host': order.host.name,
+        'num_pizzas': order.num_pizzas,
+        'optimization_mode': order.optimization_mode,
+        'shareability_bonus_weight': order.shareability_bonus_weight,
+        'created_at': order.created_at.isoformat(),
+        'updated_at': order.updated_at.isoformat(),
+        'people': [
+            {'id': p.pk, 'name': p.name, 'guest': p.pk in guests} for p in order.people.all()
+        ],
+        'guest_preferences': {
+            str(g.pk): {pref.topping.name: pref.preference for pref in g.topping_preferences.all()}
+            for g in guests.values()
+        },
+        'pizzas': [
+            {
+                'toppings': [t.name for t in pizza.toppings.all()],
+                'people': [p.pk for p in pizza.people.all()],
+                'score': scores.get(pizza.pk),
+            }
+            for pizza in order.pizzas.all()
+        ],
+    }
+
+
+def pack(data):
+    return zlib.compress(json.dumps(data, separators=(',', ':')).encode(), 9)
+
+
+def unpack(blob):
+    return json.loads(zlib.decompress(bytes(blob)))
+
+
+def archive_orders(order_ids):
+    """Archive the given solved orders in one transaction. Returns the number archived."""
+    orders = list(
+        Order.objects.filter(pk__in=order_ids, pizzas__isnull=False).distinct()
+        .select_related('restaurant', 'host')
+        .prefetch_related(
+            'people', 'guest_persons__topping_preferences__topping', 'pizzas__toppings', 'pizzas__people',
+        )
+    )
+    if not orders:
+        return 0
+    archives = []
+    for order in orders:
+        pizzas = list(order.pizzas.all())
+        archives.append(ArchivedOrder(
+            order_id=order.pk,
+            group_id=order.group_id,
+            created_at=order.created_at,
+            data=pack(snapshot(order, compute_pizza_scores(pizzas))),
+        ))
+    ids = [o.pk for o in orders]
+    guest_ids = [g.pk for o in orders for g in o.guest_persons.all()]
+
+    with transaction.atomic():
+        ArchivedOrder.objects.bulk_create(archives)
+        if guest_ids:
+            # Guest preference rows go in one statement: deleting them through the
+            # ORM would fire a cache-invalidation signal per row.
+            with connection.cursor() as cursor:
+                qn = connection.ops.quote_name
+                placeholders = ', '.join(['%s'] * len(guest_ids))
+                cursor.execute(
+                    f"DELETE FROM {qn(PersonToppingPreference._meta.db_table)} "
+                    f"WHERE {qn('person_id')} IN ({placeholders})",
+                    guest_ids,
+                )
+        # Cascades to pizzas, their M2M rows, order.people rows and guest Persons.
+        Order.objects.filter(pk__in=ids).delete()
+        transaction.on_commit(lambda: invalidate_preferences(*guest_ids))
+    return len(ids)
+
+
+# ---------------------------------------------------------------------------
+# Reading archives back for the results page
+# ---------------------------------------------------------------------------
+
+class _Related(list):
+    """A list that quacks like a related manager for templates: .all and .count."""
+
+    def all(self):
+        return self
+
+    def count(self):
+        return len(self)
+
+
+class _Named:
+    def __init__(self, pk, name):
+        self.pk = pk
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+
+class _ArchivedPizza:
+    def __init__(self, toppings, people):
+        self.toppings = toppings
+        self.people = people
+
+
+class ArchivedOrderView:
+    """Read-only stand-in for an Order, built from an archive snapshot."""
+
+    archived = True
+
+    def __init__(self, archived_order):
+        data = unpack(archived_order.data)
+        self.pk = self.id = data['id']
+        self.group_id = data['group_id']
+        self.restaurant = data['restaurant']
+        self.host = data['host']
+        self.num_pizzas = data['num_pizzas']
+        self.optimization_mode = data['optimization_mode']
+        self.shareability_bonus_weight = data['shareability_bonus_weight']
+        self.created_at = datetime.fromisoformat(data['created_at'])
+        self.updated_at = datetime.fromisoformat(data['updated_at'])
+        self.archived_at = archived_order.archived_at
+        people = {p['id']: _Named(p['id'], p['name']) for p in data['people']}
+        self.people = _Related(people.values())
+        self.guest_person_ids = {p['id'] for p in data['people'] if p['guest']}
+        self.pizzas_with_scores = [
+            (_ArchivedPizza(
+                _Related(_Named(None, name) for name in pizza['toppings']),
+                _Related(people[pk] for pk in pizza['people'] if pk in people),
+            ), pizza['score'])
+            for pizza in data['pizzas']
+        ]
+
+
+def load_archived_order(order_id):
+    """ArchivedOrderView for order_id, or None if it was never archived."""
+    archived = ArchivedOrder.objects.filter(pk=order_id).first()
+    return ArchivedOrderView(archived) if archived else None
@@ -0,0 +1,187 @@
+"""
+Fixture data and one request per URL, shared by the bench_views command and
+the query budget tests.
+
+seed() builds a group of a given size in the current database: a staff host
+who administers it, members with preferences for every topping, solved orders
+with pizzas, and an open draft order with a guest. url_requests() maps every
+URL name in webapp.urls to a request against that data, and timed_request()
+runs one and rolls back whatever it wrote, so every request sees the same data.
+"""
+
+import random
+import time
+import uuid
+from dataclasses import dataclass
+
+from constance import config
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse
+from django.urls import reverse
+
+from . import querylog
+from .guests import set_guest_cookie
+from .models import (
+    GroupMembership, Order, OrderedPizza, Person, PersonToppingPreference, PizzaGroup, PizzaRestaurant,
+    RequestProfile, RestaurantTopping, Topping, User,
+)
+
+PREFERENCE_VALUES = [
+    PersonToppingPreference.ALLERGY, PersonToppingPreference.DISLIKE,
+    PersonToppingPreference.NEUTRAL, PersonToppingPreference.LIKE,
+]
+PREFERENCE_WEIGHTS = [1, 3, 4, 4]
+PIZZAS_PER_ORDER = 3
+
+
+@dataclass
+class Fixture:
+    user: User
+    host: Person
+    group: PizzaGroup
+    other_group: PizzaGroup
+    restaurant: PizzaRestaurant
+    toppings: list
+    people: list
+    solved: Order
+    draft: Order
+    guest: Person
+    profile: RequestProfile
+
+
+def seed(members=30, toppings=20, orders=8, rng=None):
+    """Create a group of the given size in the current database and return its Fixture."""
+    rng = rng or random.Random(0)
+    tag = uuid.uuid4().hex[:6]
+    # The constance database backend inserts a setting's default on first read; do that up front.
+    for key in settings.CONSTANCE_CONFIG:
+        getattr(config, key)
+
+    user = User.objects.create_user(
+        username=f"host-{tag}@bench.test", email=f"host-{tag}@bench.test", password=None, is_staff=True,
+    )
+    topping_objs = Topping.objects.bulk_create([Topping(name=f"Bench {tag} {i:03}") for i in range(toppings)])
+    group = PizzaGroup.objects.create(name=f"Bench {tag}", invite_token=uuid.uuid4())
+    other_group = PizzaGroup.objects.create(name=f"Bench {tag} (other)", invite_token=uuid.uuid4())
+    restaurant = PizzaRestaurant.objects.create(name=f"Bench {tag} Pizza", group=group)
+    RestaurantTopping.objects.bulk_create(
+        [RestaurantTopping(restaurant=restaurant, topping=t) for t in topping_objs]
+    )
+    host = Person.objects.create(name="Bench Host", email=user.email, user_account=user)
+    member_objs = Person.objects.bulk_create([
+        Person(name=f"Member {i:05}", email=f"m{i}-{tag}@bench.test", unrated_is_dislike=rng.random() < 0.2)
+        for i in range(members)
+    ])
+    people = [host] + member_objs
+    GroupMembership.objects.bulk_create(
+        [GroupMembership(group=group, person=host, is_admin=True),
+         GroupMembership(group=other_group, person=host, is_admin=True)]
+        + [GroupMembership(group=group, person=p) for p in member_objs]
+    )
+    PersonToppingPreference.objects.bulk_create([
+        PersonToppingPreference(person=p, topping=t, preference=rng.choices(PREFERENCE_VALUES, PREFERENCE_WEIGHTS)[0])
+        for p in people for t in topping_objs
+    ], batch_size=5000)
+
+    solved = None
+    for _ in range(orders):
+        solved = Order.objects.create(
+            host=host, restaurant=restaurant, group=group, num_pizzas=PIZZAS_PER_ORDER,
+            optimization_mode='maximize_likes',
+        )
+        solved.people.set(people)
+        pizzas = OrderedPizza.objects.bulk_create([OrderedPizza(order=solved) for _ in range(PIZZAS_PER_ORDER)])
+        OrderedPizza.toppings.through.objects.bulk_create([
+            OrderedPizza.toppings.through(orderedpizza_id=pizza.pk, topping_id=t.pk)
+            for k, pizza in enumerate(pizzas) for t in topping_objs[k:k + 2]
+        ])
+        OrderedPizza.people.through.objects.bulk_create([
+            OrderedPizza.people.through(orderedpizza_id=pizza.pk, person_id=p.pk)
+            for k, pizza in enumerate(pizzas) for p in people[k::PIZZAS_PER_ORDER]
+        ])
+
+    draft = Order.objects.create(
+        host=host, restaurant=restaurant, group=group, num_pizzas=2,
+        optimization_mode='maximize_likes', invite_token=uuid.uuid4(),
+    )
+    draft.people.set(people[:10])
+    guest = Person.objects.create(name="Guest", email="", guest_for_order=draft)
+    draft.people.add(guest)
+    profile = RequestProfile.objects.create(
+        method='GET', path='/', status_code=200, duration_ms=1, query_count=1,
+        trigger=RequestProfile.TRIGGER_FLAG, summary='', stats=b'',
+    )
+    return Fixture(
+        user=user, host=host, group=group, other_group=other_group, restaurant=restaurant,
+        toppings=topping_objs, people=people, solved=solved, draft=draft, guest=guest, profile=profile,
+    )
+
+
+def url_requests(fx):
+    """url name -> (method, url, POST data or GET params) for every URL in webapp.urls."""
+    group, draft, solved, topping = fx.group.pk, fx.draft, fx.solved, fx.toppings[0]
+    specs = {
+        'index': ('get', {}, None),
+        'order_select_group': ('get', {}, None),
+        'new_order': ('get', {'group_id': group}, None),
+        'draft_order': ('get', {'group_id': group, 'order_id': draft.pk}, None),
+        'order_results': ('get', {'order_id': solved.pk}, None),
+        'order_recompute': ('post', {'order_id': draft.pk}, {}),
+        'order_cancel_invite': ('post', {'order_id': draft.pk}, {}),
+        'order_people_partial': ('get', {'order_id': draft.pk}, None),
+        'order_join': ('get', {'invite_token': draft.invite_token}, None),
+        'order_join_autosave': (
+            'post', {'invite_token': draft.invite_token, 'topping_id': topping.pk}, {f'pref_{topping.pk}': '1'},
+        ),
+        'topping_list': ('get', {}, None),
+        'topping_create': ('get', {}, None),
+        'topping_edit': ('get', {'pk': topping.pk}, None),
+        'topping_merge': ('post', {'pk': topping.pk}, {'target': fx.toppings[1].pk}),
+        'topping_delete': ('get', {'pk': topping.pk}, None),
+        'staff_preferences': ('get', {}, {'group': group}),
+        'staff_preferences_matrix': ('get', {'group_id': group}, None),
+        'staff_preferences_export': ('get', {'group_id': group}, None),
+        'staff_orders_export': ('get', {}, None),
+        'staff_import': ('get', {}, None),
+        'staff_db_pool': ('get', {}, None),
+        'staff_profiles': ('get', {}, None),
+        'staff_profile_detail': ('get', {'pk': fx.profile.pk}, None),
+        'staff_profile_download': ('get', {'pk': fx.profile.pk}, None),
+        'metrics': ('get', {}, None),
+        'restaurant_list': ('get', {}, None),
+        'restaurant_create': ('get', {}, None),
+        'restaurant_edit': ('get', {'pk': fx.restaurant.pk}, None),
+        'restaurant_clone': ('get', {'pk': fx.restaurant.pk}, None),
+        'restaurant_delete': ('get', {'pk': fx.restaurant.pk}, None),
+        'profile_edit': ('get', {}, None),
+        'profile_preference_autosave': ('post', {'topping_id': topping.pk}, {f'pref_{topping.pk}': 'like'}),
+        'group_list': ('get', {}, None),
+        'group_create': ('get', {}, None),
+        'group_detail': ('get', {'pk': group}, None),
+        'group_orders': ('get', {'pk': group}, None),
+        'group_delete': ('get', {'pk': group}, None),
+        'group_join': ('get', {'token': fx.other_group.invite_token}, None),
+        'group_reset_invite': ('post', {'pk': group}, {}),
+        'group_remove_member': ('post', {'pk': group, 'person_pk': fx.people[1].pk}, {}),
+    }
+    return {name: (method, reverse(name, kwargs=kwargs), data) for name, (method, kwargs, data) in specs.items()}
+
+
+def login(client, fx):
+    """Log client in as the fixture's host, with the draft order's guest cookie set."""
+    client.force_login(fx.user)
+    client.cookies.update(set_guest_cookie(HttpResponse(), fx.draft, fx.guest.pk).cookies)
+
+
+def timed_request(client, method, url, data):
+    """Run one request and roll back its writes. Returns (response, seconds, QueryLog, body bytes)."""
+    with transaction.atomic():
+        with querylog.record() as log:
+            start = time.perf_counter()
+            response = getattr(client, method)(url, data)
+            # Streaming exports run their queries while the body is consumed.
+            body = b''.join(response.streaming_content) if response.streaming else response.content
+            seconds = time.perf_counter() - start
+        transaction.set_rollback(True)
+    return response, seconds, log, len(body)
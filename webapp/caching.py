@@ -0,0 +1,82 @@
+"""
+Version counters for fragment caching.
+
+Cached page fragments are keyed on the versions of the objects they render.
+Instead of deleting fragments when data changes, signal handlers in
+webapp.signals bump the relevant version, so the next render uses a fresh key
+and stale fragments simply age out of the cache.
+
+Writers call bump_on_commit() rather than bump_versions(): the bump waits for
+the transaction to commit, so a reader that sees the old rows in the meantime
+caches them under the old version. Names bumped in one transaction are
+collected and bumped together.
+
+Version names:
+  - 'toppings':                the topping catalog
+  - 'restaurant:<pk>':         one restaurant's topping set
+  - 'group-restaurants:<pk>':  the restaurants (and their topping sets) of a group
+  - 'group-members:<pk>':      a group's memberships and member names
+  - 'person:<pk>':             one person's name, unrated default and topping ratings
+
+A version missing from the cache (never set, or evicted) is initialised to
+the current time, so it can never collide with a value used before.
+"""
+
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+VERSION_KEY = 'version:{}'
+
+
+def bump_versions(*names):
+    """Invalidate every fragment keyed on any of the given versions."""
+    now = time.time_ns()
+    cache.set_many({VERSION_KEY.format(name): now for name in names}, None)
+
+
+def get_versions(*names):
+    """Return {name: version} for the given names, initialising missing ones."""
+    keys = {VERSION_KEY.format(name): name for name in names}
+    found = cache.get_many(keys)
+    missing = [name for key, name in keys.items() if key not in found]
+    if missing:
+        bump_versions(*missing)
+        found.update(cache.get_many([VERSION_KEY.format(name) for name in missing]))
+    return {name: found[key] for key, name in keys.items()}
+
+
+def versions_key(*names):
+    """A single string combining the given versions, for use as a {% cache %} vary-on argument."""
+    versions = get_versions(*names)
+    return '-'.join(f'{name}.{versions[name]}' for name in names)
+
+
+def restaurant_versions(menus):
+    """Version names for [(restaurant_id, group_id)]: each restaurant and its group's restaurant list."""
+    return [f'restaurant:{pk}' for pk, _ in menus] + [f'group-restaurants:{gid}' for _, gid in menus if gid]
+
+
+def collect_on_commit(name, items, callback):
+    """Add items to the current transaction's set called name; callback(items) runs once when it commits.
+
+    Outside a transaction callback runs right away. Items added by a transaction
+    that rolled back go out with the next batch.
+    """
+    pending = transaction.get_connection().__dict__.setdefault('pending_on_commit', {})
+    pending.setdefault(name, set()).update(items)
+
+    def flush():
+        # Every call registers a flush, so a rolled-back savepoint cannot drop the batch;
+        # the first flush to run takes it and the rest find nothing.
+        collected = pending.pop(name, None)
+        if collected:
+            callback(collected)
+
+    transaction.on_commit(flush)
+
+
+def bump_on_commit(*names):
+    """bump_versions() once the current transaction commits."""
+    collect_on_commit('versions', names, lambda collected: bump_versions(*collected))
@@ -0,0 +1,36 @@
+"""
+Connection pool metrics.
+
+With DB_POOL=True (see settings) each PostgreSQL alias gets a psycopg_pool
+ConnectionPool per worker process. pool_stats() reads its counters; they
+describe only the process that answers, so sample a few requests to see
+every worker.
+"""
+
+import os
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+def pool_stats():
+    """{alias: stats dict} for every database alias that uses a connection pool."""
+    stats = {}
+    for alias in connections:
+        pool = getattr(connections[alias], 'pool', None)
+        if pool is not None:
+            stats[alias] = pool.get_stats()
+    return stats
+
+
+def release_idle_connection(using=DEFAULT_DB_ALIAS):
+    """Hand this thread's pooled connection back to the pool, unless a transaction is using it.
+
+    The next query checks one out again. Without a pool this does nothing.
+    """
+    connection = connections[using]
+    if getattr(connection, 'pool', None) is not None and not connection.in_atomic_block:
+        connection.close()
+
+
+def pool_report():
+    """Stats for this worker process, tagged with its pid."""
+    return {'pid': os.getpid(), 'databases': pool_stats()}
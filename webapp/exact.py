@@ -0,0 +1,125 @@
+"""
+Exact solvers for small orders, run in-process instead of CBC.
+
+Once it is fixed who shares a pizza, that pizza's best toppings no longer
+depend on the other pizzas: they are the toppings nobody on it is allergic to
+whose blended score is positive, best first, up to MAX_TOPPINGS_PER_PIZZA. So:
+
+  - one pizza: everyone is on it, and it takes the top-scoring safe toppings;
+  - a few pizzas: a memoised search over bitmasks enumerates the balanced
+    partitions of the people (sizes floor(P/K) and ceil(P/K), as in the ILP),
+    scoring each possible group once.
+
+Both reach the ILP's optimal objective for both optimization modes, including
+shareability. solve() uses them for every one-pizza order, and for orders with
+at most MAX_PARTITIONS balanced partitions and MAX_GROUPS possible groups; it
+builds the ILP otherwise.
+"""
+
+import math
+from functools import lru_cache
+from itertools import combinations
+
+# Past these sizes the search takes longer than building the ILP and running CBC.
+MAX_PARTITIONS = 20000
+MAX_GROUPS = 2000
+
+
+def group_count(num_people, num_pizzas):
+    """How many distinct groups of a balanced size the search may have to score."""
+    lo = num_people // num_pizzas
+    return math.comb(num_people, lo) + (math.comb(num_people, lo + 1) if num_people % num_pizzas else 0)
+
+
+def partition_count(num_people, num_pizzas):
+    """How many ways num_people split into num_pizzas unlabelled, balanced groups."""
+    small, big = num_pizzas - num_people % num_pizzas, num_people % num_pizzas
+    lo = num_people // num_pizzas
+    return math.factorial(num_people) // (
+        math.factorial(lo) ** small * math.factorial(lo + 1) ** big * math.factorial(small) * math.factorial(big)
+    )
+
+
+class Instance:
+    """The solver inputs of one order, indexed the way solver.solve() indexes them.
+
+    prefs maps (person_index, topping_index) -> score and never holds allergies;
+    allergy_pairs holds those. share_weight is the per-pizza shareability weight
+    (order.shareability_bonus_weight / (K - 1), or 0 for a single pizza).
+    """
+
+    def __init__(self, num_people, num_toppings, prefs, allergy_pairs, num_pizzas, max_toppings,
+                 share_weight, mode):
+        self.num_people = num_people
+        self.num_pizzas = num_pizzas
+        self.max_toppings = max_toppings
+        self.share_weight = share_weight
+        self.balanced = mode == 'minimize_dislikes'
+        self.rows = [[prefs.get((p, t), 0) for t in range(num_toppings)] for p in range(num_people)]
+        self.totals = [sum(column) for column in zip(*self.rows)] if num_people else [0] * num_toppings
+        self.allergic = [0] * num_toppings  # bitmask of people allergic to each topping
+        for p, t in allergy_pairs:
+            self.allergic[t] |= 1 << p
+
+    def toppings_for(self, mask):
+        """(score, topping indexes) of the best pizza for the people in bitmask mask."""
+        sums = map(sum, zip(*(self.rows[p] for p in range(self.num_people) if mask >> p & 1)))
+        own, share = 1 - self.share_weight, self.share_weight
+        scored = sorted(
+            (-score, t)
+            for t, score in enumerate(own * assigned + share * total for assigned, total in zip(sums, self.totals))
+            if score > 0 and not self.allergic[t] & mask
+        )[:self.max_toppings]
+        return -sum(score for score, _ in scored), [t for _, t in scored]
+
+    def value(self, pizzas):
+        """The ILP objective of pizzas, a list of (person indexes, topping indexes)."""
+        scores = []
+        for people, toppings in pizzas:
+            members = set(people)
+            scores.append(sum(
+                (1 - self.share_weight) * sum(self.rows[p][t] for p in members)
+                + self.share_weight * self.totals[t]
+                for t in toppings
+            ))
+        return min(scores) if self.balanced else sum(scores)
+
+    def solve(self):
+        """Optimal pizzas as a list of (person indexes, topping indexes), or None if the order is too big."""
+        everyone = (1 << self.num_people) - 1
+        if self.num_pizzas == 1:
+            return [(list(range(self.num_people)), self.toppings_for(everyone)[1])]
+        if (partition_count(self.num_people, self.num_pizzas) > MAX_PARTITIONS
+                or group_count(self.num_people, self.num_pizzas) > MAX_GROUPS):
+            return None
+
+        lo = self.num_people // self.num_pizzas
+        best_group = lru_cache(maxsize=None)(self.toppings_for)
+
+        @lru_cache(maxsize=None)
+        def best(mask, big_left):
+            """(key, groups) for splitting bitmask mask; key compares (worst, total) or (total,)."""
+            if not mask:
+                return ((math.inf, 0) if self.balanced else (0,)), ()
+            first = mask & -mask
+            rest = [1 << p for p in range(self.num_people) if (mask & ~first) >> p & 1]
+            # What is left always splits into big_left groups of lo + 1 and some of lo.
+            sizes = [lo + 1] if big_left else []
+            if mask.bit_count() > (lo + 1) * big_left:
+                sizes.append(lo)
+            winner = None
+            for size in sizes:
+                for others in combinations(rest, size - 1):
+                    group = first | sum(others)
+                    sub_key, sub_groups = best(mask & ~group, big_left - (size > lo))
+                    score = best_group(group)[0]
+                    key = (min(score, sub_key[0]), score + sub_key[1]) if self.balanced else (score + sub_key[0],)
+                    if winner is None or key > winner[0]:
+                        winner = key, (group,) + sub_groups
+            return winner
+
+        _, groups = best(everyone, self.num_people % self.num_pizzas)
+        return [
+            ([p for p in range(self.num_people) if group >> p & 1], best_group(group)[1])
+            for group in groups
+        ]
@@ -0,0 +1,157 @@
+"""
+Streaming CSV / JSONL exports for staff.
+
+Each export is a generator of text lines, so it can be fed straight into a
+StreamingHttpResponse or written to a file by a management command. Rows are
+read with iterator(chunk_size=...), which uses a server-side cursor on
+PostgreSQL, so memory stays flat no matter how much history is exported.
+
+Exports:
+  - group_preferences: one record per persistent member of a group, with their
+    explicit topping ratings (CSV: one column per topping).
+  - order_history: one record per order with its pizzas, toppings and
+    assigned people (CSV: one row per pizza).
+"""
+
+import csv
+import io
+import json
+from itertools import groupby
+
+from django.db.models import Prefetch
+from django.db.models.functions import Lower
+
+from .models import Order, OrderedPizza, Person, PersonToppingPreference, Topping
+
+CHUNK_SIZE = 2000
+FORMATS = ('csv', 'jsonl')
+CONTENT_TYPES = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+PREFERENCE_LABELS = {
+    PersonToppingPreference.ALLERGY: 'allergy',
+    PersonToppingPreference.DISLIKE: 'dislike',
+    PersonToppingPreference.NEUTRAL: 'neutral',
+    PersonToppingPreference.LIKE: 'like',
+}
+
+
+def _csv_lines(header, rows):
+    """Encode rows as CSV one line at a time."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    yield buffer.getvalue()
+    for row in rows:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(row)
+        yield buffer.getvalue()
+
+
+def _jsonl_lines(records):
+    for record in records:
+        yield json.dumps(record, default=str) + '\n'
+
+
+# ---------------------------------------------------------------------------
+# Group preference matrix
+# ---------------------------------------------------------------------------
+
+def _member_records(group):
+    """Yield {person_id, name, email, unrated, preferences: {topping_id: label}} per member, by pk."""
+    members = (
+        Person.objects.filter(group_memberships__group=group, guest_for_order__isnull=True)
+        .order_by('pk').values_list('pk', 'name', 'email', 'unrated_is_dislike')
+        .iterator(chunk_size=CHUNK_SIZE)
+    )
+    prefs = groupby(
+        PersonToppingPreference.objects.filter(
+            person__group_memberships__group=group, person__guest_for_order__isnull=True,
+        ).order_by('person_id').values_list('person_id', 'topping_id', 'preference')
+        .iterator(chunk_size=CHUNK_SIZE),
+        key=lambda row: row[0],
+    )
+    # Both streams are ordered by person pk, so merge them without buffering.
+    pending = next(prefs, None)
+    for pk, name, email, unrated_is_dislike in members:
+        while pending is not None and pending[0] < pk:
+            pending = next(prefs, None)
+        ratings = {}
+        if pending is not None and pending[0] == pk:
+            ratings = {topping_id: PREFERENCE_LABELS[pref] for _, topping_id, pref in pending[1]}
+            pending = next(prefs, None)
+        yield {
+            'person_id': pk,
+            'name': name,
+            'email': email,
+            'unrated': 'dislike' if unrated_is_dislike else 'neutral',
+            'preferences': ratings,
+        }
+
+
+def group_preferences(group, fmt):
+    """Lines of the group's preference matrix. Blank CSV cells are unrated toppings."""
+    toppings = list(Topping.objects.order_by(Lower('name')).values_list('pk', 'name'))
+    names = dict(toppings)
+    records = _member_records(group)
+    if fmt == 'jsonl':
+        return _jsonl_lines(
+            {**r, 'preferences': {names[tid]: label for tid, label in r['preferences'].items()}}
+            for r in records
+        )
+    header = ['person_id', 'name', 'email', 'unrated'] + [name for _, name in toppings]
+    return _csv_lines(header, (
+        [r['person_id'], r['name'], r['email'], r['unrated']]
+        + [r['preferences'].get(tid, '') for tid, _ in toppings]
+        for r in records
+    ))
+
+
+# ---------------------------------------------------------------------------
+# Order history
+# ---------------------------------------------------------------------------
+
+def _order_records(group=None):
+    orders = Order.objects.select_related('group', 'restaurant', 'host').prefetch_related(
+        Prefetch('pizzas', queryset=OrderedPizza.objects.order_by('pk').prefetch_related('toppings', 'people')),
+    ).order_by('pk')
+    if group is not None:
+        orders = orders.filter(group=group)
+    for order in orders.iterator(chunk_size=CHUNK_SIZE):
+        yield {
+            'order_id': order.pk,
+            'created_at': order.created_at.isoformat(),
+            'group': order.group.name,
+            'restaurant': order.restaurant.name,
+            'host': order.host.name,
+            'num_pizzas': order.num_pizzas,
+            'optimization_mode': order.optimization_mode,
+            'pizzas': [
+                {
+                    'pizza_id': pizza.pk,
+                    'toppings': sorted(t.name for t in pizza.toppings.all()),
+                    'people': sorted(p.name for p in pizza.people.all()),
+                }
+                for pizza in order.pizzas.all()
+            ],
+        }
+
+
+def order_history(fmt, group=None):
+    """Lines of every order (optionally one group's), with pizzas, toppings and assignments."""
+    records = _order_records(group)
+    if fmt == 'jsonl':
+        return _jsonl_lines(records)
+    header = ['order_id', 'created_at', 'group', 'restaurant', 'host', 'num_pizzas',
+              'optimization_mode', 'pizza_id', 'toppings', 'people']
+
+    def rows():
+        for r in records:
+            base = [r['order_id'], r['created_at'], r['group'], r['restaurant'], r['host'],
+                    r['num_pizzas'], r['optimization_mode']]
+            if not r['pizzas']:
+                yield base + ['', '', '']
+            for pizza in r['pizzas']:
+                yield base + [pizza['pizza_id'], '; '.join(pizza['toppings']), '; '.join(pizza['people'])]
+
+    return _csv_lines(header, rows())
@@ -25,12 +25,22 @@ class BaseOrderForm(forms.Form):
         initial=0,
         widget=forms.HiddenInput(),
     )
+    solve_quality = forms.ChoiceField(
+        choices=Order.SOLVE_QUALITY_CHOICES,
+        initial='balanced',
+        required=False,
+        widget=forms.HiddenInput(),
+    )
 
-    def __init__(self, *args, host=None, selected_group=None, **kwargs):
+    def __init__(self, *args, host=None, selected_group=None, allow_exact=False, **kwargs):
         super().__init__(*args, **kwargs)
         self.host = host
         self.selected_group = selected_group
         self._guest_pks = set()
+        self.allow_exact = allow_exact
+
+    def clean_solve_quality(self):
+        return self.cleaned_data['solve_quality'] or 'balanced'
 
     def clean(self):
         cleaned = super().clean()
@@ -48,6 +58,9 @@ class BaseOrderForm(forms.Form):
             if num_pizzas > effective_count:
                 self.add_error('num_pizzas', "Cannot have more pizzas than people.")
 
+        if cleaned.get('solve_quality') == 'exact' and not self.allow_exact:
+            self.add_error('solve_quality', "Only staff can request an exact solve.")
+
         return cleaned
 
 
@@ -144,6 +157,28 @@ class CloneRestaurantForm(forms.Form):
             self.fields['name'].initial = restaurant.name
 
 
+class BulkImportForm(forms.Form):
+    file = forms.FileField(label="JSON or CSV file")
+    group = forms.CharField(
+        max_length=200, required=False, label="Group",
+        help_text="Group to add people and restaurants to. Created if it doesn't exist; "
+                  "overrides a JSON file's \"group\".",
+    )
+    create_toppings = forms.BooleanField(required=False, label="Create toppings that don't exist yet")
+
+    def clean_file(self):
+        upload = self.cleaned_data['file']
+        fmt = upload.name.rsplit('.', 1)[-1].lower()
+        if fmt not in ('json', 'csv'):
+            raise forms.ValidationError("Upload a .json or .csv file.")
+        try:
+            upload.text = upload.read().decode('utf-8')
+        except UnicodeDecodeError:
+            raise forms.ValidationError("The file must be UTF-8 encoded.")
+        upload.format = fmt
+        return upload
+
+
 class PizzaGroupForm(forms.ModelForm):
     class Meta:
         model = PizzaGroup
@@ -0,0 +1,203 @@
+"""
+Cross-process concurrency governor for solver runs.
+
+Every gunicorn worker is a separate process, so an in-process semaphore cannot
+stop N workers from launching N CBC processes at once. The governor instead
+uses a directory of slot files guarded by ``flock``: holding an exclusive lock
+on one of the ``SOLVER_MAX_CONCURRENT`` slot files is the right to run a solve.
+Locks are released by the kernel if a worker dies, so a timed-out or killed
+worker never leaks a slot.
+
+Requests that cannot get a slot wait in a queue, polling until
+``SOLVER_QUEUE_TIMEOUT`` seconds have passed, after which SolverBusyError is
+raised. Each waiter creates a ``wait-<pid>-<id>`` marker file so the queue
+depth can be read by any process.
+
+stats() (scraped by /metrics) never locks, writes or removes anything: a slot
+holder writes its pid into the slot file and clears it before unlocking, and
+both slots and waiters count only while that pid is alive. A probing lock
+would make a concurrent non-blocking acquire fail. Markers left by dead
+workers are removed by the next request that queues.
+
+Settings:
+  - SOLVER_MAX_CONCURRENT: concurrent solves across all workers (0 = half the
+    available cores, at least 1).
+  - SOLVER_QUEUE_TIMEOUT: seconds a request may wait for a slot.
+  - SOLVER_LOCK_DIR: directory shared by all workers for the lock files.
+"""
+
+import contextlib
+import logging
+import os
+import time
+import uuid
+from dataclasses import dataclass
+
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - non-POSIX platforms run ungoverned
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.05
+
+
+class SolverBusyError(ValueError):
+    """Raised when no solver slot became free within the queue timeout."""
+
+
+@dataclass
+class SolverSlot:
+    """A held solver slot, with the thread budget and how long it took to get."""
+    index: int
+    threads: int
+    wait_seconds: float
+    queue_depth: int
+
+
+def available_cores():
+    """Cores this process may run on (respects CPU affinity, e.g. in containers)."""
+    if hasattr(os, 'sched_getaffinity'):
+        return max(1, len(os.sched_getaffinity(0)))
+    return max(1, os.cpu_count() or 1)
+
+
+def max_concurrent_solves():
+    configured = settings.SOLVER_MAX_CONCURRENT
+    if configured > 0:
+        return configured
+    return max(1, available_cores() // 2)
+
+
+def threads_per_solve():
+    """Split the available cores evenly across the concurrent solve slots."""
+    return max(1, available_cores() // max_concurrent_solves())
+
+
+def _lock_dir():
+    path = settings.SOLVER_LOCK_DIR
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _try_lock(path):
+    """Open path and take a non-blocking exclusive lock. Returns the fd or None."""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def _release(fd):
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # alive, but run by another user
+        pass
+    return True
+
+
+def _holder(path):
+    """The live pid recorded in a slot file, or None if the slot is free."""
+    try:
+        with open(path, 'rb') as f:
+            pid = int(f.read() or 0)
+    except (FileNotFoundError, ValueError):
+        return None
+    return pid if pid and _alive(pid) else None
+
+
+def _waiters(lock_dir):
+    """(live, stale) wait marker paths, by whether the pid in their name is alive."""
+    live, stale = [], []
+    for name in os.listdir(lock_dir):
+        if name.startswith('wait-'):
+            pid = int(name.split('-')[1])
+            (live if _alive(pid) else stale).append(os.path.join(lock_dir, name))
+    return live, stale
+
+
+def stats():
+    """Snapshot of governor state: slot count, slots in use and waiting requests. Read-only."""
+    limit = max_concurrent_solves()
+    lock_dir = settings.SOLVER_LOCK_DIR
+    if fcntl is None or not os.path.isdir(lock_dir):
+        return {'max_concurrent': limit, 'active': 0, 'queue_depth': 0}
+    active = sum(_holder(os.path.join(lock_dir, f'slot-{i}')) is not None for i in range(limit))
+    return {'max_concurrent': limit, 'active': active, 'queue_depth': len(_waiters(lock_dir)[0])}
+
+
+@contextlib.contextmanager
+def solver_slot(timeout=None):
+    """Hold one of the global solver slots for the duration of the block.
+
+    Yields a SolverSlot. Raises SolverBusyError if no slot frees up in time.
+    """
+    if timeout is None:
+        timeout = settings.SOLVER_QUEUE_TIMEOUT
+    threads = threads_per_solve()
+    if fcntl is None:
+        yield SolverSlot(index=0, threads=threads, wait_seconds=0.0, queue_depth=0)
+        return
+
+    lock_dir = _lock_dir()
+    limit = max_concurrent_solves()
+    start = time.monotonic()
+    deadline = start + timeout
+    wait_path = None
+    slot_fd = None
+    slot_index = None
+    queue_depth = 0
+    try:
+        while True:
+            for i in range(limit):
+                slot_fd = _try_lock(os.path.join(lock_dir, f'slot-{i}'))
+                if slot_fd is not None:
+                    slot_index = i
+                    break
+            if slot_fd is not None:
+                break
+            if wait_path is None:
+                # Register as a waiter so other processes can see the queue.
+                wait_path = os.path.join(lock_dir, f'wait-{os.getpid()}-{uuid.uuid4().hex}')
+                os.close(os.open(wait_path, os.O_WRONLY | os.O_CREAT, 0o644))
+                live, stale = _waiters(lock_dir)
+                for path in stale:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.unlink(path)
+                queue_depth = len(live)
+                logger.info("Solver busy: queued behind %d slot(s), queue depth %d", limit, queue_depth)
+            if time.monotonic() >= deadline:
+                raise SolverBusyError(
+                    f"The solver is busy ({limit} solve(s) running). Please try again shortly."
+                )
+            time.sleep(POLL_INTERVAL)
+    finally:
+        if wait_path is not None:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(wait_path)
+
+    wait_seconds = time.monotonic() - start
+    logger.info(
+        "Solver slot %d acquired after %.3fs (queue depth %d, %d thread(s))",
+        slot_index, wait_seconds, queue_depth, threads,
+    )
+    os.ftruncate(slot_fd, 0)
+    os.pwrite(slot_fd, str(os.getpid()).encode(), 0)
+    try:
+        yield SolverSlot(index=slot_index, threads=threads, wait_seconds=wait_seconds, queue_depth=queue_depth)
+    finally:
+        os.ftruncate(slot_fd, 0)
+        _release(slot_fd)
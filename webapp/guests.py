@@ -0,0 +1,43 @@
+"""
+Guest identity for the no-auth join flow.
+
+A guest who joins an order gets a signed cookie naming their guest Person,
+instead of an entry in the database-backed session. Invite bursts then write
+no django_session rows. The cookie is scoped to the order: its name and
+signing salt include the order, and its path is the order's join URL, so the
+browser only sends it to that order's join and autosave endpoints.
+"""
+
+from django.conf import settings
+from django.core import signing
+from django.urls import reverse
+
+COOKIE_PREFIX = 'guest_'
+SALT = 'webapp.guests'
+# Join links are short-lived; a guest who returns within a week is still recognised.
+MAX_AGE = 7 * 24 * 60 * 60
+
+
+def _cookie_name(order):
+    return f'{COOKIE_PREFIX}{order.pk}'
+
+
+def _salt(order):
+    return f'{SALT}:{order.invite_token}'
+
+
+def get_guest_id(request, order):
+    """Person pk of this browser's guest for order, or None if missing, tampered or expired."""
+    try:
+        return int(request.get_signed_cookie(_cookie_name(order), salt=_salt(order), max_age=MAX_AGE))
+    except (KeyError, ValueError, signing.BadSignature):
+        return None
+
+
+def set_guest_cookie(response, order, person_id):
+    response.set_signed_cookie(
+        _cookie_name(order), str(person_id), salt=_salt(order), max_age=MAX_AGE,
+        path=reverse('order_join', kwargs={'invite_token': order.invite_token}),
+        secure=settings.SESSION_COOKIE_SECURE, httponly=True, samesite='Lax',
+    )
+    return response
@@ -0,0 +1,369 @@
+"""
+Bulk import of people, group memberships, preference matrices and restaurant menus.
+
+Accepted input:
+
+JSON, with any subset of these keys::
+
+    {
+      "group": "Survey Group",
+      "people": [{"name": "Person01", "email": "p01@example.com", "admin": true,
+                  "unrated_is_dislike": false}, ...],
+      "preferences": {"Bacon": [-1, -2, ...], ...},
+      "restaurants": [{"name": "Mario's Pizza", "toppings": ["Bacon", ...]}]
+    }
+
+"preferences" has the seed_test_data.PREFERENCES shape: one list per topping,
+with one value per entry of "people" in the same order. Values are -2..1 or
+allergy/dislike/neutral/like; null leaves the topping unrated.
+
+CSV, in one of two layouts, detected from the header:
+  - people: name, email[, admin][, unrated], then one column per topping
+    (the layout written by exports.group_preferences, so an export can be
+    edited and re-imported).
+  - menus: restaurant, topping; one row per topping offered.
+
+validate() checks the whole payload and reports every problem at once;
+nothing is written unless it passes. apply() then writes everything in one
+transaction with batched upserts (bulk_create(update_conflicts=...)), using
+COPY for the preference rows on PostgreSQL. People are matched by email and
+get a login account with an unusable password, so they can claim it via
+password reset. Restaurants are matched by name within the group and their
+topping list is replaced.
+"""
+
+import csv
+import io
+import json
+from dataclasses import dataclass, field
+
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import connection, transaction
+from django.db.models import Count
+
+from .caching import bump_versions
+from .middleware import person_context_cache_key
+from .models import (
+    GroupMembership, Person, PersonToppingPreference, PizzaGroup, PizzaRestaurant,
+    RestaurantTopping, Topping, User,
+)
+from .preferences import preferences_changed
+
+BATCH_SIZE = 1000
+FORMATS = ('json', 'csv')
+
+PREFERENCE_VALUES = {
+    'allergy': PersonToppingPreference.ALLERGY,
+    'dislike': PersonToppingPreference.DISLIKE,
+    'neutral': PersonToppingPreference.NEUTRAL,
+    'like': PersonToppingPreference.LIKE,
+}
+TRUE_VALUES = ('1', 'true', 'yes', 'y', 'admin')
+PEOPLE_COLUMNS = ('person_id', 'name', 'email', 'admin', 'unrated')
+
+
+class BulkImportError(ValueError):
+    """Raised when an import payload fails validation; .errors lists every problem found."""
+
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__("; ".join(errors))
+
+
+@dataclass
+class ImportPlan:
+    """A validated import, ready for apply()."""
+    group_name: str = None
+    people: list = field(default_factory=list)        # (name, email, is_admin, unrated_is_dislike)
+    ratings: list = field(default_factory=list)       # (email, topping name, preference)
+    restaurants: list = field(default_factory=list)   # (name, [topping names])
+    new_toppings: list = field(default_factory=list)
+
+
+# ---------------------------------------------------------------------------
+# Parsing
+# ---------------------------------------------------------------------------
+
+def parse(text, fmt):
+    """Parse JSON or CSV text into a payload dict with the JSON keys above."""
+    if fmt == 'json':
+        try:
+            payload = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise BulkImportError([f"Invalid JSON: {e}"])
+        if not isinstance(payload, dict):
+            raise BulkImportError(["JSON import must be an object."])
+        return payload
+    return _parse_csv(text)
+
+
+def _parse_csv(text):
+    rows = list(csv.reader(io.StringIO(text.lstrip('\ufeff'))))
+    if not rows:
+        raise BulkImportError(["CSV file is empty."])
+    header = [h.strip() for h in rows[0]]
+    lower = [h.lower() for h in header]
+    body = [row for row in rows[1:] if any(cell.strip() for cell in row)]
+
+    if 'restaurant' in lower and 'topping' in lower:
+        r_col, t_col = lower.index('restaurant'), lower.index('topping')
+        menus = {}
+        for row in body:
+            name = row[r_col].strip() if r_col < len(row) else ''
+            topping = row[t_col].strip() if t_col < len(row) else ''
+            menus.setdefault(name, []).append(topping)
+        return {'restaurants': [{'name': name, 'toppings': toppings} for name, toppings in menus.items()]}
+
+    if 'name' not in lower or 'email' not in lower:
+        raise BulkImportError([
+            "CSV header must contain either name and email columns (people) "
+            "or restaurant and topping columns (menus)."
+        ])
+    topping_cols = [(i, h) for i, h in enumerate(header) if h.lower() not in PEOPLE_COLUMNS]
+    people = []
+    preferences = {name: [] for _, name in topping_cols}
+    for row in body:
+        row = row + [''] * (len(header) - len(row))
+        cell = {h: row[i].strip() for i, h in enumerate(lower)}
+        people.append({
+            'name': cell['name'],
+            'email': cell['email'],
+            'admin': cell.get('admin', '').lower() in TRUE_VALUES,
+            'unrated_is_dislike': cell.get('unrated', '').lower() == 'dislike',
+        })
+        for i, name in topping_cols:
+            preferences[name].append(row[i].strip() or None)
+    return {'people': people, 'preferences': preferences}
+
+
+# ---------------------------------------------------------------------------
+# Validation
+# ---------------------------------------------------------------------------
+
+def _preference_value(value):
+    """Map an imported cell to a preference level; None means unrated. Raises ValueError."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, str):
+        if value.strip().lower() in PREFERENCE_VALUES:
+            return PREFERENCE_VALUES[value.strip().lower()]
+        value = int(value)
+    if isinstance(value, bool) or value not in PREFERENCE_VALUES.values():
+        raise ValueError(value)
+    return value
+
+
+def validate(payload, group_name=None, create_toppings=False):
+    """Check a parsed payload against the database. Returns an ImportPlan or raises BulkImportError."""
+    errors = []
+    plan = ImportPlan(group_name=(group_name or payload.get('group') or '').strip() or None)
+
+    if plan.group_name and PizzaGroup.objects.filter(name=plan.group_name).count() > 1:
+        errors.append(f"More than one group is named '{plan.group_name}'.")
+
+    # People
+    seen = set()
+    for i, person in enumerate(payload.get('people') or [], start=1):
+        if not isinstance(person, dict):
+            errors.append(f"People entry {i} must be an object.")
+            continue
+        name = str(person.get('name') or '').strip()
+        email = str(person.get('email') or '').strip().lower()
+        if not name:
+            errors.append(f"Person {i}: name is required.")
+        try:
+            validate_email(email)
+        except ValidationError:
+            errors.append(f"Person {i}: '{email}' is not a valid email address.")
+            continue
+        if email in seen:
+            errors.append(f"Person {i}: duplicate email '{email}'.")
+        seen.add(email)
+        plan.people.append((name, email, bool(person.get('admin')), bool(person.get('unrated_is_dislike'))))
+    if plan.people and not plan.group_name:
+        admins = [email for _, email, is_admin, _ in plan.people if is_admin]
+        if admins:
+            errors.append("Admin flags need a group to apply to.")
+
+    emails = [email for _, email, _, _ in plan.people]
+    taken = set(
+        User.objects.filter(username__in=emails).exclude(email__in=emails).values_list('username', flat=True)
+    )
+    errors.extend(f"Username '{email}' already belongs to another account." for email in sorted(taken))
+
+    # Preferences
+    topping_names = set()
+    for topping, values in (payload.get('preferences') or {}).items():
+        topping_names.add(topping)
+        if not isinstance(values, list) or len(values) != len(emails):
+            errors.append(f"Preferences for '{topping}' must list one value per person ({len(emails)}).")
+            continue
+        for email, value in zip(emails, values):
+            try:
+                pref = _preference_value(value)
+            except (TypeError, ValueError):
+                errors.append(f"Preference for '{topping}' / {email}: invalid value {value!r}.")
+                continue
+            if pref is not None:
+                plan.ratings.append((email, topping, pref))
+
+    # Restaurants
+    seen = set()
+    for i, restaurant in enumerate(payload.get('restaurants') or [], start=1):
+        name = str((restaurant or {}).get('name') or '').strip()
+        toppings = [str(t).strip() for t in (restaurant or {}).get('toppings') or [] if str(t).strip()]
+        if not name:
+            errors.append(f"Restaurant {i}: name is required.")
+            continue
+        if name in seen:
+            errors.append(f"Restaurant '{name}' appears more than once.")
+        seen.add(name)
+        topping_names.update(toppings)
+        plan.restaurants.append((name, toppings))
+    if plan.restaurants:
+        existing = PizzaRestaurant.objects.filter(name__in=seen, group__name=plan.group_name) \
+            if plan.group_name else PizzaRestaurant.objects.filter(name__in=seen, group__isnull=True)
+        duplicated = existing.values('name').annotate(n=Count('pk')).filter(n__gt=1).values_list('name', flat=True)
+        errors.extend(f"More than one existing restaurant is named '{name}'." for name in sorted(duplicated))
+
+    known = set(Topping.objects.filter(name__in=topping_names).values_list('name', flat=True))
+    unknown = sorted(topping_names - known)
+    if unknown and create_toppings:
+        plan.new_toppings = unknown
+    elif unknown:
+        errors.append(f"Unknown toppings: {', '.join(unknown)}.")
+
+    if errors:
+        raise BulkImportError(errors)
+    return plan
+
+
+# ---------------------------------------------------------------------------
+# Writing
+# ---------------------------------------------------------------------------
+
+def _copy_preferences(rows):
+    """Upsert (person_id, topping_id, preference) rows through COPY into a temp table (PostgreSQL)."""
+    table = PersonToppingPreference._meta.db_table
+    data = ''.join(f'{p}\t{t}\t{v}\n' for p, t, v in rows)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "CREATE TEMP TABLE import_preferences (person_id integer, topping_id integer, preference integer) "
+            "ON COMMIT DROP"
+        )
+        raw = cursor.cursor
+        copy_sql = "COPY import_preferences (person_id, topping_id, preference) FROM STDIN"
+        if hasattr(raw, 'copy_expert'):   # psycopg2
+            raw.copy_expert(copy_sql, io.StringIO(data))
+        else:                             # psycopg 3
+            with raw.copy(copy_sql) as copy:
+                copy.write(data)
+        cursor.execute(
+            f"INSERT INTO {table} (person_id, topping_id, preference) "
+            "SELECT person_id, topping_id, preference FROM import_preferences "
+            "ON CONFLICT (person_id, topping_id) DO UPDATE SET preference = EXCLUDED.preference"
+        )
+
+
+def _upsert_preferences(rows):
+    if connection.vendor == 'postgresql':
+        _copy_preferences(rows)
+        return
+    PersonToppingPreference.objects.bulk_create(
+        [PersonToppingPreference(person_id=p, topping_id=t, preference=v) for p, t, v in rows],
+        batch_size=BATCH_SIZE,
+        update_conflicts=True,
+        unique_fields=['person', 'topping'],
+        update_fields=['preference'],
+    )
+
+
+@transaction.atomic
+def apply(plan):
+    """Write a validated ImportPlan. Returns a dict of counts."""
+    Topping.objects.bulk_create([Topping(name=name) for name in plan.new_toppings], ignore_conflicts=True)
+    toppings = dict(Topping.objects.values_list('name', 'pk'))
+
+    group = None
+    if plan.group_name:
+        group = PizzaGroup.objects.filter(name=plan.group_name).first()
+        if group is None:
+            group = PizzaGroup.objects.create(name=plan.group_name)
+
+    # People: one login account each (username = email), then a Person linked to it.
+    emails = [email for _, email, _, _ in plan.people]
+    User.objects.bulk_create(
+        [User(username=email, email=email, password=make_password(None)) for email in emails],
+        batch_size=BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+    user_ids = dict(User.objects.filter(email__in=emails).values_list('email', 'pk'))
+    Person.objects.bulk_create(
+        [Person(name=name, email=email, user_account_id=user_ids[email], unrated_is_dislike=unrated_is_dislike)
+         for name, email, _, unrated_is_dislike in plan.people],
+        batch_size=BATCH_SIZE,
+        update_conflicts=True,
+        unique_fields=['user_account'],
+        update_fields=['name', 'email', 'unrated_is_dislike'],
+    )
+    person_ids = dict(
+        Person.objects.filter(user_account__email__in=emails).values_list('user_account__email', 'pk')
+    )
+
+    if group is not None and plan.people:
+        GroupMembership.objects.bulk_create(
+            [GroupMembership(group=group, person_id=person_ids[email], is_admin=is_admin)
+             for _, email, is_admin, _ in plan.people],
+            batch_size=BATCH_SIZE,
+            update_conflicts=True,
+            unique_fields=['group', 'person'],
+            update_fields=['is_admin'],
+        )
+
+    if plan.ratings:
+        _upsert_preferences([(person_ids[email], toppings[name], pref) for email, name, pref in plan.ratings])
+
+    restaurant_ids = []
+    for name, topping_names in plan.restaurants:
+        restaurant = PizzaRestaurant.objects.filter(name=name, group=group).first()
+        if restaurant is None:
+            restaurant = PizzaRestaurant.objects.create(name=name, group=group)
+        wanted = {toppings[t] for t in topping_names}
+        RestaurantTopping.objects.filter(restaurant=restaurant).exclude(topping_id__in=wanted).delete()
+        RestaurantTopping.objects.bulk_create(
+            [RestaurantTopping(restaurant=restaurant, topping_id=tid) for tid in wanted],
+            ignore_conflicts=True,
+        )
+        restaurant_ids.append(restaurant.pk)
+
+    # Bulk writes send no signals: invalidate caches once the data is committed.
+    changed_people = list(person_ids.values())
+    versions = [f'restaurant:{pk}' for pk in restaurant_ids]
+    if group is not None:
+        versions += [f'group-members:{group.pk}', f'group-restaurants:{group.pk}']
+
+    def invalidate():
+        if changed_people:
+            preferences_changed(*changed_people)
+            cache.delete_many([person_context_cache_key(user_id) for user_id in user_ids.values()])
+        if versions or plan.new_toppings:
+            bump_versions(*versions, *(['toppings'] if plan.new_toppings else []))
+
+    transaction.on_commit(invalidate)
+
+    return {
+        'group': group.name if group else None,
+        'people': len(plan.people),
+        'preferences': len(plan.ratings),
+        'restaurants': len(plan.restaurants),
+        'new_toppings': len(plan.new_toppings),
+    }
+
+
+def import_data(text, fmt, group_name=None, create_toppings=False):
+    """Parse, validate and write an import in one call. Raises BulkImportError if anything is invalid."""
+    plan = validate(parse(text, fmt), group_name=group_name, create_toppings=create_toppings)
+    return apply(plan)
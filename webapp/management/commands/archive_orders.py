@@ -0,0 +1,67 @@
+"""
+Management command to move old solved orders into the ArchivedOrder cold store.
+
+Usage:
+    python manage.py archive_orders --days 365
+    python manage.py archive_orders --before 2025-01-01 --batch-size 100 --dry-run
+
+Each batch snapshots its orders into compressed ArchivedOrder rows and deletes
+the hot rows (order, pizzas, assignments, guests and guest preferences) in one
+transaction, so an interrupted run leaves every order either fully live or
+fully archived. Unsolved orders are never archived. Archived orders remain
+viewable on their results page.
+"""
+
+from datetime import datetime, time, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from webapp.archive import archive_orders
+from webapp.models import ArchivedOrder, Order
+
+
+class Command(BaseCommand):
+    help = "Archive solved orders older than a cutoff into compressed ArchivedOrder rows."
+
+    def add_arguments(self, parser):
+        cutoff = parser.add_mutually_exclusive_group()
+        cutoff.add_argument('--days', type=int, default=365, help="Archive orders created more than this many days ago.")
+        cutoff.add_argument('--before', help="Archive orders created before this date (YYYY-MM-DD).")
+        parser.add_argument('--batch-size', type=int, default=200, help="Orders archived per transaction.")
+        parser.add_argument('--dry-run', action='store_true', help="Only report how many orders would be archived.")
+
+    def handle(self, *args, **options):
+        if options['before']:
+            try:
+                day = datetime.strptime(options['before'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError("--before must be a date in YYYY-MM-DD format.")
+            cutoff = timezone.make_aware(datetime.combine(day, time.min))
+        else:
+            cutoff = timezone.now() - timedelta(days=options['days'])
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be positive.")
+
+        candidates = (
+            Order.objects.filter(created_at__lt=cutoff, pizzas__isnull=False)
+            .distinct().order_by('pk').values_list('pk', flat=True)
+        )
+        if options['dry_run']:
+            self.stdout.write(f"{candidates.count()} solved orders created before {cutoff:%Y-%m-%d} would be archived.")
+            return
+
+        total = 0
+        last_pk = 0
+        while True:
+            batch = list(candidates.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not batch:
+                break
+            last_pk = batch[-1]
+            total += archive_orders(batch)
+            self.stdout.write(f"  Archived {total} orders...")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {total} orders created before {cutoff:%Y-%m-%d} "
+            f"({ArchivedOrder.objects.count()} archived in total)."
+        ))
@@ -0,0 +1,166 @@
+"""
+Management command to benchmark every URL in the app, in-process.
+
+Usage:
+    python manage.py bench_views [--members 200 --toppings 40 --orders 50]
+                                 [--repeat 20] [--cold] [--output bench.json]
+                                 [--baseline old.json --threshold 20]
+
+Like preview_templates, this runs against a throwaway test database (in
+memory for SQLite), so it never touches real data. It seeds a group of the
+given size (webapp.benchmarks.seed), then requests every URL in webapp.urls
+--repeat times through Django's test client as the group's staff host, rolling
+back each request's writes. For each URL it reports p50/p95 latency, queries
+per request and response size as JSON.
+
+The cache is a private in-memory one. --cold clears it before every request,
+which is how the query budget tests measure; the default keeps it warm as in
+production.
+
+With --baseline, results are compared to an earlier run's JSON: a URL whose
+p95 grew by more than --threshold percent, or that runs more queries than
+before, is a regression and the command exits with an error.
+"""
+
+import json
+import os
+import random
+import tempfile
+from statistics import median
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, override_settings
+from django.test.runner import DiscoverRunner
+
+from webapp import benchmarks
+from webapp.management.commands.loadtest import percentile
+from webapp.urls import urlpatterns
+
+
+def compare(results, baseline, threshold):
+    """Regressions of results against baseline, as human-readable lines."""
+    regressions = []
+    for name, now in results['urls'].items():
+        before = baseline.get('urls', {}).get(name)
+        if before is None:
+            continue
+        if before['p95_ms'] and now['p95_ms'] > before['p95_ms'] * (1 + threshold / 100):
+            regressions.append(f"{name}: p95 {before['p95_ms']:.1f}ms -> {now['p95_ms']:.1f}ms")
+        if now['queries'] > before['queries']:
+            regressions.append(f"{name}: queries {before['queries']} -> {now['queries']}")
+    return regressions
+
+
+class Command(BaseCommand):
+    help = "Seed a throwaway database and report latency, queries and response size for every URL."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=200, help="Members in the seeded group.")
+        parser.add_argument('--toppings', type=int, default=40, help="Toppings, all rated by every member.")
+        parser.add_argument('--orders', type=int, default=50, help="Solved orders in the group's history.")
+        parser.add_argument('--repeat', type=int, default=20, help="Timed requests per URL.")
+        parser.add_argument('--warmup', type=int, default=2, help="Untimed requests per URL first.")
+        parser.add_argument('--cold', action='store_true', help="Clear the cache before every request.")
+        parser.add_argument('--only', nargs='+', metavar='NAME', help="Benchmark only these URL names.")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed for the generated preferences.")
+        parser.add_argument('--output', help="Write the JSON results to this file instead of stdout.")
+        parser.add_argument('--baseline', help="JSON from an earlier run to compare against.")
+        parser.add_argument(
+            '--threshold', type=float, default=20.0, help="Allowed p95 growth over the baseline, in percent.",
+        )
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1 or options['members'] < 1 or options['toppings'] < 2 or options['orders'] < 1:
+            raise CommandError("--repeat, --members and --orders must be positive and --toppings at least 2.")
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+
+        if settings.DATABASES['default']['ENGINE'].endswith('sqlite3'):
+            settings.DATABASES['default'].setdefault('TEST', {})['NAME'] = ':memory:'
+        # Keep the benchmark's cache entries, metrics and solver locks away from a running server's.
+        scratch = tempfile.mkdtemp(prefix='bench_views-')
+        isolated = override_settings(
+            CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+            METRICS_DIR=os.path.join(scratch, 'metrics'),
+            SOLVER_LOCK_DIR=os.path.join(scratch, 'locks'),
+            PROFILE_SAMPLE_RATE=0.0,
+        )
+        runner = DiscoverRunner(verbosity=0)
+        old_config = runner.setup_databases()
+        try:
+            with isolated:
+                self.stderr.write(
+                    f"Seeding {options['members']} members, {options['toppings']} toppings, "
+                    f"{options['orders']} orders..."
+                )
+                fx = benchmarks.seed(
+                    options['members'], options['toppings'], options['orders'], random.Random(options['seed']),
+                )
+                results = self._run(fx, options)
+        finally:
+            runner.teardown_databases(old_config)
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+            self.stderr.write(f"Wrote {options['output']}")
+        else:
+            self.stdout.write(output)
+
+        if baseline is not None:
+            regressions = compare(results, baseline, options['threshold'])
+            if regressions:
+                raise CommandError("Regressions against baseline:\n  " + "\n  ".join(regressions))
+            self.stderr.write(self.style.SUCCESS("No regressions against baseline."))
+
+    def _run(self, fx, options):
+        requests = benchmarks.url_requests(fx)
+        missing = {p.name for p in urlpatterns} - set(requests)
+        if missing:
+            self.stderr.write(self.style.WARNING(f"No benchmark request for: {', '.join(sorted(missing))}"))
+        if options['only']:
+            unknown = set(options['only']) - set(requests)
+            if unknown:
+                raise CommandError(f"Unknown URL names: {', '.join(sorted(unknown))}")
+            requests = {name: requests[name] for name in options['only']}
+
+        client = Client()
+        benchmarks.login(client, fx)
+        urls = {}
+        for name, (method, url, data) in requests.items():
+            latencies, queries, sizes, statuses = [], [], [], set()
+            for i in range(options['warmup'] + options['repeat']):
+                if options['cold']:
+                    cache.clear()
+                response, seconds, log, size = benchmarks.timed_request(client, method, url, data)
+                if i < options['warmup']:
+                    continue
+                latencies.append(seconds * 1000)
+                queries.append(log.count)
+                sizes.append(size)
+                statuses.add(response.status_code)
+            urls[name] = {
+                'method': method.upper(),
+                'status': sorted(statuses),
+                'p50_ms': round(percentile(latencies, 50), 2),
+                'p95_ms': round(percentile(latencies, 95), 2),
+                'queries': max(queries),
+                'queries_median': median(queries),
+                'bytes': max(sizes),
+            }
+            self.stderr.write(
+                f"  {name:<30} p50 {urls[name]['p50_ms']:>8.2f}ms  p95 {urls[name]['p95_ms']:>8.2f}ms"
+                f"  {urls[name]['queries']:>4} queries  {urls[name]['bytes']:>8} bytes"
+            )
+        return {
+            'scale': {key: options[key] for key in ('members', 'toppings', 'orders')},
+            'repeat': options['repeat'],
+            'cold_cache': options['cold'],
+            'database': settings.DATABASES['default']['ENGINE'].rsplit('.', 1)[-1],
+            'urls': urls,
+        }
@@ -0,0 +1,33 @@
+"""
+Management command to export order history.
+
+Usage:
+    python manage.py export_orders [--group GROUP_ID] [--format csv|jsonl] [--output FILE]
+
+Streams every order with its pizzas, toppings and assigned people (see
+webapp/exports.py), writing to stdout unless --output is given.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from webapp import exports
+from webapp.management.commands.export_preferences import write_lines
+from webapp.models import PizzaGroup
+
+
+class Command(BaseCommand):
+    help = "Export all orders with their pizzas, toppings and assignments as CSV or JSONL."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--group', type=int, help="Only export this group's orders.")
+        parser.add_argument('--format', choices=exports.FORMATS, default='csv')
+        parser.add_argument('--output', help="File to write (default: stdout).")
+
+    def handle(self, *args, **options):
+        group = None
+        if options['group'] is not None:
+            try:
+                group = PizzaGroup.objects.get(pk=options['group'])
+            except PizzaGroup.DoesNotExist:
+                raise CommandError(f"No group with id {options['group']}.")
+        write_lines(self.stdout, exports.order_history(options['format'], group), options['output'])
@@ -0,0 +1,40 @@
+"""
+Management command to export a group's preference matrix.
+
+Usage:
+    python manage.py export_preferences <group_id> [--format csv|jsonl] [--output FILE]
+
+Streams one record per persistent member (see webapp/exports.py), writing to
+stdout unless --output is given.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from webapp import exports
+from webapp.models import PizzaGroup
+
+
+class Command(BaseCommand):
+    help = "Export a group's topping preference matrix as CSV or JSONL."
+
+    def add_arguments(self, parser):
+        parser.add_argument('group_id', type=int)
+        parser.add_argument('--format', choices=exports.FORMATS, default='csv')
+        parser.add_argument('--output', help="File to write (default: stdout).")
+
+    def handle(self, *args, **options):
+        try:
+            group = PizzaGroup.objects.get(pk=options['group_id'])
+        except PizzaGroup.DoesNotExist:
+            raise CommandError(f"No group with id {options['group_id']}.")
+        write_lines(self.stdout, exports.group_preferences(group, options['format']), options['output'])
+
+
+def write_lines(stdout, lines, output):
+    """Write export lines to the output file, or to the command's stdout."""
+    if output:
+        with open(output, 'w', newline='', encoding='utf-8') as f:
+            f.writelines(lines)
+    else:
+        for line in lines:
+            stdout.write(line, ending='')
@@ -0,0 +1,48 @@
+"""
+Management command to bulk import people, memberships, preferences and menus.
+
+Usage:
+    python manage.py import_data people.json
+    python manage.py import_data people.csv --group "Survey Group"
+    python manage.py import_data menus.csv --group "Survey Group" --create-toppings
+
+See webapp/imports.py for the accepted JSON and CSV layouts. The whole file is
+validated first; if anything is wrong, every problem is reported and nothing
+is written.
+"""
+
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from webapp.imports import FORMATS, BulkImportError, import_data
+
+
+class Command(BaseCommand):
+    help = "Bulk import people, group memberships, preference matrices and restaurant menus from JSON or CSV."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="JSON or CSV file to import.")
+        parser.add_argument('--format', choices=FORMATS, help="Input format (default: from the file extension).")
+        parser.add_argument('--group', help="Group to add people and restaurants to (overrides the file's 'group').")
+        parser.add_argument('--create-toppings', action='store_true', help="Create toppings that don't exist yet.")
+
+    def handle(self, *args, **options):
+        fmt = options['format'] or os.path.splitext(options['path'])[1].lstrip('.').lower()
+        if fmt not in FORMATS:
+            raise CommandError("Cannot tell the format from the file name; pass --format json or --format csv.")
+        with open(options['path'], encoding='utf-8') as f:
+            text = f.read()
+        try:
+            result = import_data(text, fmt, group_name=options['group'], create_toppings=options['create_toppings'])
+        except BulkImportError as e:
+            for error in e.errors:
+                self.stderr.write(f"  {error}")
+            raise CommandError(f"Import failed with {len(e.errors)} error(s); nothing was written.")
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {result['people']} people, {result['preferences']} preferences and "
+            f"{result['restaurants']} restaurant menus"
+            + (f" into '{result['group']}'" if result['group'] else "")
+            + (f" ({result['new_toppings']} new toppings)" if result['new_toppings'] else "")
+            + "."
+        ))
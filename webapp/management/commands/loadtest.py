@@ -0,0 +1,318 @@
+"""
+Management command to generate load against a running pizza_solver server.
+
+Usage:
+    python manage.py loadtest join http://localhost:8000/orders/join/<token>/ --guests 200 --concurrency 50
+    python manage.py loadtest order http://localhost:8000/ --email host@example.com --password ... \
+        --group 1 --orders 5 --guests 30 --concurrency 50
+
+The ``join`` scenario simulates an invite-link burst: each simulated guest uses
+its own cookie jar, GETs the join page, then POSTs a name and a set of topping
+preferences.
+
+The ``order`` scenario replays whole order lifecycles, --orders of them at
+once. For each, the host (an existing account that belongs to --group) signs
+in, opens the new-order page and creates a draft with an invite link; --guests
+guests join through the link while the host's draft page polls the people
+list every --poll-interval seconds, as its HTMX does; the host then generates
+the order for everyone who joined and views the results. Guests of all orders
+share --concurrency threads. Each run leaves its solved orders and guests in
+the database, so point it at a disposable instance (see seed_test_data).
+
+Latency is measured per HTTP request and summarised per step as requests/s,
+error rate and p50/p95/p99. Redirects are followed, so a step's latency
+includes the page it redirects to (generate includes rendering the results).
+
+Compare ``SERVER_MODE=wsgi`` against ``SERVER_MODE=asgi`` (see entrypoint.sh)
+by pointing this command at each server in turn with the same arguments.
+
+This command only talks HTTP; it never touches the local database.
+"""
+
+import http.cookiejar
+import json
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+_CSRF_RE = re.compile(r'name="csrfmiddlewaretoken" value="([^"]+)"')
+_TOPPING_RE = re.compile(r'name="pref_(\d+)"')
+_INVITE_RE = re.compile(r'/orders/join/[0-9a-f-]{36}/')
+_ORDER_RE = re.compile(r'/draft/(\d+)/')
+_CHECKED_RE = re.compile(r'name="people" value="(\d+)" checked')
+_RESTAURANT_RE = re.compile(r'<select name="restaurant".*?</select>', re.S)
+_OPTION_RE = re.compile(r'<option value="(\d+)"')
+
+ORDER_STEPS = ['login', 'new_order', 'create_draft', 'join_get', 'join_post', 'poll_people', 'generate', 'results']
+
+PREFERENCE_VALUES = ['-2', '-1', '0', '1']
+PREFERENCE_WEIGHTS = [1, 3, 4, 4]
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of numbers (0 for an empty list)."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+def summarize(latencies, errors, elapsed):
+    """Return a JSON-serialisable summary for one step of a scenario."""
+    total = len(latencies) + errors
+    return {
+        'requests': total,
+        'errors': errors,
+        'error_rate': round(errors / total, 4) if total else 0.0,
+        'requests_per_second': round(total / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+    }
+
+
+class Steps:
+    """Thread-safe latencies and error counts per step."""
+
+    def __init__(self, names):
+        self.lock = threading.Lock()
+        self.timings = {name: [] for name in names}
+        self.errors = {name: 0 for name in names}
+
+    def add(self, step, status, seconds):
+        """Record one request; returns True if it succeeded (any status below 400)."""
+        ok = 0 < status < 400
+        with self.lock:
+            if ok:
+                self.timings[step].append(seconds)
+            else:
+                self.errors[step] += 1
+        return ok
+
+    def summary(self, elapsed):
+        steps = {step: summarize(self.timings[step], self.errors[step], elapsed) for step in self.timings}
+        all_latencies = [t for timings in self.timings.values() for t in timings]
+        return steps, summarize(all_latencies, sum(self.errors.values()), elapsed)
+
+
+class Session:
+    """A single simulated browser: own cookie jar, CSRF handling and timing."""
+
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.jar = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.jar))
+        self.url = base_url
+
+    def request(self, url, data=None):
+        """Fetch url (POSTing data if given). Returns (status, body, seconds); self.url is where it ended up."""
+        url = urllib.parse.urljoin(self.base_url, url)
+        body = urllib.parse.urlencode(data, doseq=True).encode() if data is not None else None
+        req = urllib.request.Request(url, data=body, headers={'Referer': url})
+        start = time.perf_counter()
+        try:
+            with self.opener.open(req, timeout=self.timeout) as resp:
+                content = resp.read().decode('utf-8', 'replace')
+                status = resp.status
+                self.url = resp.geturl()
+        except urllib.error.HTTPError as e:
+            content = e.read().decode('utf-8', 'replace')
+            status = e.code
+        except (urllib.error.URLError, OSError):
+            # Connection refused/reset or timeout: count as a failed request.
+            content = ''
+            status = 0
+        return status, content, time.perf_counter() - start
+
+    @staticmethod
+    def csrf_token(html):
+        match = _CSRF_RE.search(html)
+        return match.group(1) if match else ''
+
+
+class Command(BaseCommand):
+    help = "Drive concurrent HTTP traffic against a running server and report latency percentiles."
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=['join', 'order'], help="Traffic pattern to replay.")
+        parser.add_argument(
+            'url',
+            help="Invite URL (join), e.g. http://localhost:8000/orders/join/<token>/, or the site root (order).",
+        )
+        parser.add_argument('--guests', type=int, default=100, help="Number of simulated guests (per order).")
+        parser.add_argument('--concurrency', type=int, default=20, help="Simultaneous in-flight guests.")
+        parser.add_argument('--timeout', type=float, default=30.0, help="Per-request timeout in seconds.")
+        parser.add_argument('--json', action='store_true', help="Print the summary as JSON.")
+        order = parser.add_argument_group("order scenario")
+        order.add_argument('--email', help="Host account email.")
+        order.add_argument('--password', help="Host account password.")
+        order.add_argument('--group', type=int, help="Group the host belongs to and orders for.")
+        order.add_argument('--restaurant', type=int, help="Restaurant id (default: the group's first).")
+        order.add_argument('--orders', type=int, default=1, help="Order lifecycles to run at once.")
+        order.add_argument('--pizzas', type=int, help="Pizzas per order (default: one per three people).")
+        order.add_argument(
+            '--poll-interval', type=float, default=2.0, help="Seconds between the host's people-list polls.",
+        )
+
+    def handle(self, *args, **options):
+        if options['guests'] < 1 or options['concurrency'] < 1:
+            raise CommandError("--guests and --concurrency must be positive.")
+        if options['scenario'] == 'order':
+            if not (options['email'] and options['password'] and options['group']):
+                raise CommandError("The order scenario needs --email, --password and --group.")
+            if options['orders'] < 1 or options['poll_interval'] <= 0:
+                raise CommandError("--orders and --poll-interval must be positive.")
+            summary = self._run_order(options)
+        else:
+            summary = self._run_join(options)
+        self._report(summary, options['json'])
+
+    # ------------------------------------------------------------------
+    # Scenarios
+    # ------------------------------------------------------------------
+
+    def _join_one(self, url, index, timeout, steps):
+        """One guest: GET the join page, then POST name + preferences."""
+        session = Session(url, timeout)
+        status, html, seconds = session.request(url)
+        if not steps.add('join_get', status if status == 200 else 0, seconds):
+            return
+
+        data = {'csrfmiddlewaretoken': session.csrf_token(html), 'name': f'Load Guest {index}'}
+        for topping_pk in _TOPPING_RE.findall(html):
+            data[f'pref_{topping_pk}'] = random.choices(PREFERENCE_VALUES, PREFERENCE_WEIGHTS)[0]
+        status, _html, seconds = session.request(url, data)
+        steps.add('join_post', status, seconds)
+
+    def _run_join(self, options):
+        url = options['url']
+        steps = Steps(['join_get', 'join_post'])
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            futures = [
+                pool.submit(self._join_one, url, i, options['timeout'], steps)
+                for i in range(options['guests'])
+            ]
+            for future in futures:
+                future.result()
+        elapsed = time.perf_counter() - start
+
+        by_step, overall = steps.summary(elapsed)
+        return {
+            'scenario': 'join',
+            'guests': options['guests'],
+            'concurrency': options['concurrency'],
+            'elapsed_s': round(elapsed, 3),
+            'steps': by_step,
+            'overall': overall,
+        }
+
+    def _order_one(self, index, options, steps, guest_pool):
+        """One order lifecycle, from sign-in to viewing the results."""
+        host = Session(options['url'], options['timeout'])
+
+        status, html, _ = host.request('/accounts/login/')
+        status, html, seconds = host.request('/accounts/login/', {
+            'csrfmiddlewaretoken': host.csrf_token(html), 'login': options['email'], 'password': options['password'],
+        })
+        if not steps.add('login', 0 if '/accounts/login/' in host.url else status, seconds):
+            return
+
+        status, html, seconds = host.request(f"/orders/group/{options['group']}/new/")
+        if not steps.add('new_order', status, seconds):
+            return
+        restaurant = options['restaurant']
+        if restaurant is None:
+            select = _RESTAURANT_RE.search(html)
+            options_found = _OPTION_RE.findall(select.group(0)) if select else []
+            restaurant = options_found[0] if options_found else ''
+
+        status, html, seconds = host.request(f"/orders/group/{options['group']}/new/", {
+            'csrfmiddlewaretoken': host.csrf_token(html), 'invite_guests': '1', 'restaurant': restaurant,
+        })
+        invite, order_id = _INVITE_RE.search(html), _ORDER_RE.search(host.url)
+        if not steps.add('create_draft', status if invite and order_id else 0, seconds):
+            return
+        draft_url, invite_url = host.url, urllib.parse.urljoin(host.url, invite.group(0))
+        partial_url = f'/orders/{order_id.group(1)}/people-partial/'
+        draft_csrf = host.csrf_token(html)
+
+        guests = [
+            guest_pool.submit(self._join_one, invite_url, f'{index}-{i}', options['timeout'], steps)
+            for i in range(options['guests'])
+        ]
+        partial = ''
+        while True:
+            joining = not all(g.done() for g in guests)
+            status, body, seconds = host.request(partial_url)
+            if steps.add('poll_people', status, seconds):
+                partial = body
+            if not joining:
+                break
+            time.sleep(options['poll_interval'])
+        for g in guests:
+            g.result()
+
+        people = _CHECKED_RE.findall(partial)
+        pizzas = options['pizzas'] or max(1, (len(people) + 1) // 3)
+        status, html, seconds = host.request(draft_url, {
+            'csrfmiddlewaretoken': draft_csrf, 'people': people, 'num_pizzas': min(pizzas, len(people) + 1),
+            'optimization_mode': 'minimize_dislikes', 'shareability_bonus_weight': '0',
+        })
+        if not steps.add('generate', status if '/results/' in host.url else 0, seconds):
+            return
+        status, html, seconds = host.request(host.url)
+        steps.add('results', status, seconds)
+
+    def _run_order(self, options):
+        steps = Steps(ORDER_STEPS)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as guest_pool, \
+                ThreadPoolExecutor(max_workers=options['orders']) as host_pool:
+            futures = [
+                host_pool.submit(self._order_one, i, options, steps, guest_pool) for i in range(options['orders'])
+            ]
+            for future in futures:
+                future.result()
+        elapsed = time.perf_counter() - start
+
+        by_step, overall = steps.summary(elapsed)
+        return {
+            'scenario': 'order',
+            'orders': options['orders'],
+            'guests': options['guests'],
+            'concurrency': options['concurrency'],
+            'elapsed_s': round(elapsed, 3),
+            'steps': by_step,
+            'overall': overall,
+        }
+
+    # ------------------------------------------------------------------
+    # Reporting
+    # ------------------------------------------------------------------
+
+    def _report(self, summary, as_json):
+        if as_json:
+            self.stdout.write(json.dumps(summary, indent=2))
+            return
+        orders = f"{summary['orders']} orders, " if 'orders' in summary else ''
+        self.stdout.write(
+            f"{summary['scenario']}: {orders}{summary['guests']} guests, concurrency {summary['concurrency']}, "
+            f"{summary['elapsed_s']}s"
+        )
+        rows = list(summary['steps'].items()) + [('overall', summary['overall'])]
+        self.stdout.write(f"  {'step':<12} {'reqs':>6} {'err':>5} {'req/s':>8} {'p50ms':>8} {'p95ms':>8} {'p99ms':>8}")
+        for step, s in rows:
+            self.stdout.write(
+                f"  {step:<12} {s['requests']:>6} {s['errors']:>5} {s['requests_per_second']:>8} "
+                f"{s['p50_ms']:>8} {s['p95_ms']:>8} {s['p99_ms']:>8}"
+            )
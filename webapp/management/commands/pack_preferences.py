@@ -0,0 +1,101 @@
+"""
+Management command to build packed preference vectors from PersonToppingPreference rows.
+
+Usage:
+    python manage.py pack_preferences
+    python manage.py pack_preferences --benchmark [--group-size 50] [--repeat 20]
+
+Without options, (re)packs a PersonPreferenceVector for every non-guest person
+that has ratings. Run it after turning on PACKED_PREFERENCES; afterwards the
+vectors are kept in sync by webapp.preferences.preferences_changed().
+
+--benchmark also compares the two layouts on the current database: on-disk
+size of each table (SQLite dbstat / PostgreSQL pg_total_relation_size) and
+the latency of loading a group's preferences from rows vs. from vectors,
+bypassing the cache.
+"""
+
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from webapp.models import Person, PersonPreferenceVector, PersonToppingPreference
+from webapp.preferences import read_rows, read_vectors, write_vectors
+
+BATCH_SIZE = 500
+
+
+def table_bytes(model):
+    """On-disk size of a model's table including indexes, or None if the backend can't say."""
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT pg_total_relation_size(%s)", [table])
+            return cursor.fetchone()[0]
+        if connection.vendor == 'sqlite':
+            try:
+                cursor.execute(
+                    "SELECT SUM(pgsize) FROM dbstat WHERE name = %s OR name IN "
+                    "(SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s)",
+                    [table, table],
+                )
+            except Exception:
+                return None
+            return cursor.fetchone()[0] or 0
+    return None
+
+
+class Command(BaseCommand):
+    help = "Pack every person's topping preferences into a PersonPreferenceVector."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--benchmark', action='store_true',
+                            help="Compare storage size and read latency of rows vs. vectors.")
+        parser.add_argument('--group-size', type=int, default=50,
+                            help="People loaded per read in the benchmark.")
+        parser.add_argument('--repeat', type=int, default=20,
+                            help="Timed reads per layout in the benchmark.")
+
+    def handle(self, *args, **options):
+        person_ids = list(
+            PersonToppingPreference.objects.filter(person__guest_for_order__isnull=True)
+            .values_list('person_id', flat=True).distinct().order_by('person_id')
+        )
+        for start in range(0, len(person_ids), BATCH_SIZE):
+            write_vectors(read_rows(person_ids[start:start + BATCH_SIZE]))
+        self.stdout.write(self.style.SUCCESS(f"Packed preference vectors for {len(person_ids)} people."))
+
+        if options['benchmark']:
+            self._benchmark(person_ids, options['group_size'], options['repeat'])
+
+    def _benchmark(self, person_ids, group_size, repeat):
+        if not person_ids:
+            self.stdout.write("No rated people to benchmark.")
+            return
+        people = Person.objects.count()
+        rows = PersonToppingPreference.objects.count()
+        vectors = PersonPreferenceVector.objects.count()
+        self.stdout.write(f"\n{people} people, {rows} preference rows, {vectors} vectors")
+
+        for label, model in [('rows', PersonToppingPreference), ('vectors', PersonPreferenceVector)]:
+            size = table_bytes(model)
+            if size is None:
+                self.stdout.write(f"  {label:<8} size: unavailable on {connection.vendor}")
+            else:
+                self.stdout.write(f"  {label:<8} size: {size / 1024:,.0f} KiB")
+
+        group_size = min(group_size, len(person_ids))
+        samples = [random.sample(person_ids, group_size) for _ in range(repeat)]
+        for label, reader in [('rows', read_rows), ('vectors', read_vectors)]:
+            timings = []
+            for ids in samples:
+                start = time.perf_counter()
+                reader(ids)
+                timings.append(time.perf_counter() - start)
+            self.stdout.write(
+                f"  {label:<8} read {group_size} people: "
+                f"median {statistics.median(timings) * 1000:.2f} ms, max {max(timings) * 1000:.2f} ms"
+            )
@@ -0,0 +1,274 @@
+"""
+Management command to seed the database with production-sized synthetic data.
+
+Usage:
+    python manage.py seed_scale [--users 5000] [--groups 100] [--restaurants 2]
+                                [--orders 40] [--days 365] [--seed 0] [--wipe] [--copy]
+
+Creates --users accounts (password 'testpass', hashed once and shared), spread
+over --groups groups whose sizes follow a heavy-tailed distribution, with 15% of
+people also in a second group. The first member of each group is its admin.
+Each group owns --restaurants restaurants offering most of the toppings.
+Everyone rates a varying share of the toppings, drawn per topping from the
+answers in seed_test_data's preference survey. Each group also gets about
+--orders solved orders spread over the last --days days, with pizzas and
+assignments.
+
+Rows that need their ids back are written with batched bulk_create; the
+large link tables (memberships, preferences, restaurant menus, order people
+and pizza toppings/people) with batched executemany INSERTs, or with COPY on
+PostgreSQL when --copy is given. --wipe first removes the same
+data as seed_test_data.
+
+Toppings are created via get_or_create from seed_toppings' list, so this works
+whether or not seed_toppings has been run first.
+"""
+
+import itertools
+import math
+import random
+import time
+import uuid
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from webapp.management.commands.seed_test_data import (
+    Command as SeedTestData, PREFERENCES as SURVEY, TEST_PASSWORD,
+)
+from webapp.management.commands.seed_toppings import TOPPINGS
+from webapp.models import (
+    GroupMembership, Order, OrderedPizza, Person, PersonToppingPreference,
+    PizzaGroup, PizzaRestaurant, RestaurantTopping, Topping, User,
+)
+from webapp.preferences import read_rows, write_vectors
+
+BATCH_SIZE = 2000
+SECOND_GROUP_SHARE = 0.15
+UNRATED_IS_DISLIKE_SHARE = 0.2
+
+
+def survey_distributions():
+    """topping name -> Counter of survey answers, plus None -> all answers pooled."""
+    distributions = {name: Counter(values) for name, values in SURVEY.items()}
+    distributions[None] = sum(distributions.values(), Counter())
+    return distributions
+
+
+def sample_group_sizes(rng, users, groups):
+    """Heavy-tailed group sizes (a few big groups, many small ones) summing to users."""
+    weights = [rng.paretovariate(1.2) for _ in range(groups)]
+    total = sum(weights)
+    sizes = [max(1, int(users * w / total)) for w in weights]
+    for i in range(users - sum(sizes)):
+        sizes[i % groups] += 1
+    while sum(sizes) > users:
+        sizes[sizes.index(max(sizes))] -= 1
+    return sizes
+
+
+class Command(BaseCommand):
+    help = "Seed thousands of users, groups, restaurants, preferences and historical orders in bulk."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=5000, help="Accounts to create.")
+        parser.add_argument('--groups', type=int, default=100, help="Groups to spread them over.")
+        parser.add_argument('--restaurants', type=int, default=2, help="Restaurants per group.")
+        parser.add_argument('--orders', type=int, default=40, help="Average solved orders per group.")
+        parser.add_argument('--days', type=int, default=365, help="Order history spans this many days.")
+        parser.add_argument('--seed', type=int, default=0, help="Random seed.")
+        parser.add_argument('--wipe', action='store_true', help="Remove existing non-superuser data first.")
+        parser.add_argument('--copy', action='store_true', help="Load link tables with COPY (PostgreSQL only).")
+
+    def handle(self, *args, **options):
+        if options['users'] < 1 or options['groups'] < 1 or options['restaurants'] < 1:
+            raise CommandError("--users, --groups and --restaurants must be positive.")
+        if options['groups'] > options['users']:
+            raise CommandError("--groups cannot exceed --users.")
+        if options['copy'] and connection.vendor != 'postgresql':
+            raise CommandError("--copy needs PostgreSQL.")
+        self.rng = random.Random(options['seed'])
+        self.use_copy = options['copy']
+        self.tag = uuid.uuid4().hex[:6]
+
+        start = time.perf_counter()
+        if options['wipe']:
+            SeedTestData(stdout=self.stdout, stderr=self.stderr)._wipe()
+        with transaction.atomic():
+            toppings = self._ensure_toppings()
+            people = self._create_people(options['users'], toppings)
+            groups = self._create_groups(people, options['groups'])
+            restaurants = self._create_restaurants(groups, toppings, options['restaurants'])
+            self._create_orders(groups, restaurants, options['orders'], options['days'])
+        if settings.PACKED_PREFERENCES:
+            ids = [p.pk for p in people]
+            for i in range(0, len(ids), BATCH_SIZE):
+                write_vectors(read_rows(ids[i:i + BATCH_SIZE]))
+            self.stdout.write("  Packed preference vectors.")
+        # bulk_create and COPY send no signals, so drop cached rows wholesale.
+        cache.clear()
+        self.stdout.write(self.style.SUCCESS(f"Scale seeding complete in {time.perf_counter() - start:.1f}s."))
+
+    # ------------------------------------------------------------------
+    # Writing
+    # ------------------------------------------------------------------
+
+    def _insert(self, model, fields, rows):
+        """Insert rows (tuples of values for the field attnames) with COPY if enabled, else batched INSERTs.
+
+        Link rows skip the ORM: building and compiling a model instance per row
+        costs several times more than the insert itself.
+        """
+        qn = connection.ops.quote_name
+        table = qn(model._meta.db_table)
+        columns = ', '.join(qn(model._meta.get_field(f).column) for f in fields)
+        with connection.cursor() as cursor:
+            if self.use_copy:
+                # cursor.cursor is the underlying psycopg 3 cursor.
+                with cursor.cursor.copy(f"COPY {table} ({columns}) FROM STDIN") as copy:
+                    for row in rows:
+                        copy.write_row(row)
+                return
+            sql = f"INSERT INTO {table} ({columns}) VALUES ({', '.join(['%s'] * len(fields))})"
+            rows = iter(rows)
+            while batch := list(itertools.islice(rows, BATCH_SIZE)):
+                cursor.executemany(sql, batch)
+
+    # ------------------------------------------------------------------
+    # Data
+    # ------------------------------------------------------------------
+
+    def _ensure_toppings(self):
+        Topping.objects.bulk_create([Topping(name=name) for name in TOPPINGS], ignore_conflicts=True)
+        toppings = list(Topping.objects.order_by('pk'))
+        self.stdout.write(f"  Ensured {len(TOPPINGS)} toppings exist ({len(toppings)} in total).")
+        return toppings
+
+    def _create_people(self, count, toppings):
+        password = make_password(TEST_PASSWORD)
+        users = User.objects.bulk_create([
+            User(username=f"scale{i:06}.{self.tag}@example.com", email=f"scale{i:06}.{self.tag}@example.com",
+                 password=password)
+            for i in range(count)
+        ], batch_size=BATCH_SIZE)
+        people = Person.objects.bulk_create([
+            Person(name=f"Scale {i:06}", email=user.email, user_account=user,
+                   unrated_is_dislike=self.rng.random() < UNRATED_IS_DISLIKE_SHARE)
+            for i, user in enumerate(users)
+        ], batch_size=BATCH_SIZE)
+
+        distributions = survey_distributions()
+        choices = {}
+        for topping in toppings:
+            answers = distributions.get(topping.name) or distributions[None]
+            choices[topping.pk] = (list(answers), list(answers.values()))
+
+        def rows():
+            for person in people:
+                # Most people rate most toppings; some only a handful.
+                share = self.rng.betavariate(5, 2)
+                for topping in self.rng.sample(toppings, max(1, round(share * len(toppings)))):
+                    values, weights = choices[topping.pk]
+                    yield person.pk, topping.pk, self.rng.choices(values, weights)[0]
+
+        self._insert(PersonToppingPreference, ['person_id', 'topping_id', 'preference'], rows())
+        self.stdout.write(f"  Created {count} users (password: '{TEST_PASSWORD}') with preferences.")
+        return people
+
+    def _create_groups(self, people, count):
+        sizes = sample_group_sizes(self.rng, len(people), count)
+        groups = PizzaGroup.objects.bulk_create(
+            [PizzaGroup(name=f"Scale Group {i:04} ({self.tag})") for i in range(count)], batch_size=BATCH_SIZE,
+        )
+        members = {group.pk: [] for group in groups}
+        shuffled = self.rng.sample(people, len(people))
+        offset = 0
+        for group, size in zip(groups, sizes):
+            members[group.pk] = shuffled[offset:offset + size]
+            offset += size
+        if count > 1:
+            for person in self.rng.sample(people, int(len(people) * SECOND_GROUP_SHARE)):
+                group = self.rng.choice(groups)
+                if person not in members[group.pk]:
+                    members[group.pk].append(person)
+
+        self._insert(GroupMembership, ['group_id', 'person_id', 'is_admin'], (
+            (group_pk, person.pk, i == 0) for group_pk, group_members in members.items()
+            for i, person in enumerate(group_members)
+        ))
+        for group in groups:
+            group.scale_members = members[group.pk]
+        self.stdout.write(f"  Created {count} groups (largest {max(sizes)}, smallest {min(sizes)} members).")
+        return groups
+
+    def _create_restaurants(self, groups, toppings, per_group):
+        restaurants = PizzaRestaurant.objects.bulk_create([
+            PizzaRestaurant(name=f"Scale Pizza {i + 1}", group=group)
+            for group in groups for i in range(per_group)
+        ], batch_size=BATCH_SIZE)
+        menus = {
+            r.pk: self.rng.sample(toppings, max(1, round(self.rng.uniform(0.6, 1.0) * len(toppings))))
+            for r in restaurants
+        }
+        self._insert(RestaurantTopping, ['restaurant_id', 'topping_id'], (
+            (pk, topping.pk) for pk, menu in menus.items() for topping in menu
+        ))
+        for r in restaurants:
+            r.scale_menu = menus[r.pk]
+        self.stdout.write(f"  Created {len(restaurants)} restaurants.")
+        return restaurants
+
+    def _create_orders(self, groups, restaurants, per_group, days):
+        by_group = {}
+        for r in restaurants:
+            by_group.setdefault(r.group_id, []).append(r)
+        now = timezone.now()
+        orders, plans = [], []
+        for group in groups:
+            members = group.scale_members
+            # Groups order at different rates; bigger groups a little more often.
+            count = round(per_group * self.rng.uniform(0.3, 1.7) * math.sqrt(len(members) / 20 + 0.5))
+            for _ in range(count):
+                people = self.rng.sample(members, self.rng.randint(1, min(len(members), 40)))
+                when = now - timedelta(seconds=self.rng.uniform(0, days * 86400))
+                restaurant = self.rng.choice(by_group[group.pk])
+                orders.append(Order(
+                    host=people[0], restaurant=restaurant, group=group,
+                    num_pizzas=max(1, math.ceil(len(people) / 3)),
+                    optimization_mode=self.rng.choice(['maximize_likes', 'minimize_dislikes']),
+                ))
+                plans.append((people, restaurant.scale_menu, when))
+        orders = Order.objects.bulk_create(orders, batch_size=BATCH_SIZE)
+        # auto_now_add ignores values given to bulk_create; backdate in a second pass.
+        qn = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"UPDATE {qn(Order._meta.db_table)} SET {qn('created_at')} = %s, {qn('updated_at')} = %s "
+                f"WHERE {qn('id')} = %s",
+                [(when, when, order.pk) for order, (_, _, when) in zip(orders, plans)],
+            )
+
+        pizzas = OrderedPizza.objects.bulk_create(
+            [OrderedPizza(order=order) for order in orders for _ in range(order.num_pizzas)], batch_size=BATCH_SIZE,
+        )
+        pizza_toppings, pizza_people, order_people = [], [], []
+        index = 0
+        for order, (people, menu, _) in zip(orders, plans):
+            order_people.extend((order.pk, person.pk) for person in people)
+            order_pizzas = pizzas[index:index + order.num_pizzas]
+            index += order.num_pizzas
+            for k, pizza in enumerate(order_pizzas):
+                picked = self.rng.sample(menu, min(len(menu), self.rng.randint(1, 3)))
+                pizza_toppings.extend((pizza.pk, topping.pk) for topping in picked)
+                pizza_people.extend((pizza.pk, person.pk) for person in people[k::order.num_pizzas])
+
+        self._insert(Order.people.through, ['order_id', 'person_id'], order_people)
+        self._insert(OrderedPizza.toppings.through, ['orderedpizza_id', 'topping_id'], pizza_toppings)
+        self._insert(OrderedPizza.people.through, ['orderedpizza_id', 'person_id'], pizza_people)
+        self.stdout.write(f"  Created {len(orders)} solved orders with {len(pizzas)} pizzas over {days} days.")
@@ -12,6 +12,7 @@ Toppings are created via get_or_create so this command works whether or not
 seed_toppings has been run first.
 """
 
+from django.core.cache import cache
 from django.core.management.base import BaseCommand
 
 from webapp.models import (
@@ -78,6 +79,8 @@ class Command(BaseCommand):
         Person.objects.all().delete()
         User.objects.filter(is_superuser=False).delete()
         PizzaRestaurant.objects.all().delete()
+        # Seeding uses bulk_create, which sends no signals, so drop cached rows wholesale.
+        cache.clear()
         self.stdout.write("  Wiped all non-superuser, non-topping data.")
 
     def _ensure_toppings(self):
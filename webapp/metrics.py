@@ -0,0 +1,271 @@
+"""
+Runtime metrics in Prometheus text format.
+
+Each gunicorn worker keeps its counters and histograms in memory and writes
+them to its own JSON file in METRICS_DIR, at most every
+METRICS_FLUSH_INTERVAL seconds and at exit. /metrics sums the files of every
+worker that has run with the answering worker's live numbers, so totals
+survive a worker being recycled. entrypoint.sh empties the directory
+on start-up. Scraping reads only these files and the solver governor's lock
+files. It never queries the database.
+
+Metrics:
+  - pizza_request_duration_seconds{view}: request latency histogram.
+  - pizza_solve_duration_seconds{backend,mode}: solve time histogram.
+  - pizza_solve_model_variables / _constraints{mode}: ILP size histograms.
+  - pizza_solver_queue_depth, pizza_solver_active_solves, pizza_solver_slots:
+    governor state at scrape time.
+  - pizza_cache_requests_total{cache,result} and pizza_cache_hit_ratio{cache}
+    for the preference and person-context caches.
+  - pizza_guest_joins_total: guests who joined an order. Joins per minute
+    is rate(pizza_guest_joins_total[5m]) * 60.
+  - pizza_db_pool_*{database}: psycopg_pool counters (DB_POOL=True, see
+    webapp.dbpool). Workers add their pool stats to their files; the
+    connection gauges only count workers that are still running.
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
+
+from . import dbpool, governor
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SOLVE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+SIZE_BUCKETS = (100, 300, 1000, 3000, 10000, 30000, 100000, 300000)
+
+HISTOGRAMS = {
+    'pizza_request_duration_seconds': ("Request latency by view.", LATENCY_BUCKETS),
+    'pizza_solve_duration_seconds': ("Wall time of solver runs.", SOLVE_BUCKETS),
+    'pizza_solve_model_variables': ("Variables in each solved ILP.", SIZE_BUCKETS),
+    'pizza_solve_model_constraints': ("Constraints in each solved ILP.", SIZE_BUCKETS),
+}
+COUNTERS = {
+    'pizza_cache_requests_total': "Cache lookups by cache and result (hit/miss).",
+    'pizza_guest_joins_total': "Guests who joined an order through an invite link.",
+}
+
+# psycopg_pool get_stats() keys exported as gauges (workers still running) and as counters (all workers).
+POOL_GAUGES = {
+    'pool_size': "Connections the pool holds, in use or idle.",
+    'pool_available': "Idle connections ready for a request.",
+    'pool_max': "Most connections the pool may open.",
+}
+POOL_COUNTERS = {
+    'requests_num': "Connections requested from the pool.",
+    'requests_queued': "Requests that had to wait for a connection.",
+    'requests_wait_ms': "Milliseconds requests spent waiting for a connection.",
+    'requests_errors': "Requests that timed out or failed waiting for a connection.",
+    'returns_bad': "Connections returned to the pool in a bad state.",
+    'connections_num': "Connection attempts to the server.",
+    'connections_errors': "Failed connection attempts.",
+    'connections_lost': "Connections found broken when checked.",
+}
+
+_lock = threading.Lock()
+_pid = None
+_path = None
+_last_flush = 0.0
+_counters = defaultdict(float)   # (name, labels) -> value
+_histograms = {}                 # (name, labels) -> [per-bucket counts..., +Inf count, sum]
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _own_state():
+    """Reset state in a freshly forked worker so it never reports its parent's numbers."""
+    global _pid, _path, _last_flush
+    if _pid != os.getpid():
+        _pid = os.getpid()
+        _path = os.path.join(settings.METRICS_DIR, f'metrics-{_pid}-{uuid.uuid4().hex[:8]}.json')
+        _last_flush = 0.0
+        _counters.clear()
+        _histograms.clear()
+
+
+def inc(name, amount=1, **labels):
+    with _lock:
+        _own_state()
+        _counters[name, _labels(labels)] += amount
+    _maybe_flush()
+
+
+def observe(name, value, **labels):
+    buckets = HISTOGRAMS[name][1]
+    with _lock:
+        _own_state()
+        slots = _histograms.setdefault((name, _labels(labels)), [0] * (len(buckets) + 1) + [0.0])
+        index = next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))
+        slots[index] += 1
+        slots[-1] += value
+    _maybe_flush()
+
+
+def _snapshot():
+    return {
+        'counters': [[name, list(labels), value] for (name, labels), value in _counters.items()],
+        'histograms': [[name, list(labels), slots] for (name, labels), slots in _histograms.items()],
+        'pools': dbpool.pool_stats(),
+    }
+
+
+def _running(path):
+    """Whether the worker that wrote metrics-<pid>-<id>.json is still running."""
+    try:
+        pid = int(os.path.basename(path).split('-')[1])
+        if pid <= 0:
+            return False
+        os.kill(pid, 0)
+    except (IndexError, ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _maybe_flush():
+    if time.monotonic() - _last_flush >= settings.METRICS_FLUSH_INTERVAL:
+        flush()
+
+
+def flush():
+    """Write this worker's numbers to its file (atomically, so readers never see half a file)."""
+    global _last_flush
+    with _lock:
+        _own_state()
+        if not _counters and not _histograms:
+            return
+        data = json.dumps(_snapshot())
+        _last_flush = time.monotonic()
+        path = _path
+    os.makedirs(settings.METRICS_DIR, exist_ok=True)
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+atexit.register(flush)
+
+
+def collect():
+    """(counters, histograms, pools) summed over every worker's file, with this worker's live state.
+
+    pools maps (database, stat) to a total; gauges only count running workers.
+    """
+    with _lock:
+        _own_state()
+        own = _path
+        states = [_snapshot()]
+    live = [True]
+    try:
+        names = os.listdir(settings.METRICS_DIR)
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        path = os.path.join(settings.METRICS_DIR, name)
+        if not name.endswith('.json') or path == own:
+            continue
+        try:
+            with open(path) as f:
+                states.append(json.load(f))
+        except (OSError, ValueError):
+            continue  # removed or being replaced mid-read
+        live.append(_running(path))
+
+    counters = defaultdict(float)
+    histograms = {}
+    for state in states:
+        for name, labels, value in state['counters']:
+            counters[name, tuple(map(tuple, labels))] += value
+        for name, labels, slots in state['histograms']:
+            key = name, tuple(map(tuple, labels))
+            if key in histograms:
+                histograms[key] = [a + b for a, b in zip(histograms[key], slots)]
+            else:
+                histograms[key] = list(slots)
+    pools = defaultdict(float)
+    for state, running in zip(states, live):
+        for database, stats in state.get('pools', {}).items():
+            for stat, value in stats.items():
+                if stat in POOL_COUNTERS or (running and stat in POOL_GAUGES):
+                    pools[database, stat] += value
+    return counters, histograms, pools
+
+
+# ---------------------------------------------------------------------------
+# Exposition
+# ---------------------------------------------------------------------------
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+def render():
+    """The Prometheus text exposition of every metric."""
+    counters, histograms, pools = collect()
+    lines = []
+
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+        for (metric, labels), slots in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ['+Inf'], slots[:-1]):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", bound),))} {_number(cumulative)}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {_number(slots[-1])}')
+            lines.append(f'{name}_count{_format_labels(labels)} {_number(cumulative)}')
+
+    for name, help_text in COUNTERS.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append(f'{name}{_format_labels(labels)} {_number(value)}')
+
+    totals = defaultdict(lambda: [0.0, 0.0])
+    for (metric, labels), value in counters.items():
+        if metric == 'pizza_cache_requests_total':
+            labels = dict(labels)
+            totals[labels['cache']][labels['result'] == 'hit'] += value
+    lines += ['# HELP pizza_cache_hit_ratio Lifetime hits / lookups per cache.', '# TYPE pizza_cache_hit_ratio gauge']
+    for cache_name, (misses, hits) in sorted(totals.items()):
+        lines.append(f'pizza_cache_hit_ratio{{cache="{_escape(cache_name)}"}} {_number(hits / (hits + misses))}')
+
+    solver = governor.stats()
+    for name, key, help_text in (
+        ('pizza_solver_queue_depth', 'queue_depth', "Requests waiting for a solver slot."),
+        ('pizza_solver_active_solves', 'active', "Solver slots in use."),
+        ('pizza_solver_slots', 'max_concurrent', "Solver slots across all workers."),
+    ):
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {solver[key]}']
+
+    databases = sorted({database for database, _ in pools})
+    for stats, kind, suffix in ((POOL_GAUGES, 'gauge', ''), (POOL_COUNTERS, 'counter', '_total')):
+        for stat, help_text in stats.items():
+            name = f'pizza_db_pool_{stat}{suffix}'
+            if databases:
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+            for database in databases:
+                lines.append(f'{name}{{database="{_escape(database)}"}} {_number(pools[database, stat])}')
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,243 @@
+import logging
+import time
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404
+from django.utils.decorators import sync_and_async_middleware
+
+from . import metrics, profiling, querylog
+from .models import GroupMembership, Person, RequestProfile
+from .routers import PIN_COOKIE, begin_request, end_request
+
+query_logger = logging.getLogger('webapp.queries')
+
+PERSON_CONTEXT_CACHE_KEY = 'person-context:{}'
+
+
+def person_context_cache_key(user_id):
+    return PERSON_CONTEXT_CACHE_KEY.format(user_id)
+
+
+class PersonContext:
+    """The current user's Person and group memberships, resolved at most once per request.
+
+    Both are loaded lazily on first access. When PERSON_CONTEXT_CACHE_TIMEOUT is
+    set, they are also cached across requests for that many seconds; signal
+    handlers in webapp.signals drop the entry when the Person or one of its
+    memberships changes.
+    """
+
+    def __init__(self, request):
+        self._request = request
+        self._user = None
+        self._person_loaded = False
+        self._person = None
+        self._memberships = None
+
+    def _cache_key(self):
+        timeout = settings.PERSON_CONTEXT_CACHE_TIMEOUT
+        if timeout and self._user.is_authenticated:
+            return person_context_cache_key(self._user.pk)
+        return None
+
+    def _load(self, user, memberships=False):
+        if self._user is None:
+            self._user = user
+            key = self._cache_key()
+            cached = cache.get(key) if key else None
+            if key:
+                metrics.inc('pizza_cache_requests_total', cache='person_context', result='miss' if cached is None else 'hit')
+            if cached is not None:
+                self._person, self._memberships = cached
+                self._person_loaded = True
+        if not self._person_loaded:
+            self._person = Person.get_for_user(self._user)
+            self._person_loaded = True
+        if memberships and self._memberships is None:
+            self._memberships = dict(
+                GroupMembership.objects.filter(person=self._person).values_list('group_id', 'is_admin')
+            ) if self._person else {}
+            key = self._cache_key()
+            if key:
+                cache.set(key, (self._person, self._memberships), settings.PERSON_CONTEXT_CACHE_TIMEOUT)
+
+    @property
+    def person(self):
+        """The Person for request.user (created on first use), or None for anonymous users."""
+        self._load(self._request.user)
+        return self._person
+
+    @property
+    def memberships(self):
+        """Dict mapping group_id -> is_admin for every group the person belongs to."""
+        self._load(self._request.user, memberships=True)
+        return self._memberships
+
+    @property
+    def group_ids(self):
+        return set(self.memberships)
+
+    def is_member(self, group_id):
+        return group_id in self.memberships
+
+    def is_admin(self, group_id):
+        return self.memberships.get(group_id, False)
+
+    def require_member(self, group_id):
+        """Raise Http404 unless the person belongs to the group. Returns the is_admin flag."""
+        if group_id not in self.memberships:
+            raise Http404("No GroupMembership matches the given query.")
+        return self.memberships[group_id]
+
+    async def aperson(self):
+        user = await self._request.auser()
+        await sync_to_async(self._load)(user)
+        return self._person
+
+    async def amemberships(self):
+        user = await self._request.auser()
+        await sync_to_async(self._load)(user, memberships=True)
+        return self._memberships
+
+
+@sync_and_async_middleware
+def person_context_middleware(get_response):
+    """Attach a lazy PersonContext to every request as request.person_context."""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            request.person_context = PersonContext(request)
+            return await get_response(request)
+    else:
+        def middleware(request):
+            request.person_context = PersonContext(request)
+            return get_response(request)
+    return middleware
+
+
+def _pin_after_write(response, wrote):
+    if wrote:
+        response.set_cookie(PIN_COOKIE, '1', max_age=settings.REPLICA_PIN_SECONDS, httponly=True, samesite='Lax')
+    return response
+
+
+@sync_and_async_middleware
+def replica_pin_middleware(get_response):
+    """Track reads/writes for webapp.routers and pin users to the primary briefly after they write."""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            token = begin_request()
+            try:
+                response = await get_response(request)
+            finally:
+                wrote = end_request(token)
+            return _pin_after_write(response, wrote)
+    else:
+        def middleware(request):
+            token = begin_request()
+            try:
+                response = get_response(request)
+            finally:
+                wrote = end_request(token)
+            return _pin_after_write(response, wrote)
+    return middleware
+
+
+def _report_queries(request, response, log):
+    ms = log.seconds * 1000
+    response['X-DB-Queries'] = str(log.count)
+    response['X-DB-Time-Ms'] = f'{ms:.1f}'
+    response['X-DB-Duplicate-Queries'] = str(log.duplicates)
+    response['Server-Timing'] = f'db;dur={ms:.1f};desc="{log.count} queries"'
+    query_logger.info(
+        "%s %s: %d queries, %.1f ms, %d duplicates",
+        request.method, request.path, log.count, ms, log.duplicates,
+    )
+    for count, sql in log.repeated():
+        query_logger.info("  %dx %s", count, sql)
+    return response
+
+
+@sync_and_async_middleware
+def query_budget_middleware(get_response):
+    """Report per-request query count, DB time and repeated statements (QUERY_BUDGET=True).
+
+    Streaming responses only include the queries run before the body starts.
+    """
+    querylog.install()
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            with querylog.record() as log:
+                response = await get_response(request)
+            return _report_queries(request, response, log)
+    else:
+        def middleware(request):
+            with querylog.record() as log:
+                response = get_response(request)
+            return _report_queries(request, response, log)
+    return middleware
+
+
+@sync_and_async_middleware
+def profiling_middleware(get_response):
+    """Run staff-flagged (?_profile=1) or sampled requests under cProfile; see webapp.profiling."""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            if profiling.flagged(request) and (await request.auser()).is_staff:
+                trigger = RequestProfile.TRIGGER_FLAG
+            elif profiling.sampled():
+                trigger = RequestProfile.TRIGGER_SAMPLE
+            else:
+                return await get_response(request)
+            run = profiling.Run()
+            if not run.start():
+                return await get_response(request)
+            try:
+                response = await get_response(request)
+            finally:
+                run.stop()
+            await sync_to_async(run.save)(request, response, trigger)
+            return response
+    else:
+        def middleware(request):
+            if profiling.flagged(request) and request.user.is_staff:
+                trigger = RequestProfile.TRIGGER_FLAG
+            elif profiling.sampled():
+                trigger = RequestProfile.TRIGGER_SAMPLE
+            else:
+                return get_response(request)
+            run = profiling.Run()
+            if not run.start():
+                return get_response(request)
+            try:
+                response = get_response(request)
+            finally:
+                run.stop()
+            run.save(request, response, trigger)
+            return response
+    return middleware
+
+
+def _observe_request(request, seconds):
+    match = request.resolver_match
+    view = match.view_name if match else 'unmatched'
+    metrics.observe('pizza_request_duration_seconds', seconds, view=view)
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """Record request latency by view name for /metrics."""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            start = time.perf_counter()
+            response = await get_response(request)
+            _observe_request(request, time.perf_counter() - start)
+            return response
+    else:
+        def middleware(request):
+            start = time.perf_counter()
+            response = get_response(request)
+            _observe_request(request, time.perf_counter() - start)
+            return response
+    return middleware
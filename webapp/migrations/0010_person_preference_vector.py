@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webapp', '0009_add_shareability_bonus_weight'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PersonPreferenceVector',
+            fields=[
+                ('person', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='preference_vector', serialize=False, to='webapp.person')),
+                ('codes', models.BinaryField(default=bytes)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 22:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webapp', '0013_request_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='solve_quality',
+            field=models.CharField(choices=[('fast', 'Fast'), ('balanced', 'Balanced'), ('exact', 'Exact')], default='balanced', help_text='How long the solver may search: fast and balanced stop near the optimum, exact (staff only) proves it', max_length=10),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('webapp', '0014_order_solve_quality'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='solving_since',
+            field=models.DateTimeField(blank=True, editable=False, help_text="Set while a solve_once() call holds the order's solve claim", null=True),
+        ),
+    ]
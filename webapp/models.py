@@ -26,11 +26,26 @@ class Person(models.Model):
 
     @classmethod
     def get_from_request(cls, request):
-        """Get the Person associated with the current request, if any."""
-        if request.user.is_authenticated:
+        """Get the Person associated with the current request, if any.
+
+        Reuses the per-request PersonContext set up by person_context_middleware when present.
+        """
+        context = getattr(request, 'person_context', None)
+        if context is not None:
+            return context.person
+        return cls.get_for_user(request.user)
+
+    @classmethod
+    def get_for_user(cls, user):
+        """Get (or create) the Person linked to an authenticated user; None for anonymous users."""
+        if user.is_authenticated:
+            # Plain read first: get_or_create() counts as a write for database routing.
+            person = cls.objects.filter(user_account=user).first()
+            if person is not None:
+                return person
             person, _ = cls.objects.get_or_create(
-                user_account=request.user,
-                defaults={'name': request.user.email, 'email': request.user.email},
+                user_account=user,
+                defaults={'name': user.email, 'email': user.email},
             )
             return person
         return None
@@ -146,6 +161,22 @@ class PersonToppingPreference(models.Model):
         return f"{self.person.name} - {self.topping.name} ({self.get_preference_display()})"
 
 
+class PersonPreferenceVector(models.Model):
+    """Packed copy of a person's PersonToppingPreference rows, kept in sync when PACKED_PREFERENCES is on.
+
+    codes[topping_id] holds one byte per topping: 0 = unrated, otherwise preference + 3
+    (so ALLERGY=1, DISLIKE=2, NEUTRAL=3, LIKE=4). Topping ids are stable, so the
+    vector never needs reindexing; it is as long as the highest rated topping id + 1.
+    """
+    person = models.OneToOneField(
+        Person, on_delete=models.CASCADE, primary_key=True, related_name='preference_vector',
+    )
+    codes = models.BinaryField(default=bytes)
+
+    def __str__(self):
+        return f"Preference vector for {self.person_id}"
+
+
 class RestaurantTopping(models.Model):
     """Through model indicating which restaurants have which toppings available."""
     restaurant = models.ForeignKey(PizzaRestaurant, on_delete=models.CASCADE, related_name='available_toppings')
@@ -165,6 +196,11 @@ class Order(models.Model):
         ('maximize_likes', 'Maximize Likes'),
         ('minimize_dislikes', 'Minimize Dislikes'),
     ]
+    SOLVE_QUALITY_CHOICES = [
+        ('fast', 'Fast'),
+        ('balanced', 'Balanced'),
+        ('exact', 'Exact'),
+    ]
 
     host = models.ForeignKey(Person, on_delete=models.CASCADE, related_name='hosted_orders')
     restaurant = models.ForeignKey(PizzaRestaurant, on_delete=models.CASCADE, related_name='orders')
@@ -185,11 +221,26 @@ class Order(models.Model):
                   "assigned people's collective influence when scoring pizzas. Normalized by number of "
                   "pizzas at solve time. 0 = only assigned people's preferences are considered."
     )
+    solve_quality = models.CharField(
+        max_length=10, choices=SOLVE_QUALITY_CHOICES, default='balanced',
+        help_text="How long the solver may search: fast and balanced stop near the optimum, "
+                  "exact (staff only) proves it"
+    )
     invite_token = models.UUIDField(null=True, blank=True, unique=True)
+    solving_since = models.DateTimeField(
+        null=True, blank=True, editable=False,
+        help_text="Set while a solve_once() call holds the order's solve claim",
+    )
     metadata = models.JSONField(default=dict, blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Serves a group's order history newest-first with keyset pagination.
+            models.Index(fields=['group', 'created_at', 'id'], name='order_group_created_idx'),
+        ]
+
     def __str__(self):
         return f"Order #{self.id} - {self.restaurant.name} ({self.created_at.date()})"
 
@@ -202,3 +253,50 @@ class OrderedPizza(models.Model):
 
     def __str__(self):
         return f"Pizza #{self.id} - Order #{self.order.id}"
+
+
+class ArchivedOrder(models.Model):
+    """A solved order moved out of the hot tables by the archive_orders command.
+
+    data holds the zlib-compressed JSON snapshot built by webapp.archive; the
+    primary key is the original Order id, so /orders/<id>/results/ keeps working.
+    """
+    order_id = models.PositiveIntegerField(primary_key=True)
+    group = models.ForeignKey('PizzaGroup', on_delete=models.PROTECT, related_name='archived_orders')
+    created_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+    data = models.BinaryField()
+
+    def __str__(self):
+        return f"Archived order #{self.order_id} ({self.created_at.date()})"
+
+
+class RequestProfile(models.Model):
+    """A cProfile run of one request, recorded by webapp.profiling.
+
+    stats holds the marshalled pstats data (the .prof file format, readable by
+    pstats or snakeviz); summary is the top of the cumulative-time listing.
+    """
+    TRIGGER_FLAG = 'flag'
+    TRIGGER_SAMPLE = 'sample'
+    TRIGGER_CHOICES = [(TRIGGER_FLAG, 'Staff flag'), (TRIGGER_SAMPLE, 'Sampled')]
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=500)
+    view_name = models.CharField(max_length=100, blank=True)
+    status_code = models.PositiveSmallIntegerField()
+    duration_ms = models.FloatField()
+    query_count = models.PositiveIntegerField()
+    trigger = models.CharField(max_length=10, choices=TRIGGER_CHOICES)
+    user = models.ForeignKey(
+        User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+',
+    )
+    summary = models.TextField()
+    stats = models.BinaryField()
+
+    class Meta:
+        ordering = ['-created_at', '-id']
+
+    def __str__(self):
+        return f"{self.method} {self.path} ({self.duration_ms:.0f} ms)"
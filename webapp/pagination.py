@@ -0,0 +1,79 @@
+"""
+Keyset (seek) pagination.
+
+OFFSET pagination makes the database walk and discard every row before the
+requested page, so deep pages get slower as a group's history grows. Keyset
+pagination instead remembers the sort key of the last row shown and asks for
+rows strictly after it, which an index on the sort key answers directly.
+
+The cursor is an opaque URL-safe token holding the last row's key values. It
+only supports moving forward; pages link back to the first page.
+"""
+
+import base64
+import binascii
+import json
+from dataclasses import dataclass
+from functools import reduce
+from operator import or_
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+@dataclass
+class KeysetPage:
+    items: list
+    next_cursor: str = None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def _encode(values):
+    raw = json.dumps(values, default=str, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def _decode(cursor, fields):
+    """Cursor -> list of Python values for fields, or None if the cursor is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+        if not isinstance(values, list) or len(values) != len(fields):
+            return None
+        return [field.to_python(value) for field, value in zip(fields, values)]
+    except (binascii.Error, ValueError, ValidationError):
+        return None
+
+
+def keyset_page(queryset, keys, cursor=None, per_page=50):
+    """Return the page of queryset after cursor, ordered by keys.
+
+    keys is a list of field names, each optionally prefixed with '-' for
+    descending order; the last one must be unique (e.g. 'id') so the order is
+    total. A malformed cursor is treated as the first page.
+    """
+    model = queryset.model
+    names = [key.lstrip('-') for key in keys]
+    fields = [model._meta.get_field(name) for name in names]
+    queryset = queryset.order_by(*keys)
+
+    values = _decode(cursor, fields) if cursor else None
+    if values is not None:
+        # (k1, k2, ...) after (v1, v2, ...): k1 beyond v1, or k1 = v1 and k2 beyond v2, ...
+        conditions = []
+        for i, key in enumerate(keys):
+            lookup = 'lt' if key.startswith('-') else 'gt'
+            equal = {names[j]: values[j] for j in range(i)}
+            conditions.append(Q(**equal, **{f'{names[i]}__{lookup}': values[i]}))
+        queryset = queryset.filter(reduce(or_, conditions))
+
+    items = list(queryset[:per_page + 1])
+    next_cursor = None
+    if len(items) > per_page:
+        items = items[:per_page]
+        last = items[-1]
+        next_cursor = _encode([getattr(last, field.attname) for field in fields])
+    return KeysetPage(items=items, next_cursor=next_cursor)
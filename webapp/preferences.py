@@ -0,0 +1,202 @@
+"""
+Cached person x topping preference lookups.
+
+The solver, pizza scoring and the staff preference matrix all need the same
+thing: for a set of people and toppings, each person's effective preference,
+with unrated toppings defaulting to DISLIKE or NEUTRAL per
+Person.unrated_is_dislike. load_preferences() serves that from a per-person
+cache entry holding the person's explicit ratings, so repeat solves and page
+views do not re-query PersonToppingPreference.
+
+Entries are per person rather than per group because orders mix group members
+with guests, and a person's ratings do not depend on which restaurant's topping
+set is being looked at.
+
+Entries are never updated in place. A write invalidates the person's whole
+entry, and the next lookup re-reads all of their ratings. Each entry's key
+includes the person's 'person:<pk>' version (see webapp.caching). Signal
+handlers in webapp.signals bump it when one of their preferences is saved, or
+when a Topping or Person delete cascades to them. Code that writes preferences
+with bulk_create() or deletes them with a queryset must call
+preferences_changed() itself, since those send no signals. The bump waits for
+the write's transaction to commit. A reader that loaded the old rows before
+then stores them under the old version, where no later lookup will find them.
+Patching the cached entry with a write's delta instead would let two writers
+that commit close together each patch the same old entry, losing one change.
+
+With PACKED_PREFERENCES on, each person's ratings are also kept as one
+PersonPreferenceVector: a byte string indexed by topping id (see
+pack_codes()). Cache misses then read one narrow row per person instead of one
+row per rating. PersonToppingPreference stays the source of truth; a person
+without a vector is read from the rows and packed on the spot. That packing
+never overwrites an existing vector, so it cannot undo the re-pack that
+preferences_changed() does after a commit.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, router, transaction
+
+from . import metrics
+from .caching import bump_versions, collect_on_commit, get_versions
+from .models import Person, PersonPreferenceVector, PersonToppingPreference
+
+PREFERENCE_CACHE_KEY = 'prefs:person:{}:{}'
+
+
+def _keys(person_ids):
+    """{person_id: cache key} for the people's current versions."""
+    versions = get_versions(*(f'person:{pk}' for pk in person_ids))
+    return {pk: PREFERENCE_CACHE_KEY.format(pk, versions[f'person:{pk}']) for pk in person_ids}
+
+
+class PreferenceMatrix:
+    """Effective preferences for a fixed set of people, with defaults applied on lookup."""
+
+    def __init__(self, explicit, defaults):
+        self._explicit = explicit
+        self._defaults = defaults
+
+    def get(self, person_id, topping_id):
+        """The person's preference for the topping, falling back to their unrated default."""
+        return self._explicit[person_id].get(topping_id, self._defaults[person_id])
+
+    def explicit(self, person_id, topping_id):
+        """The person's recorded preference for the topping, or None if unrated."""
+        return self._explicit[person_id].get(topping_id)
+
+
+def pack_codes(ratings):
+    """Pack {topping_id: preference} into bytes: byte i is 0 if topping i is unrated, else preference + 3."""
+    if not ratings:
+        return b''
+    codes = bytearray(max(ratings) + 1)
+    for topping_id, pref in ratings.items():
+        codes[topping_id] = pref + 3
+    return bytes(codes)
+
+
+def unpack_codes(codes):
+    """Inverse of pack_codes()."""
+    return {topping_id: code - 3 for topping_id, code in enumerate(bytes(codes)) if code}
+
+
+def read_rows(person_ids, using=None):
+    """{person_id: {topping_id: preference}} read from PersonToppingPreference."""
+    loaded = {pk: {} for pk in person_ids}
+    for person_id, topping_id, pref in PersonToppingPreference.objects.using(using).filter(
+        person_id__in=person_ids,
+    ).values_list('person_id', 'topping_id', 'preference'):
+        loaded[person_id][topping_id] = pref
+    return loaded
+
+
+def read_vectors(person_ids, using=None):
+    """{person_id: {topping_id: preference}} for the given people that have a packed vector."""
+    return {
+        person_id: unpack_codes(codes)
+        for person_id, codes in PersonPreferenceVector.objects.using(using).filter(
+            person_id__in=person_ids,
+        ).values_list('person_id', 'codes')
+    }
+
+
+def write_vectors(ratings_by_person, replace=True):
+    """Store packed vectors for {person_id: {topping_id: preference}}.
+
+    With replace=False, people who already have a vector keep it.
+    """
+    vectors = [PersonPreferenceVector(person_id=pk, codes=pack_codes(ratings))
+               for pk, ratings in ratings_by_person.items()]
+    if replace:
+        PersonPreferenceVector.objects.bulk_create(
+            vectors, update_conflicts=True, unique_fields=['person'], update_fields=['codes'],
+        )
+    else:
+        PersonPreferenceVector.objects.bulk_create(vectors, ignore_conflicts=True)
+
+
+def load_preferences(people, using=None):
+    """Build a PreferenceMatrix for the given Person objects, reading through the cache.
+
+    using picks the database for cache misses (default: the router's choice).
+    Rows read from a replica are not cached or packed, since a lagging replica
+    could otherwise outlive the invalidation of a newer write.
+    """
+    people = list(people)
+    alias = using or router.db_for_read(PersonToppingPreference)
+    defaults = {
+        p.pk: PersonToppingPreference.DISLIKE if p.unrated_is_dislike else PersonToppingPreference.NEUTRAL
+        for p in people
+    }
+    keys = _keys(list(defaults))
+    cached = cache.get_many(list(keys.values()))
+    explicit = {pk: cached[key] for pk, key in keys.items() if key in cached}
+
+    missing = [pk for pk in defaults if pk not in explicit]
+    metrics.inc('pizza_cache_requests_total', len(explicit), cache='preferences', result='hit')
+    metrics.inc('pizza_cache_requests_total', len(missing), cache='preferences', result='miss')
+    if missing:
+        from_primary = alias == DEFAULT_DB_ALIAS
+        if settings.PACKED_PREFERENCES:
+            loaded = read_vectors(missing, alias)
+            unpacked = [pk for pk in missing if pk not in loaded]
+            if unpacked:
+                from_rows = read_rows(unpacked, alias)
+                if from_primary:
+                    write_vectors(from_rows, replace=False)
+                loaded.update(from_rows)
+        else:
+            loaded = read_rows(missing, alias)
+        if from_primary:
+            cache.set_many({keys[pk]: row for pk, row in loaded.items()}, settings.PREFERENCE_CACHE_TIMEOUT)
+        explicit.update(loaded)
+
+    return PreferenceMatrix(explicit, defaults)
+
+
+def invalidate_preferences(*person_ids):
+    """Make cached preferences for the given people unreachable."""
+    bump_versions(*(f'person:{pk}' for pk in person_ids))
+
+
+def write_preferences(person_id, current, wanted, topping_ids):
+    """Bring a person's ratings for topping_ids from current to wanted, writing only rows that differ.
+
+    current and wanted map topping_id -> preference; toppings in topping_ids that
+    are missing from wanted are cleared. Returns the number of rows changed.
+    """
+    upserts = {tid: pref for tid, pref in wanted.items() if current.get(tid) != pref}
+    deletes = [tid for tid in topping_ids if tid in current and tid not in wanted]
+    if deletes:
+        PersonToppingPreference.objects.filter(person_id=person_id, topping_id__in=deletes).delete()
+    if upserts:
+        PersonToppingPreference.objects.bulk_create(
+            [PersonToppingPreference(person_id=person_id, topping_id=tid, preference=pref)
+             for tid, pref in upserts.items()],
+            update_conflicts=True,
+            unique_fields=['person', 'topping'],
+            update_fields=['preference'],
+        )
+    if upserts or deletes:
+        preferences_changed(person_id)
+    return len(upserts) + len(deletes)
+
+
+def preferences_changed(*person_ids):
+    """Call after writing the given people's PersonToppingPreference rows.
+
+    Once the current transaction commits, everyone changed in it has their cache
+    entry invalidated and, with PACKED_PREFERENCES, their vector re-packed from
+    the rows.
+    """
+    collect_on_commit('preferences', person_ids, _refresh)
+
+
+def _refresh(person_ids):
+    invalidate_preferences(*person_ids)
+    if settings.PACKED_PREFERENCES:
+        with transaction.atomic():
+            # Concurrent re-packs for one person queue on the row lock, so the last one reads the latest rows.
+            list(Person.objects.select_for_update().filter(pk__in=person_ids).values_list('pk', flat=True))
+            write_vectors(read_rows(person_ids))
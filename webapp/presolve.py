@@ -0,0 +1,97 @@
+"""
+Presolve: shrink an order's ILP before it is built.
+
+Every reduction keeps at least one optimal solution of the full problem:
+
+  - Toppings that cannot be placed: every pizza has at least floor(P/K)
+    people, so a topping fewer than that many people can eat is never used.
+  - Toppings nobody likes: with no positive score among the participants
+    (and so no positive group-wide total), a topping can only lower a pizza's
+    score, under any assignment and any shareability weight.
+  - Indifferent people: someone with no score and no allergy for any
+    remaining topping changes no pizza's score. They are left out of the
+    model; it only keeps count of how many sit on each pizza, so pizza sizes
+    stay balanced, and they fill those seats afterwards.
+  - Identical toppings: toppings with the same score and allergy for every
+    remaining person are interchangeable. They merge into one integer
+    variable per pizza counting how many of them it gets.
+
+The solver builds its ILP from a Presolved and maps the answer back with
+Presolved.expand().
+"""
+
+from dataclasses import dataclass, field
+
+
+@dataclass
+class Presolved:
+    people: list          # original indexes of the people kept in the model
+    free: list            # original indexes of indifferent people
+    classes: list         # per merged topping: the original indexes it stands for
+    prefs: dict           # (model person, class) -> nonzero score
+    allergy_pairs: set    # (model person, class)
+    stats: dict = field(default_factory=dict)
+
+    def expand(self, pizzas):
+        """Map [(model people, free seats, {class: count})] back to [(person indexes, topping indexes)]."""
+        free = iter(self.free)
+        return [
+            ([self.people[p] for p in assigned] + [next(free) for _ in range(seats)],
+             [t for c, count in counts.items() for t in self.classes[c][:count]])
+            for assigned, seats, counts in pizzas
+        ]
+
+    def summary(self):
+        s = self.stats
+        return (
+            f"people {s['people']} -> {len(self.people)} (+{len(self.free)} indifferent), "
+            f"toppings {s['toppings']} -> {len(self.classes)} "
+            f"({s['unplaceable']} unplaceable, {s['unliked']} unliked, {s['merged']} merged)"
+        )
+
+
+def presolve(num_people, num_toppings, prefs, allergy_pairs, num_pizzas):
+    """Reduce the problem solver.solve() would build; see the module docstring."""
+    min_per_pizza = num_people // num_pizzas
+    allergic = [set() for _ in range(num_toppings)]
+    for p, t in allergy_pairs:
+        allergic[t].add(p)
+
+    placeable = [t for t in range(num_toppings) if num_people - len(allergic[t]) >= min_per_pizza]
+    liked = [t for t in placeable if any(prefs.get((p, t), 0) > 0 for p in range(num_people))]
+
+    kept, free = [], []
+    for p in range(num_people):
+        if any(prefs.get((p, t), 0) or p in allergic[t] for t in liked):
+            kept.append(p)
+        else:
+            free.append(p)
+
+    classes, by_column = [], {}
+    for t in liked:
+        column = tuple((prefs.get((p, t), 0), p in allergic[t]) for p in kept)
+        if column in by_column:
+            classes[by_column[column]].append(t)
+        else:
+            by_column[column] = len(classes)
+            classes.append([t])
+
+    reduced_prefs, reduced_allergies = {}, set()
+    for c, members in enumerate(classes):
+        t = members[0]
+        for i, p in enumerate(kept):
+            if p in allergic[t]:
+                reduced_allergies.add((i, c))
+            elif prefs.get((p, t), 0):
+                reduced_prefs[i, c] = prefs[p, t]
+
+    return Presolved(
+        people=kept, free=free, classes=classes, prefs=reduced_prefs, allergy_pairs=reduced_allergies,
+        stats={
+            'people': num_people,
+            'toppings': num_toppings,
+            'unplaceable': num_toppings - len(placeable),
+            'unliked': len(placeable) - len(liked),
+            'merged': len(liked) - len(classes),
+        },
+    )
@@ -0,0 +1,109 @@
+"""
+On-demand request profiling for staff.
+
+A request is profiled when a staff user adds ?_profile=1 to any URL, or when it
+falls into the PROFILE_SAMPLE_RATE fraction of all requests. The request runs
+under cProfile, and the result is saved as a RequestProfile that staff can
+browse at /staff/profiles/ and download as a .prof file (open it with
+``python -m pstats`` or snakeviz).
+
+When a request is not profiled, the only cost is a query-string lookup and, if
+sampling is on, one random() call.
+
+cProfile only sees the thread it runs in. For async views that is the event
+loop; ORM work they hand to sync_to_async shows up as time spent awaiting.
+Sync views such as new_order and draft_order, which run the solver, are
+profiled in full. Under ASGI the event loop also runs other requests while one
+is profiled, so an async profile can include their work too.
+
+Only one request per process is profiled at a time: Python 3.12 allows a
+single active cProfile per process. A request that would be profiled while
+another is (or while some other tool holds the profiler) is served normally
+and not profiled.
+"""
+
+import cProfile
+import io
+import marshal
+import pstats
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.urls import Resolver404, resolve
+
+from . import querylog
+from .models import RequestProfile
+
+FLAG = '_profile'
+SUMMARY_LINES = 60
+
+_active = threading.Lock()
+
+
+def flagged(request):
+    """True if the URL asks for a profile; the caller still has to check the user is staff."""
+    return FLAG in request.GET
+
+
+def sampled():
+    rate = settings.PROFILE_SAMPLE_RATE
+    return bool(rate) and random.random() < rate
+
+
+class Run:
+    """Times one request under cProfile and counts its queries."""
+
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+        self._queries = querylog.record()
+
+    def start(self):
+        """Start profiling. False, with nothing started, if the profiler is already in use."""
+        if not _active.acquire(blocking=False):
+            return False
+        try:
+            self.profiler.enable()
+        except ValueError:  # Another profiling tool is already active.
+            _active.release()
+            return False
+        self.log = self._queries.__enter__()
+        self.started = time.perf_counter()
+        return True
+
+    def stop(self):
+        self.profiler.disable()
+        self.seconds = time.perf_counter() - self.started
+        self._queries.__exit__(None, None, None)
+        _active.release()
+
+    def save(self, request, response, trigger):
+        out = io.StringIO()
+        stats = pstats.Stats(self.profiler, stream=out)
+        stats.sort_stats('cumulative').print_stats(SUMMARY_LINES)
+        try:
+            view_name = resolve(request.path_info).view_name
+        except Resolver404:
+            view_name = ''
+        user = getattr(request, 'user', None)
+        profile = RequestProfile.objects.create(
+            method=request.method,
+            path=request.get_full_path()[:500],
+            view_name=view_name[:100],
+            status_code=response.status_code,
+            duration_ms=self.seconds * 1000,
+            query_count=self.log.count,
+            trigger=trigger,
+            user=user if user is not None and user.is_authenticated else None,
+            summary=out.getvalue(),
+            stats=marshal.dumps(stats.stats),
+        )
+        prune()
+        return profile
+
+
+def prune():
+    """Keep only the newest PROFILE_KEEP profiles."""
+    stale = RequestProfile.objects.values_list('pk', flat=True)[settings.PROFILE_KEEP:]
+    RequestProfile.objects.filter(pk__in=list(stale)).delete()
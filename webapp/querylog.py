@@ -0,0 +1,94 @@
+"""
+Per-request query accounting.
+
+record() counts every SQL statement run while it is active, with total time
+and a fingerprint per statement, on all database connections: the recorder
+lives in a context variable, so it also sees queries that async views run
+through sync_to_async. Statements that differ only in parameters share a
+fingerprint, so a fingerprint seen many times in one request is usually an
+N+1 loop.
+
+query_budget_middleware (webapp.middleware, enabled with QUERY_BUDGET=True)
+reports the numbers in response headers and the webapp.queries log; the
+query budget tests use record() directly.
+"""
+
+import contextvars
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+_current = contextvars.ContextVar('query_log', default=None)
+
+_IN_LIST = re.compile(r'\bIN \((?:%s, )*%s\)')
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+\b')
+
+
+def fingerprint(sql):
+    """sql with literals and IN-list lengths normalised away."""
+    sql = _IN_LIST.sub('IN (...)', sql)
+    sql = _STRING.sub('?', sql)
+    return _NUMBER.sub('?', sql)
+
+
+@dataclass
+class QueryLog:
+    count: int = 0
+    seconds: float = 0.0
+    fingerprints: Counter = field(default_factory=Counter)
+
+    def add(self, sql, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.fingerprints[fingerprint(sql)] += 1
+
+    @property
+    def duplicates(self):
+        """Executions beyond the first of every repeated fingerprint."""
+        return sum(n - 1 for n in self.fingerprints.values())
+
+    def repeated(self, limit=3):
+        """The most repeated fingerprints as (count, sql), most frequent first."""
+        return [(n, sql) for sql, n in self.fingerprints.most_common(limit) if n > 1]
+
+
+def _record(execute, sql, params, many, context):
+    log = _current.get()
+    if log is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        log.add(sql, time.perf_counter() - start)
+
+
+def instrument(connection, **kwargs):
+    """Install the recorder on a connection (idempotent). Also a connection_created receiver."""
+    if _record not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record)
+
+
+def install():
+    """Instrument this thread's connections now and every connection opened later."""
+    connection_created.connect(instrument, dispatch_uid='webapp.querylog')
+    for conn in connections.all(initialized_only=True):
+        instrument(conn)
+
+
+@contextmanager
+def record():
+    """Collect a QueryLog of the statements run inside the block."""
+    install()
+    log = QueryLog()
+    token = _current.set(log)
+    try:
+        yield log
+    finally:
+        _current.reset(token)
@@ -0,0 +1,93 @@
+"""
+Read-replica routing.
+
+When DATABASE_REPLICA_URL is set, settings adds a 'replica' database, installs
+ReplicaRouter and the replica pin middleware. Reads only go to the replica in
+views decorated with @replica_reads (read-only pages). Everything else,
+including all writes and the solver's preference loads, stays on the primary. Inside a
+replica_reads view, the first write or an open transaction on the primary
+switches the rest of the request back to the primary (read-after-write).
+A request that wrote also sets a short-lived pin cookie, so the pages the user
+is redirected to next read from the primary until the replica has caught up.
+
+Without a replica configured, the decorator and middleware do nothing.
+"""
+
+import contextvars
+import functools
+from dataclasses import dataclass
+
+from asgiref.sync import iscoroutinefunction
+from django.contrib.auth import get_user_model
+from django.db import DEFAULT_DB_ALIAS, connections
+
+REPLICA_DB_ALIAS = 'replica'
+PIN_COOKIE = 'db_pin'
+
+
+@dataclass
+class RoutingState:
+    use_replica: bool = False
+    wrote: bool = False
+
+
+_state = contextvars.ContextVar('replica_routing_state', default=None)
+
+
+def begin_request():
+    """Start routing state for a request. Returns a token for end_request()."""
+    return _state.set(RoutingState())
+
+
+def end_request(token):
+    """Reset routing state; returns True if the request wrote to the primary."""
+    state = _state.get()
+    _state.reset(token)
+    return bool(state and state.wrote)
+
+
+def _replicable(model):
+    """App data only: sessions, accounts and constance settings always read from the primary."""
+    return model._meta.app_label == 'webapp' and model is not get_user_model()
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if (state is not None and state.use_replica and not state.wrote and _replicable(model)
+                and not connections[DEFAULT_DB_ALIAS].in_atomic_block):
+            return REPLICA_DB_ALIAS
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None and _replicable(model):
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both aliases hold the same data.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+def replica_reads(view):
+    """Let a read-only view read from the replica, unless the user recently wrote."""
+    def enable(request):
+        state = _state.get()
+        if state is not None and not request.COOKIES.get(PIN_COOKIE):
+            state.use_replica = True
+
+    if iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            enable(request)
+            return await view(request, *args, **kwargs)
+    else:
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            enable(request)
+            return view(request, *args, **kwargs)
+    return wrapper
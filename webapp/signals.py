@@ -0,0 +1,112 @@
+"""
+Cache invalidation on model writes.
+
+Version bumps and preference refreshes wait for the write's transaction to
+commit (see webapp.caching.bump_on_commit). GroupMembership, RestaurantTopping
+and PersonToppingPreference have no delete receivers: any receiver would make
+Django load and signal every row a cascade reaches instead of deleting them in
+one statement. Deleting a Topping, PizzaGroup or Person invalidates what its
+cascade removes with one query up front. Code that deletes those rows
+directly invalidates for them itself.
+"""
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from .caching import bump_on_commit, restaurant_versions
+from .middleware import person_context_cache_key
+from .models import (
+    GroupMembership, Person, PersonToppingPreference, PizzaGroup, PizzaRestaurant, RestaurantTopping, Topping,
+)
+from .preferences import preferences_changed
+
+
+@receiver([post_save, post_delete], sender=Person)
+def invalidate_person_context_for_person(sender, instance, **kwargs):
+    if instance.user_account_id:
+        cache.delete(person_context_cache_key(instance.user_account_id))
+
+
+@receiver(post_save, sender=GroupMembership)
+def invalidate_person_context_for_membership(sender, instance, **kwargs):
+    user_id = Person.objects.filter(pk=instance.person_id).values_list('user_account_id', flat=True).first()
+    if user_id:
+        cache.delete(person_context_cache_key(user_id))
+
+
+# ---------------------------------------------------------------------------
+# Fragment cache versions (see webapp.caching)
+# ---------------------------------------------------------------------------
+
+@receiver([post_save, post_delete], sender=Topping)
+def bump_topping_catalog(sender, instance, **kwargs):
+    bump_on_commit('toppings')
+
+
+@receiver(pre_delete, sender=Topping)
+def invalidate_topping_cascade(sender, instance, **kwargs):
+    menus = list(RestaurantTopping.objects.filter(topping=instance).values_list('restaurant_id', 'restaurant__group_id'))
+    bump_on_commit(*restaurant_versions(menus))
+    person_ids = PersonToppingPreference.objects.filter(topping=instance).values_list('person_id', flat=True)
+    preferences_changed(*person_ids)
+
+
+@receiver([post_save, post_delete], sender=PizzaRestaurant)
+def bump_restaurant(sender, instance, **kwargs):
+    names = [f'restaurant:{instance.pk}']
+    if instance.group_id:
+        names.append(f'group-restaurants:{instance.group_id}')
+    bump_on_commit(*names)
+
+
+@receiver(post_save, sender=RestaurantTopping)
+def bump_restaurant_toppings(sender, instance, **kwargs):
+    group_id = PizzaRestaurant.objects.filter(pk=instance.restaurant_id).values_list('group_id', flat=True).first()
+    bump_on_commit(*restaurant_versions([(instance.restaurant_id, group_id)]))
+
+
+@receiver(post_save, sender=PizzaGroup)
+def bump_group(sender, instance, **kwargs):
+    bump_on_commit(f'group-restaurants:{instance.pk}', f'group-members:{instance.pk}')
+
+
+@receiver(pre_delete, sender=PizzaGroup)
+def invalidate_group_cascade(sender, instance, **kwargs):
+    keys = [person_context_cache_key(user_id) for user_id in GroupMembership.objects.filter(
+        group=instance, person__user_account__isnull=False,
+    ).values_list('person__user_account_id', flat=True)]
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+@receiver(post_save, sender=GroupMembership)
+def bump_group_members(sender, instance, **kwargs):
+    bump_on_commit(f'group-members:{instance.group_id}')
+
+
+@receiver(post_save, sender=Person)
+def bump_groups_of_person(sender, instance, **kwargs):
+    bump_on_commit(f'person:{instance.pk}')
+    if instance.guest_for_order_id:
+        return
+    group_ids = GroupMembership.objects.filter(person=instance).values_list('group_id', flat=True)
+    bump_on_commit(*(f'group-members:{group_id}' for group_id in group_ids))
+
+
+@receiver(pre_delete, sender=Person)
+def invalidate_person_cascade(sender, instance, **kwargs):
+    preferences_changed(instance.pk)
+    if instance.guest_for_order_id:
+        return
+    group_ids = GroupMembership.objects.filter(person=instance).values_list('group_id', flat=True)
+    bump_on_commit(*(f'group-members:{group_id}' for group_id in group_ids))
+
+
+# ---------------------------------------------------------------------------
+# Preference matrix cache (see webapp.preferences)
+# ---------------------------------------------------------------------------
+
+@receiver(post_save, sender=PersonToppingPreference)
+def invalidate_person_preferences(sender, instance, **kwargs):
+    preferences_changed(instance.person_id)
@@ -26,15 +26,65 @@ Input:
 Output:
   - A list of saved OrderedPizza objects, each with toppings and people
     M2M relations fully populated in the database.
+
+Small orders (one pizza, or few enough people that every balanced split can
+be tried) are solved exactly in-process by webapp.exact without building the
+ILP or starting CBC. Larger ones go through webapp.presolve first, which
+shrinks the ILP without changing its optimum.
+
+CBC runs get a time limit, thread count and optimality gap from cbc_budget(),
+scaled to the ILP's size and to the order's solve_quality tier.
+
+Views call solve_once() rather than solve() so that concurrent requests for
+the same order (a double-clicked Generate button, two staff recomputing) run
+the solver once and share its result. solve_once() holds no transaction or
+row lock while the solver runs.
 """
 
+import logging
 import math
 import random
+import time
+from datetime import timedelta
 
 import pulp
 from constance import config
-
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import exact, metrics
+from .dbpool import release_idle_connection
+from .governor import solver_slot
 from .models import Order, OrderedPizza, PersonToppingPreference
+from .preferences import load_preferences
+from .presolve import presolve
+
+logger = logging.getLogger(__name__)
+
+# Per solve_quality tier: (base seconds, seconds per 1000 variables, most seconds, gap multiple).
+# The gap multiple scales config.SOLVER_MIP_GAP; exact solves run until CBC proves the optimum.
+SOLVE_BUDGETS = {
+    'fast': (0.5, 0.25, 2, 5),
+    'balanced': (2, 1, 10, 1),
+    'exact': (10, 10, 60, 0),
+}
+# Below this many variables per thread, extra CBC threads cost more to start than they save.
+VARIABLES_PER_THREAD = 2000
+
+# solve_once(): how often a caller waiting on another's solve claim checks it, and the seconds
+# allowed beyond the longest slot wait plus CBC run (reading inputs, presolve, saving).
+CLAIM_POLL_INTERVAL = 0.2
+CLAIM_MARGIN = 30
+
+
+def cbc_budget(quality, num_variables, max_threads):
+    """(time limit in seconds, threads, relative gap) for a CBC run on an ILP of num_variables."""
+    base, per_thousand, most, gap_multiple = SOLVE_BUDGETS[quality]
+    time_limit = min(most, base + per_thousand * num_variables / 1000)
+    threads = max(1, min(max_threads, num_variables // VARIABLES_PER_THREAD))
+    return time_limit, threads, config.SOLVER_MIP_GAP * gap_multiple
 
 
 def _build_prefs(people, toppings):
@@ -47,31 +97,25 @@ def _build_prefs(people, toppings):
     prefs = {}
     allergy_pairs = set()
 
-    existing = {}
-    if people:
-        prefs_qs = PersonToppingPreference.objects.filter(
-            person__in=people,
-            topping__in=toppings,
-        ).values_list('person_id', 'topping_id', 'preference')
-        for person_id, topping_id, pref in prefs_qs:
-            existing[(person_id, topping_id)] = pref
-
-    use_dislike_weight = config.DISLIKE_WEIGHT != PersonToppingPreference.DISLIKE
+    # Always the primary: a solve often follows a guest's join or a profile save straight away,
+    # and a lagging replica could miss those ratings, allergies included.
+    matrix = load_preferences(people, using=DEFAULT_DB_ALIAS)
+    dislike_weight = config.DISLIKE_WEIGHT
+    use_dislike_weight = dislike_weight != PersonToppingPreference.DISLIKE
     for p_idx, person in enumerate(people):
-        default = PersonToppingPreference.DISLIKE if person.unrated_is_dislike else PersonToppingPreference.NEUTRAL
         for t_idx, topping in enumerate(toppings):
-            pref = existing.get((person.id, topping.id), default)
+            pref = matrix.get(person.id, topping.id)
             if pref == PersonToppingPreference.ALLERGY:
                 allergy_pairs.add((p_idx, t_idx))
             elif use_dislike_weight and pref == PersonToppingPreference.DISLIKE:
-                prefs[(p_idx, t_idx)] = config.DISLIKE_WEIGHT
+                prefs[(p_idx, t_idx)] = dislike_weight
             else:
                 prefs[(p_idx, t_idx)] = pref
 
     return prefs, allergy_pairs
 
 
-def solve(order: Order) -> list[OrderedPizza]:
+def solve(order: Order, quality: str | None = None) -> list[OrderedPizza]:
     """
     Run the pizza optimization algorithm for the given order.
 
@@ -82,13 +126,21 @@ def solve(order: Order) -> list[OrderedPizza]:
         order: A saved Order instance with restaurant, people, num_pizzas,
                and optimization_mode populated. Guests are Person objects
                with user_account=None in order.people.
+        quality: solve_quality tier for this run only; defaults to order.solve_quality.
 
     Returns:
         A list of saved OrderedPizza instances with all M2M relations populated.
 
     Raises:
         ValueError: If num_pizzas > num_participants or order configuration is invalid.
+        SolverBusyError: (a ValueError) if no solver slot frees up within SOLVER_QUEUE_TIMEOUT.
     """
+    return _save_pizzas(order, *_plan(order, quality))
+
+
+def _plan(order, quality=None):
+    """Solve the order without writing anything: (people, toppings, [(person indexes, topping indexes)])."""
+    quality = quality or order.solve_quality
     people = list(order.people.all())
     toppings = list(order.restaurant.toppings.all())
     if not config.DETERMINISTIC:
@@ -104,77 +156,107 @@ def solve(order: Order) -> list[OrderedPizza]:
         )
 
     prefs, allergy_pairs = _build_prefs(people, toppings)
+    mode = order.optimization_mode
+    max_toppings = config.MAX_TOPPINGS_PER_PIZZA
+    # shareability_bonus_weight blends assigned-only scoring (w=0) with
+    # group-wide scoring (w=1), normalised by the number of other pizzas.
+    norm_share_weight = order.shareability_bonus_weight / (num_pizzas - 1) if num_pizzas > 1 else 0
+
+    started = time.perf_counter()
+    pizzas = exact.Instance(
+        num_people, num_toppings, prefs, allergy_pairs, num_pizzas, max_toppings, norm_share_weight, mode,
+    ).solve()
+    if pizzas is not None:
+        metrics.observe('pizza_solve_duration_seconds', time.perf_counter() - started, backend='exact', mode=mode)
+        return people, toppings, pizzas
+
+    # Shrink the model first: drop toppings that cannot help, leave indifferent people
+    # out and merge interchangeable toppings. The ILP below is over what is left.
+    started = time.perf_counter()
+    reduced = presolve(num_people, num_toppings, prefs, allergy_pairs, num_pizzas)
+    logger.info("Presolved order %s in %.1fms: %s",
+                order.pk, (time.perf_counter() - started) * 1000, reduced.summary())
+    people_idx = range(len(reduced.people))
+    classes_idx = range(len(reduced.classes))
+    # How many of a class's toppings can go on one pizza; 1 unless toppings were merged.
+    size = [len(members) for members in reduced.classes]
+    num_free = len(reduced.free)
 
     prob = pulp.LpProblem("pizza", pulp.LpMaximize)
 
     # --- Variables ---
 
+    def counter(name, upper):
+        return pulp.LpVariable(name, cat='Binary') if upper == 1 else pulp.LpVariable(
+            name, lowBound=0, upBound=upper, cat='Integer')
+
     assign = {}
     topping_on = {}
+    free_seats = {}
     for k in range(num_pizzas):
         # assign[p,k]: participant p assigned to pizza k
-        for p in range(num_people):
+        for p in people_idx:
             assign[p, k] = pulp.LpVariable(f"assign_{p}_{k}", cat='Binary')
 
-        # topping_on[t,k]: topping t on pizza k
-        for t in range(num_toppings):
-            topping_on[t, k] = pulp.LpVariable(f"topping_on_{t}_{k}", cat='Binary')
+        # topping_on[c,k]: how many toppings of class c are on pizza k
+        for c in classes_idx:
+            topping_on[c, k] = counter(f"topping_on_{c}_{k}", size[c])
+
+        # free_seats[k]: how many indifferent people sit on pizza k
+        free_seats[k] = pulp.LpVariable(f"free_seats_{k}", lowBound=0, upBound=num_free, cat='Integer')
 
-    # pref_active[p,t,k]: linearization of assign[p,k] * topping_on[t,k] - only for LIKE/DISLIKE pairs
+    # pref_active[p,c,k]: linearization of assign[p,k] * topping_on[c,k] - only for LIKE/DISLIKE pairs
     pref_active = {}
-    nonzero_pairs = []
-    for p in range(num_people):
-        for t in range(num_toppings):
-            if prefs.get((p, t), PersonToppingPreference.NEUTRAL) != PersonToppingPreference.NEUTRAL:
-                nonzero_pairs.append((p, t))
-                for k in range(num_pizzas):
-                    pref_active[p, t, k] = pulp.LpVariable(f"pref_active_{p}_{t}_{k}", cat='Binary')
+    nonzero_pairs = sorted(reduced.prefs)
+    for p, c in nonzero_pairs:
+        for k in range(num_pizzas):
+            pref_active[p, c, k] = counter(f"pref_active_{p}_{c}_{k}", size[c])
 
     # --- Hard constraints ---
 
-    # 1. Each participant on exactly one pizza
-    for p in range(num_people):
+    # 1. Each participant on exactly one pizza, and every indifferent participant seated
+    for p in people_idx:
         prob += pulp.lpSum(assign[p, k] for k in range(num_pizzas)) == 1, f"person_{p}_once"
+    prob += pulp.lpSum(free_seats.values()) == num_free, "free_seated"
 
-    # 2. Allergy: participant p cannot be on pizza k if allergic topping t is there
-    for (p, t) in allergy_pairs:
+    # 2. Allergy: participant p cannot be on pizza k if any topping of class c is there
+    for (p, c) in reduced.allergy_pairs:
         for k in range(num_pizzas):
-            prob += assign[p, k] + topping_on[t, k] <= 1, f"allergy_{p}_{t}_{k}"
+            prob += size[c] * assign[p, k] + topping_on[c, k] <= size[c], f"allergy_{p}_{c}_{k}"
 
     # 3. Topping cap: at most MAX_TOPPINGS_PER_PIZZA toppings per pizza
     for k in range(num_pizzas):
-        prob += pulp.lpSum(topping_on[t, k] for t in range(num_toppings)) <= config.MAX_TOPPINGS_PER_PIZZA, f"topping_cap_{k}"
+        prob += pulp.lpSum(topping_on[c, k] for c in classes_idx) <= max_toppings, f"topping_cap_{k}"
 
     # 4. Balanced assignment: each pizza gets floor(P/K) or ceil(P/K) participants
     min_per_pizza, max_per_pizza = num_people // num_pizzas, math.ceil(num_people / num_pizzas)
     for k in range(num_pizzas):
-        prob += pulp.lpSum(assign[p, k] for p in range(num_people)) >= min_per_pizza, f"pizza_{k}_lo"
-        prob += pulp.lpSum(assign[p, k] for p in range(num_people)) <= max_per_pizza, f"pizza_{k}_hi"
+        seated = pulp.lpSum(assign[p, k] for p in people_idx) + free_seats[k]
+        prob += seated >= min_per_pizza, f"pizza_{k}_lo"
+        prob += seated <= max_per_pizza, f"pizza_{k}_hi"
 
     # 5. Symmetry breaking: participant p cannot be on pizza k > p (for p < num_pizzas).
-    for p in range(num_pizzas):
+    for p in range(min(num_pizzas, len(reduced.people))):
         for k in range(p + 1, num_pizzas):
             prob += assign[p, k] == 0, f"sym_{p}_{k}"
 
-    # 6. Linearization constraints: pref_active[p,t,k] = assign[p,k] AND topping_on[t,k]
-    for (p, t) in nonzero_pairs:
+    # 6. Linearization constraints: pref_active[p,c,k] = topping_on[c,k] if assign[p,k] else 0
+    for (p, c) in nonzero_pairs:
         for k in range(num_pizzas):
-            prob += pref_active[p, t, k] <= assign[p, k], f"pref_le_assign_{p}_{t}_{k}"
-            prob += pref_active[p, t, k] <= topping_on[t, k], f"pref_le_topping_{p}_{t}_{k}"
-            prob += pref_active[p, t, k] >= assign[p, k] + topping_on[t, k] - 1, f"pref_ge_{p}_{t}_{k}"
+            prob += pref_active[p, c, k] <= size[c] * assign[p, k], f"pref_le_assign_{p}_{c}_{k}"
+            prob += pref_active[p, c, k] <= topping_on[c, k], f"pref_le_topping_{p}_{c}_{k}"
+            prob += (pref_active[p, c, k] >= topping_on[c, k] - size[c] * (1 - assign[p, k]),
+                     f"pref_ge_{p}_{c}_{k}")
 
     # --- Objective ---
-    # shareability_bonus_weight blends assigned-only scoring (w=0) with
-    # group-wide scoring (w=1). At w=0 this reduces to the standard
-    # prefs[p,t] * pref_active[p,t,k] used by both existing modes.
-    shareability_weight = order.shareability_bonus_weight
-    norm_share_weight = shareability_weight / (num_pizzas - 1) if num_pizzas > 1 else 0
+    # At w=0 this reduces to the standard prefs[p,c] * pref_active[p,c,k]
+    # used by both existing modes.
     pizza_score = {k: pulp.lpSum(
-        prefs[(p, t)] * ((1 - norm_share_weight) * pref_active[p, t, k] + norm_share_weight * topping_on[t, k])
-        for (p, t) in nonzero_pairs
+        reduced.prefs[p, c] * ((1 - norm_share_weight) * pref_active[p, c, k] + norm_share_weight * topping_on[c, k])
+        for (p, c) in nonzero_pairs
     ) for k in range(num_pizzas)}
 
-    if order.optimization_mode == 'minimize_dislikes':
+    if mode == 'minimize_dislikes':
         min_pizza_score = pulp.LpVariable("min_pizza_score", cat='Continuous')
         for k in range(num_pizzas):
             prob += pizza_score[k] >= min_pizza_score, f"min_score_{k}"
@@ -182,20 +264,96 @@ def solve(order: Order) -> list[OrderedPizza]:
     else:
         prob += pulp.lpSum(pizza_score[k] for k in range(num_pizzas))
 
-    prob.solve(pulp.PULP_CBC_CMD(msg=0, threads=4, timeLimit=20))
+    # CBC runs are capped across all workers; a run uses at most the slot's share of the cores.
+    # Nothing here touches the database until the pizzas are saved, so a pooled connection
+    # goes back to the pool while this waits for a slot and runs CBC.
+    release_idle_connection()
+    with solver_slot() as slot:
+        time_limit, threads, gap = cbc_budget(quality, prob.numVariables(), slot.threads)
+        logger.info("Solving order %s (%s): %d variables, %.1fs limit, %d thread(s), gap %g",
+                    order.pk, quality, prob.numVariables(), time_limit, threads, gap)
+        started = time.perf_counter()
+        prob.solve(pulp.PULP_CBC_CMD(msg=0, threads=threads, timeLimit=time_limit, gapRel=gap))
+    metrics.observe('pizza_solve_duration_seconds', time.perf_counter() - started, backend='cbc', mode=mode)
+    metrics.observe('pizza_solve_model_variables', prob.numVariables(), mode=mode)
+    metrics.observe('pizza_solve_model_constraints', prob.numConstraints(), mode=mode)
 
     if prob.sol_status < 1:
         status = pulp.LpStatus[prob.status]
         raise ValueError(f"ILP solver could not find a solution. Status: {status}")
 
     # --- Extract solution ---
-    result = []
-    for k in range(num_pizzas):
-        pizza = OrderedPizza(order=order)
-        pizza.save()
+    return people, toppings, reduced.expand([
+        ([p for p in people_idx if assign[p, k].value() > 0.5],
+         round(free_seats[k].value()),
+         {c: round(topping_on[c, k].value()) for c in classes_idx})
+        for k in range(num_pizzas)
+    ])
+
+
+def _save_pizzas(order, people, toppings, pizzas):
+    """Save pizzas, a list of (person indexes, topping indexes), as the order's OrderedPizzas."""
+    # Three inserts in total, however many pizzas and people the order has.
+    result = OrderedPizza.objects.bulk_create([OrderedPizza(order=order) for _ in pizzas])
+    PizzaPerson = OrderedPizza.people.through
+    PizzaTopping = OrderedPizza.toppings.through
+    PizzaPerson.objects.bulk_create([
+        PizzaPerson(orderedpizza_id=pizza.pk, person_id=people[p].pk)
+        for pizza, (assigned, _) in zip(result, pizzas) for p in assigned
+    ])
+    PizzaTopping.objects.bulk_create([
+        PizzaTopping(orderedpizza_id=pizza.pk, topping_id=toppings[t].pk)
+        for pizza, (_, chosen) in zip(result, pizzas) for t in chosen
+    ])
+    return result
 
-        pizza.people.set([people[p] for p in range(num_people) if assign[p, k].value() > 0.5])
-        pizza.toppings.set([toppings[t] for t in range(num_toppings) if topping_on[t, k].value() > 0.5])
-        result.append(pizza)
 
-    return result
+def _claim_timeout():
+    """Seconds after which a solve claim counts as abandoned: the longest wait for a slot plus the longest CBC run."""
+    return settings.SOLVER_QUEUE_TIMEOUT + max(budget[2] for budget in SOLVE_BUDGETS.values()) + CLAIM_MARGIN
+
+
+def _claim(order_id, claimed_at):
+    """Compare-and-set the order's solve claim; True if this caller now holds it."""
+    free = Q(solving_since__isnull=True) | Q(solving_since__lt=claimed_at - timedelta(seconds=_claim_timeout()))
+    return Order.objects.filter(free, pk=order_id).update(solving_since=claimed_at) == 1
+
+
+def solve_once(order: Order, recompute: bool = False, quality: str | None = None) -> tuple[list[OrderedPizza], bool]:
+    """
+    Single-flight wrapper around solve() for one order.
+
+    A caller first claims the order by setting Order.solving_since with a
+    conditional UPDATE. Concurrent callers for the same order poll until the
+    claim is released, so only one solves at a time on any database backend.
+    A claim older than the longest possible solve counts as abandoned and can
+    be taken over. Whoever holds the claim reuses pizzas that are already
+    there, unless recompute=True; a recompute still reuses the result of
+    another recompute that finished after this call started.
+
+    No transaction or row lock is held while solving: the inputs are read, the
+    solver runs, and the pizzas are then replaced in one short transaction. A
+    failed solve leaves previous results untouched. quality is passed on to
+    solve().
+
+    Returns:
+        (pizzas, reused): the order's pizzas, and whether they came from an
+        earlier or concurrent solve rather than this call.
+    """
+    requested_at = timezone.now()
+    while not _claim(order.pk, claimed_at := timezone.now()):
+        release_idle_connection()
+        time.sleep(CLAIM_POLL_INTERVAL)
+    try:
+        updated_at = Order.objects.filter(pk=order.pk).values_list('updated_at', flat=True).get()
+        existing = list(OrderedPizza.objects.filter(order_id=order.pk))
+        if existing and (not recompute or updated_at >= requested_at):
+            return existing, True
+        planned = _plan(order, quality)
+        with transaction.atomic():
+            OrderedPizza.objects.filter(order_id=order.pk).delete()
+            pizzas = _save_pizzas(order, *planned)
+            Order.objects.filter(pk=order.pk).update(updated_at=timezone.now())
+        return pizzas, False
+    finally:
+        Order.objects.filter(pk=order.pk, solving_since=claimed_at).update(solving_since=None)
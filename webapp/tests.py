@@ -1,18 +1,65 @@
+import contextlib
+import csv
+import json
+import marshal
+import os
+import pstats
+import random
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from constance import config
+from constance.test import override_config
 from django.contrib.auth import get_user_model
-from django.test import TestCase, Client
+from django.contrib.sessions.models import Session
+from django.core.cache import CacheHandler, cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection, connections
+from django.db.models import Count
+from django.db.models.deletion import Collector
+from django.http import Http404, HttpResponse
+from django.test import TestCase as DjangoTestCase, Client, RequestFactory, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 
 from .models import (
     GroupMembership, Person, PizzaGroup, Topping, PizzaRestaurant, RestaurantTopping,
-    PersonToppingPreference, Order, OrderedPizza,
+    PersonToppingPreference, Order, OrderedPizza, RequestProfile,
 )
-from .solver import solve
+from .solver import solve, solve_once
 
 
 # ---------------------------------------------------------------------------
 # Helpers
 # ---------------------------------------------------------------------------
 
+TEST_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'pizza-solver-tests'}}
+
+
+@override_settings(CACHES=TEST_CACHES)
+class TestCase(DjangoTestCase):
+    """Starts every test with an empty cache: cached rows outlive the rolled-back data they describe.
+
+    The cache is a per-process LocMemCache, so clearing it (here, or in commands
+    like seed_scale) never touches the shared cache at CACHE_LOCATION.
+    """
+
+    def __call__(self, result=None):
+        cache.clear()
+        return super().__call__(result)
+
+
 def make_group(name="Test Group"):
     return PizzaGroup.objects.create(name=name)
 
@@ -37,7 +84,7 @@ def make_person(name, unrated_is_dislike=False, prefs=None):
 
 
 def make_order(restaurant, host, people, num_pizzas=1, optimization_mode='maximize_likes',
-               group=None, shareability_bonus_weight=0):
+               group=None, shareability_bonus_weight=0, solve_quality='balanced'):
     if group is None:
         group = make_group()
     order = Order.objects.create(
@@ -45,6 +92,7 @@ def make_order(restaurant, host, people, num_pizzas=1, optimization_mode='maximi
         num_pizzas=num_pizzas,
         optimization_mode=optimization_mode,
         shareability_bonus_weight=shareability_bonus_weight,
+        solve_quality=solve_quality,
         group=group,
     )
     order.people.set(people)
@@ -78,7 +126,6 @@ class PersonToppingPreferenceModelTests(TestCase):
             person=self.person, topping=self.topping,
             preference=PersonToppingPreference.LIKE,
         )
-        from django.db import IntegrityError
         with self.assertRaises(IntegrityError):
             PersonToppingPreference.objects.create(
                 person=self.person, topping=self.topping,
@@ -215,6 +262,24 @@ class NewOrderViewTests(TestCase):
         order = Order.objects.get()
         self.assertAlmostEqual(order.shareability_bonus_weight, 0.3)
 
+    def test_exact_quality_is_staff_only(self):
+        data = {
+            'restaurant': self.restaurant.pk,
+            'people': [self.bob.pk],
+            'num_pizzas': 1,
+            'optimization_mode': 'maximize_likes',
+            'shareability_bonus_weight': '0',
+            'solve_quality': 'exact',
+        }
+        response = self.client.post(self._new_order_url(), data=data)
+        self.assertEqual(response.status_code, 200)
+        self.assertFormError(response.context['form'], 'solve_quality', "Only staff can request an exact solve.")
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.post(self._new_order_url(), data=data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Order.objects.get().solve_quality, 'exact')
+
     def test_invite_guests_creates_proto_order_and_redirects_to_draft(self):
         response = self.client.post(self._new_order_url(), data={
             'restaurant': self.restaurant.pk,
@@ -244,7 +309,6 @@ class DraftOrderViewTests(TestCase):
         GroupMembership.objects.create(group=self.group, person=self.alice, is_admin=True)
         GroupMembership.objects.create(group=self.group, person=self.bob)
         self.client.force_login(self.user)
-        import uuid
         self.proto_order = Order.objects.create(
             host=self.alice, group=self.group, restaurant=self.restaurant,
             num_pizzas=1, optimization_mode='maximize_likes', invite_token=uuid.uuid4(),
@@ -269,6 +333,17 @@ class DraftOrderViewTests(TestCase):
         self.assertEqual(response.status_code, 302)
         self.assertIn('/results/', response['Location'])
 
+    def test_double_submit_does_not_duplicate_pizzas(self):
+        data = {
+            'people': [self.bob.pk],
+            'num_pizzas': 1,
+            'optimization_mode': 'maximize_likes',
+            'shareability_bonus_weight': '0',
+        }
+        self.client.post(self._draft_url(), data=data)
+        self.client.post(self._draft_url(), data=data)
+        self.assertEqual(self.proto_order.pizzas.count(), 1)
+
     def test_draft_order_solved_redirects_to_results(self):
         pizza = OrderedPizza.objects.create(order=self.proto_order)
         pizza.people.set([self.alice])
@@ -321,6 +396,88 @@ class OrderResultsViewTests(TestCase):
         self.assertEqual(response.status_code, 404)
 
 
+class OrderJoinViewTests(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.t_pep, self.t_mush = Topping.objects.create(name="Pepperoni"), Topping.objects.create(name="Mushroom")
+        self.group = make_group()
+        self.restaurant = make_restaurant(toppings=[self.t_pep, self.t_mush], group=self.group)
+        self.host = make_person("Host")
+        self.order = make_order(self.restaurant, self.host, [self.host], group=self.group)
+        self.order.invite_token = uuid.uuid4()
+        self.order.save()
+        self.url = reverse('order_join', args=[self.order.invite_token])
+
+    def test_get_join_page_returns_200(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Pepperoni")
+
+    def test_post_creates_guest_with_preferences(self):
+        response = self.client.post(self.url, data={
+            'name': 'Gina',
+            f'pref_{self.t_pep.pk}': str(PersonToppingPreference.LIKE),
+            f'pref_{self.t_mush.pk}': str(PersonToppingPreference.ALLERGY),
+        })
+        self.assertRedirects(response, self.url)
+        guest = Person.objects.get(guest_for_order=self.order)
+        self.assertIn(guest, self.order.people.all())
+        self.assertEqual(
+            dict(guest.topping_preferences.values_list('topping_id', 'preference')),
+            {self.t_pep.pk: PersonToppingPreference.LIKE, self.t_mush.pk: PersonToppingPreference.ALLERGY},
+        )
+
+    def test_repeat_post_reuses_guest_from_cookie(self):
+        self.client.post(self.url, data={'name': 'Gina'})
+        self.client.post(self.url, data={f'pref_{self.t_pep.pk}': str(PersonToppingPreference.DISLIKE)})
+        self.assertEqual(Person.objects.filter(guest_for_order=self.order).count(), 1)
+        response = self.client.get(self.url)
+        self.assertContains(response, "Welcome back")
+
+    def test_guest_join_writes_no_session_rows(self):
+        response = self.client.post(self.url, data={'name': 'Gina'})
+        cookie = response.cookies[f'guest_{self.order.pk}']
+        self.assertEqual(cookie['path'], self.url)
+        self.assertTrue(cookie['httponly'])
+        self.assertFalse(Session.objects.exists())
+
+    def test_tampered_or_foreign_guest_cookie_is_ignored(self):
+        self.client.post(self.url, data={'name': 'Gina'})
+        name = f'guest_{self.order.pk}'
+        value = self.client.cookies[name].value
+        # Pointing the signed value at another person breaks the signature.
+        self.client.cookies[name] = value.replace(value.split(':')[0], str(self.host.pk), 1)
+        self.assertNotContains(self.client.get(self.url), "Welcome back")
+        # A valid cookie for one order is not accepted by another order's join page.
+        other = make_order(self.restaurant, self.host, [self.host], group=self.group)
+        other.invite_token = uuid.uuid4()
+        other.save()
+        other_url = reverse('order_join', args=[other.invite_token])
+        self.client.cookies[f'guest_{other.pk}'] = value
+        self.assertNotContains(self.client.get(other_url), "Welcome back")
+
+    def test_post_without_name_shows_error(self):
+        response = self.client.post(self.url, data={'name': ''})
+        self.assertContains(response, "Please enter your name.")
+        self.assertFalse(Person.objects.filter(guest_for_order=self.order).exists())
+
+    def test_solved_order_rejects_guests(self):
+        OrderedPizza.objects.create(order=self.order)
+        response = self.client.get(self.url)
+        self.assertContains(response, "already been completed")
+
+    def test_people_partial_lists_guests_for_host(self):
+        user = get_user_model().objects.create_user(username="host", email="host@test.com", password="testpass")
+        self.host.user_account = user
+        self.host.save()
+        GroupMembership.objects.create(group=self.group, person=self.host, is_admin=True)
+        self.client.post(self.url, data={'name': 'Gina'})
+        self.client.force_login(user)
+        response = self.client.get(reverse('order_people_partial', args=[self.order.pk]))
+        self.assertContains(response, "Gina")
+        self.assertContains(response, "(guest)")
+
+
 # ---------------------------------------------------------------------------
 # Solver tests
 # ---------------------------------------------------------------------------
@@ -541,3 +698,1479 @@ class SolverTests(TestCase):
         bob_pizza_yes = next(p for p in pizzas_yes if bob in p.people.all())
         self.assertIn(t1.id, set(bob_pizza_yes.toppings.values_list('id', flat=True)),
                       "With shareability, Alice's non-assigned like should put T1 on Bob's pizza")
+
+
+class ExactSolverTests(TestCase):
+    """Small orders are solved in-process, to the same optimum as the ILP."""
+
+    def test_single_pizza_takes_best_safe_toppings_without_cbc(self):
+        liked, allergen, niche, disliked, extra = [
+            Topping.objects.create(name=n) for n in ("Liked", "Allergen", "Niche", "Disliked", "Extra")
+        ]
+        restaurant = make_restaurant(toppings=[liked, allergen, niche, disliked, extra])
+        L, D, A = PersonToppingPreference.LIKE, PersonToppingPreference.DISLIKE, PersonToppingPreference.ALLERGY
+        people = [
+            make_person("Ann", prefs={liked: L, allergen: L, niche: L, disliked: D}),
+            make_person("Ben", prefs={liked: L, allergen: L, disliked: D}),
+            make_person("Cat", prefs={allergen: A, disliked: D}),
+        ]
+        order = make_order(restaurant, people[0], people, num_pizzas=1)
+        with mock.patch('webapp.solver.pulp.LpProblem.solve', side_effect=AssertionError("CBC was started")):
+            pizza, = solve(order)
+        self.assertEqual(set(pizza.toppings.all()), {liked, niche})
+        self.assertEqual(pizza.people.count(), 3)
+
+    def _objective(self, order):
+        from .exact import Instance
+        from .solver import _build_prefs
+        people = list(order.people.all())
+        toppings = list(order.restaurant.toppings.all())
+        prefs, allergy_pairs = _build_prefs(people, toppings)
+        person_index = {p.pk: i for i, p in enumerate(people)}
+        topping_index = {t.pk: i for i, t in enumerate(toppings)}
+        pizzas = [
+            ([person_index[pk] for pk in pizza.people.values_list('pk', flat=True)],
+             [topping_index[pk] for pk in pizza.toppings.values_list('pk', flat=True)])
+            for pizza in order.pizzas.all()
+        ]
+        for assigned, chosen in pizzas:
+            self.assertFalse({(p, t) for p in assigned for t in chosen} & allergy_pairs)
+            self.assertIn(len(assigned), {len(people) // order.num_pizzas, -(-len(people) // order.num_pizzas)})
+        share = order.shareability_bonus_weight / (order.num_pizzas - 1)
+        instance = Instance(len(people), len(toppings), prefs, allergy_pairs, order.num_pizzas,
+                            config.MAX_TOPPINGS_PER_PIZZA, share, order.optimization_mode)
+        return instance.value(pizzas)
+
+    def test_matches_ilp_optimum_on_small_orders(self):
+        rng = random.Random(7)
+        toppings = [Topping.objects.create(name=f"Random {i}") for i in range(10)]
+        restaurant = make_restaurant(toppings=toppings)
+        values = [PersonToppingPreference.ALLERGY] + [PersonToppingPreference.DISLIKE] * 3 + \
+            [PersonToppingPreference.NEUTRAL] * 3 + [PersonToppingPreference.LIKE] * 4
+        people = [make_person(f"Random {i}", prefs={t: rng.choice(values) for t in toppings}) for i in range(7)]
+        for num_pizzas, mode, share in [
+            (2, 'maximize_likes', 0), (2, 'minimize_dislikes', 0), (3, 'maximize_likes', 0.5),
+            (3, 'minimize_dislikes', 0), (4, 'minimize_dislikes', 0.8),
+        ]:
+            with self.subTest(num_pizzas=num_pizzas, mode=mode, share=share):
+                order = make_order(restaurant, people[0], people, num_pizzas=num_pizzas,
+                                   optimization_mode=mode, shareability_bonus_weight=share,
+                                   solve_quality='exact')
+                solve(order)
+                fast = self._objective(order)
+                order.pizzas.all().delete()
+                with mock.patch('webapp.exact.MAX_PARTITIONS', 0):
+                    solve(order)
+                self.assertAlmostEqual(fast, self._objective(order))
+
+    def test_presolved_ilp_matches_optimum(self):
+        L, D, A = PersonToppingPreference.LIKE, PersonToppingPreference.DISLIKE, PersonToppingPreference.ALLERGY
+        ham, bacon, olive, anchovy, onion = [
+            Topping.objects.create(name=n) for n in ("PreHam", "PreBacon", "PreOlive", "PreAnchovy", "PreOnion")
+        ]
+        restaurant = make_restaurant(toppings=[ham, bacon, olive, anchovy, onion])
+        people = [
+            make_person("PreMeat1", prefs={ham: L, bacon: L, olive: D}),
+            make_person("PreMeat2", prefs={ham: L, bacon: L, anchovy: A}),
+            make_person("PreVeg1", prefs={ham: D, bacon: D, olive: L, anchovy: A}),
+            make_person("PreVeg2", prefs={ham: D, bacon: D, olive: L, onion: D}),
+            make_person("PreNone1"),
+            make_person("PreNone2", prefs={anchovy: D}),
+            make_person("PreNone3"),
+        ]
+        for mode, share in [('maximize_likes', 0), ('minimize_dislikes', 0), ('maximize_likes', 0.5)]:
+            with self.subTest(mode=mode, share=share):
+                order = make_order(restaurant, people[0], people, num_pizzas=2,
+                                   optimization_mode=mode, shareability_bonus_weight=share,
+                                   solve_quality='exact')
+                solve(order)
+                fast = self._objective(order)
+                order.pizzas.all().delete()
+                with mock.patch('webapp.exact.MAX_PARTITIONS', 0):
+                    pizzas = solve(order)
+                self.assertAlmostEqual(fast, self._objective(order))
+                self.assertEqual(sum(pizza.people.count() for pizza in pizzas), len(people))
+
+    def test_large_orders_fall_back_to_ilp(self):
+        from .exact import Instance
+        self.assertIsNone(Instance(16, 5, {}, set(), 4, 3, 0, 'maximize_likes').solve())
+        self.assertIsNone(Instance(14, 5, {}, set(), 2, 3, 0, 'maximize_likes').solve())
+        self.assertIsNotNone(Instance(400, 5, {}, set(), 1, 3, 0, 'maximize_likes').solve())
+
+
+class PresolveTests(TestCase):
+    def test_reductions(self):
+        from .presolve import presolve
+        # Toppings: 0 liked, 1 same column as 0, 2 only disliked, 3 two of four allergic, 4 liked by person 3.
+        prefs = {(0, 0): 1, (0, 1): 1, (1, 2): -1, (2, 3): 1, (3, 4): 1, (3, 0): -1, (3, 1): -1}
+        reduced = presolve(4, 5, prefs, {(0, 3), (1, 3)}, 2)
+        self.assertEqual(reduced.stats, {'people': 4, 'toppings': 5, 'unplaceable': 0, 'unliked': 1, 'merged': 1})
+        self.assertEqual(reduced.classes, [[0, 1], [3], [4]])
+        self.assertEqual(reduced.people, [0, 1, 2, 3])
+        # A third allergy leaves topping 3 unplaceable, and people 1 and 2 with no say in anything left.
+        reduced = presolve(4, 5, prefs, {(0, 3), (1, 3), (2, 3)}, 2)
+        self.assertEqual(reduced.stats['unplaceable'], 1)
+        self.assertEqual((reduced.people, reduced.free), ([0, 3], [1, 2]))
+        self.assertEqual(reduced.expand([([0], 1, {0: 2}), ([1], 1, {1: 1})]), [([0, 1], [0, 1]), ([3, 2], [4])])
+
+
+class SolveOnceTests(TestCase):
+    def setUp(self):
+        self.topping = Topping.objects.create(name="OnceTop")
+        self.restaurant = make_restaurant(name="Once Restaurant", toppings=[self.topping])
+        self.alice = make_person("AliceOnce", prefs={self.topping: PersonToppingPreference.LIKE})
+        self.bob = make_person("BobOnce")
+        self.order = make_order(self.restaurant, self.alice, [self.alice, self.bob], num_pizzas=2)
+
+    def test_second_call_reuses_existing_pizzas(self):
+        first, reused_first = solve_once(self.order)
+        second, reused_second = solve_once(self.order)
+        self.assertFalse(reused_first)
+        self.assertTrue(reused_second)
+        self.assertCountEqual([p.pk for p in first], [p.pk for p in second])
+        self.assertEqual(self.order.pizzas.count(), 2)
+
+    def test_recompute_replaces_pizzas_without_duplicates(self):
+        first, _ = solve_once(self.order)
+        second, reused = solve_once(self.order, recompute=True)
+        self.assertFalse(reused)
+        self.assertEqual(self.order.pizzas.count(), 2)
+        self.assertTrue(set(p.pk for p in first).isdisjoint(p.pk for p in second))
+
+    def test_failed_recompute_keeps_previous_results(self):
+        solve_once(self.order)
+        Order.objects.filter(pk=self.order.pk).update(num_pizzas=5)
+        self.order.refresh_from_db()
+        with self.assertRaises(ValueError):
+            solve_once(self.order, recompute=True)
+        self.assertEqual(self.order.pizzas.count(), 2)
+        self.assertIsNone(Order.objects.get(pk=self.order.pk).solving_since)
+
+    def test_waits_for_a_claimed_solve_and_reuses_its_result(self):
+        Order.objects.filter(pk=self.order.pk).update(solving_since=timezone.now())
+
+        def other_solve_finishes(seconds):
+            solve(self.order)
+            Order.objects.filter(pk=self.order.pk).update(solving_since=None)
+
+        with mock.patch('webapp.solver.time.sleep', side_effect=other_solve_finishes) as sleep:
+            pizzas, reused = solve_once(self.order)
+        self.assertEqual(sleep.call_count, 1)
+        self.assertTrue(reused)
+        self.assertEqual(len(pizzas), 2)
+
+    def test_abandoned_claim_is_taken_over(self):
+        from .solver import _claim_timeout
+        stale = timezone.now() - timedelta(seconds=_claim_timeout() + 1)
+        Order.objects.filter(pk=self.order.pk).update(solving_since=stale)
+        with mock.patch('webapp.solver.time.sleep') as sleep:
+            _, reused = solve_once(self.order)
+        sleep.assert_not_called()
+        self.assertFalse(reused)
+        self.assertIsNone(Order.objects.get(pk=self.order.pk).solving_since)
+
+    def test_solves_outside_any_transaction(self):
+        from . import solver
+        depth = len(connection.atomic_blocks)
+        plan = solver._plan
+
+        def checked_plan(*args):
+            self.assertEqual(len(connection.atomic_blocks), depth)
+            return plan(*args)
+
+        with mock.patch('webapp.solver._plan', side_effect=checked_plan):
+            solve_once(self.order)
+        self.assertEqual(self.order.pizzas.count(), 2)
+
+    def test_recompute_exactly_applies_to_that_run_only(self):
+        from .solver import cbc_budget
+        staff = get_user_model().objects.create_user(
+            username="staff", email="staff@test.com", password="testpass", is_staff=True,
+        )
+        self.client.force_login(staff)
+        solve_once(self.order)
+        url = reverse('order_recompute', args=[self.order.pk])
+        with mock.patch('webapp.exact.MAX_PARTITIONS', 0), \
+                mock.patch('webapp.solver.cbc_budget', wraps=cbc_budget) as budget:
+            self.client.post(url, {'solve_quality': 'exact'})
+            self.client.post(url)
+        self.assertEqual([c.args[0] for c in budget.call_args_list], ['exact', 'balanced'])
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.solve_quality, 'balanced')
+
+
+@override_settings(CACHES=TEST_CACHES)
+class SolveOnceRaceTests(TransactionTestCase):
+    """Two requests for one order at once, each on its own connection, as under a real server."""
+
+    def test_concurrent_calls_solve_once(self):
+        from . import solver
+        topping = Topping.objects.create(name="RaceTop")
+        restaurant = make_restaurant(name="Race Restaurant", toppings=[topping])
+        alice = make_person("AliceRace", prefs={topping: PersonToppingPreference.LIKE})
+        order = make_order(restaurant, alice, [alice, make_person("BobRace")], num_pizzas=2)
+        plan, plans, results = solver._plan, [], []
+        barrier = threading.Barrier(2)
+
+        def slow_plan(*args):
+            plans.append(1)
+            time.sleep(0.5)  # the other caller claims, finds the claim taken, and waits
+            return plan(*args)
+
+        def request():
+            try:
+                barrier.wait()
+                results.append(solve_once(Order.objects.get(pk=order.pk)))
+            finally:
+                connection.close()
+
+        with mock.patch('webapp.solver._plan', side_effect=slow_plan):
+            threads = [threading.Thread(target=request) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(plans), 1)
+        self.assertEqual(sorted(reused for _, reused in results), [False, True])
+        self.assertEqual(OrderedPizza.objects.filter(order=order).count(), 2)
+        self.assertIsNone(Order.objects.get(pk=order.pk).solving_since)
+
+
+# ---------------------------------------------------------------------------
+# Solver governor tests
+# ---------------------------------------------------------------------------
+
+class SolverGovernorTests(TestCase):
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+        self.override = override_settings(SOLVER_MAX_CONCURRENT=1, SOLVER_LOCK_DIR=self.lock_dir)
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.lock_dir, ignore_errors=True)
+
+    def test_slot_reports_thread_budget(self):
+        from .governor import available_cores, solver_slot
+        with solver_slot() as slot:
+            self.assertEqual(slot.threads, available_cores())
+            self.assertEqual(slot.index, 0)
+
+    def test_second_solve_times_out_while_slot_held(self):
+        from .governor import SolverBusyError, solver_slot, stats
+        with solver_slot():
+            self.assertEqual(stats()['active'], 1)
+            with self.assertRaises(SolverBusyError):
+                with solver_slot(timeout=0.1):
+                    pass
+        self.assertEqual(stats(), {'max_concurrent': 1, 'active': 0, 'queue_depth': 0})
+
+    def test_stats_is_read_only_and_ignores_dead_workers(self):
+        from .governor import SolverBusyError, solver_slot, stats
+        dead = subprocess.Popen(['true'])
+        dead.wait()
+        live_marker, dead_marker = f'wait-{os.getpid()}-live', f'wait-{dead.pid}-dead'
+        for name in (live_marker, dead_marker):
+            open(os.path.join(self.lock_dir, name), 'w').close()
+        with open(os.path.join(self.lock_dir, 'slot-0'), 'w') as f:
+            f.write(str(dead.pid))
+        with mock.patch('webapp.governor.fcntl.flock') as flock:
+            self.assertEqual(stats(), {'max_concurrent': 1, 'active': 0, 'queue_depth': 1})
+        flock.assert_not_called()
+        self.assertEqual(set(os.listdir(self.lock_dir)), {'slot-0', live_marker, dead_marker})
+        with solver_slot():
+            self.assertEqual(stats()['active'], 1)
+            with self.assertRaises(SolverBusyError):
+                with solver_slot(timeout=0.1):
+                    pass
+        self.assertEqual(set(os.listdir(self.lock_dir)), {'slot-0', live_marker})
+        self.assertEqual(stats()['active'], 0)
+
+    def test_cbc_budget_scales_with_model_size_and_tier(self):
+        from .solver import cbc_budget
+        with override_config(SOLVER_MIP_GAP=0.02):
+            self.assertEqual(cbc_budget('balanced', 200, 8), (2.2, 1, 0.02))
+            self.assertEqual(cbc_budget('balanced', 50000, 8), (10, 8, 0.02))
+            self.assertEqual(cbc_budget('fast', 5000, 8), (1.75, 2, 0.1))
+            self.assertEqual(cbc_budget('exact', 50000, 4), (60, 4, 0))
+
+    def test_busy_solver_surfaces_as_solver_error(self):
+        from .governor import solver_slot
+        t = Topping.objects.create(name="BusyTop")
+        restaurant = make_restaurant(name="Busy Restaurant", toppings=[t])
+        alice = make_person("AliceBusy")
+        bob = make_person("BobBusy")
+        order = make_order(restaurant, alice, [alice, bob], num_pizzas=2)
+        with override_settings(SOLVER_QUEUE_TIMEOUT=0.1), solver_slot(), mock.patch('webapp.exact.MAX_PARTITIONS', 0):
+            with self.assertRaises(ValueError):
+                solve(order)
+
+
+# ---------------------------------------------------------------------------
+# Person context middleware tests
+# ---------------------------------------------------------------------------
+
+class PersonContextTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="ctx", email="ctx@test.com", password="testpass")
+        self.person = make_person("Ctx")
+        self.person.user_account = self.user
+        self.person.save()
+        self.group = make_group()
+        GroupMembership.objects.create(group=self.group, person=self.person, is_admin=True)
+
+    def _context(self):
+        from .middleware import PersonContext
+        request = RequestFactory().get('/')
+        request.user = self.user
+        return PersonContext(request)
+
+    def test_person_and_memberships_resolved_once(self):
+        ctx = self._context()
+        with self.assertNumQueries(2):
+            self.assertEqual(ctx.person, self.person)
+            self.assertTrue(ctx.is_admin(self.group.pk))
+            self.assertEqual(ctx.group_ids, {self.group.pk})
+            self.assertEqual(ctx.person, self.person)
+
+    def test_require_member_raises_404_for_other_groups(self):
+        with self.assertRaises(Http404):
+            self._context().require_member(make_group("Other").pk)
+
+    def test_cached_context_is_invalidated_by_membership_change(self):
+        with override_settings(PERSON_CONTEXT_CACHE_TIMEOUT=60):
+            self.assertEqual(self._context().group_ids, {self.group.pk})
+            with self.assertNumQueries(0):
+                self.assertEqual(self._context().group_ids, {self.group.pk})
+            other = make_group("Other")
+            GroupMembership.objects.create(group=other, person=self.person)
+            self.assertEqual(self._context().group_ids, {self.group.pk, other.pk})
+
+
+# ---------------------------------------------------------------------------
+# Fragment cache tests
+# ---------------------------------------------------------------------------
+
+class FragmentCacheTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username="cache", email="cache@test.com", password="testpass", is_staff=True,
+        )
+        self.person = make_person("Cache")
+        self.person.user_account = self.user
+        self.person.save()
+        self.group = make_group("Cache Group")
+        GroupMembership.objects.create(group=self.group, person=self.person, is_admin=True)
+        self.client.force_login(self.user)
+
+    def _queries_for(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, len(ctx)
+
+    def test_topping_list_served_from_cache_until_catalog_changes(self):
+        Topping.objects.create(name="Anchovy")
+        _, first = self._queries_for(reverse('topping_list'))
+        response, second = self._queries_for(reverse('topping_list'))
+        self.assertLess(second, first)
+        self.assertContains(response, "Anchovy")
+        with self.captureOnCommitCallbacks(execute=True):
+            Topping.objects.create(name="Basil")
+        response, _ = self._queries_for(reverse('topping_list'))
+        self.assertContains(response, "Basil")
+
+    def test_group_detail_reflects_new_member(self):
+        url = reverse('group_detail', args=[self.group.pk])
+        self._queries_for(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            GroupMembership.objects.create(group=self.group, person=make_person("Newbie"))
+        response, _ = self._queries_for(url)
+        self.assertContains(response, "Newbie")
+        self.assertContains(response, 'form="remove-member-form"')
+
+    def test_restaurant_list_reflects_topping_changes(self):
+        t = Topping.objects.create(name="Olive")
+        restaurant = make_restaurant(name="Cached Pizza", group=self.group)
+        response, _ = self._queries_for(reverse('restaurant_list'))
+        self.assertContains(response, "<td>0</td>", html=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            RestaurantTopping.objects.create(restaurant=restaurant, topping=t)
+        response, _ = self._queries_for(reverse('restaurant_list'))
+        self.assertContains(response, "<td>1</td>", html=True)
+
+    def test_restaurant_edit_bumps_menu_version_after_its_rows_commit(self):
+        from .caching import get_versions
+        olive, ham = Topping.objects.create(name="Olive"), Topping.objects.create(name="Ham")
+        restaurant = make_restaurant(name="Edited Pizza", toppings=[olive], group=self.group)
+        names = [f'restaurant:{restaurant.pk}', f'group-restaurants:{self.group.pk}']
+        before = get_versions(*names)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post(reverse('restaurant_edit', args=[restaurant.pk]), {
+                'name': "Edited Pizza", 'toppings': [olive.pk, ham.pk],
+            })
+            self.assertEqual(get_versions(*names), before)
+        for callback in callbacks:
+            callback()
+        self.assertTrue(all(v != before[name] for name, v in get_versions(*names).items()))
+        response, _ = self._queries_for(reverse('restaurant_list'))
+        self.assertContains(response, "<td>2</td>", html=True)
+
+    def test_order_results_rebuilt_after_recompute(self):
+        t = Topping.objects.create(name="CacheTop")
+        PersonToppingPreference.objects.create(person=self.person, topping=t, preference=PersonToppingPreference.LIKE)
+        restaurant = make_restaurant(name="Results Pizza", toppings=[t], group=self.group)
+        order = make_order(restaurant, self.person, [self.person], group=self.group)
+        solve_once(order)
+        url = reverse('order_results', args=[order.pk])
+        _, first = self._queries_for(url)
+        _, second = self._queries_for(url)
+        self.assertLess(second, first)
+        Topping.objects.filter(pk=t.pk).update(name="RenamedTop")
+        solve_once(order, recompute=True)
+        response, _ = self._queries_for(url)
+        self.assertContains(response, "RenamedTop")
+
+    def test_order_results_reflect_preference_and_weight_changes(self):
+        t = Topping.objects.create(name="ScoreTop")
+        pref = PersonToppingPreference.objects.create(
+            person=self.person, topping=t, preference=PersonToppingPreference.LIKE,
+        )
+        restaurant = make_restaurant(name="Score Pizza", toppings=[t], group=self.group)
+        order = make_order(restaurant, self.person, [self.person], group=self.group)
+        solve_once(order)
+        url = reverse('order_results', args=[order.pk])
+        self.assertContains(self._queries_for(url)[0], "Score: 1")
+        pref.preference = PersonToppingPreference.DISLIKE
+        with self.captureOnCommitCallbacks(execute=True):
+            pref.save()
+        self.assertContains(self._queries_for(url)[0], "Score: -1")
+        with override_config(DISLIKE_WEIGHT=-2.5):
+            self.assertContains(self._queries_for(url)[0], "Score: -2.5")
+        self.person.name = "Renamed Cache"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.person.save()
+        self.assertContains(self._queries_for(url)[0], "Renamed Cache")
+        restaurant.name = "Renamed Pizza"
+        with self.captureOnCommitCallbacks(execute=True):
+            restaurant.save()
+        self.assertContains(self._queries_for(url)[0], "<strong>Restaurant:</strong>&nbsp;Renamed Pizza")
+
+    def test_shared_cache_keeps_more_than_the_default_300_entries(self):
+        from pizza_solver import settings as project_settings
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        shared = CacheHandler({'default': {**project_settings.CACHES['default'], 'LOCATION': location}})['default']
+        shared.set_many({f'version:person:{pk}': pk for pk in range(400)}, None)
+        self.assertEqual(shared.get('version:person:0'), 0)
+
+
+# ---------------------------------------------------------------------------
+# Preference cache tests
+# ---------------------------------------------------------------------------
+
+class PreferenceCacheTests(TestCase):
+    def setUp(self):
+        self.t_pep = Topping.objects.create(name="Pepperoni")
+        self.t_olive = Topping.objects.create(name="Olive")
+        self.alice = make_person("Alice", prefs={self.t_pep: PersonToppingPreference.LIKE})
+        self.bob = make_person("Bob", unrated_is_dislike=True)
+
+    def test_defaults_applied_and_served_from_cache(self):
+        from .preferences import load_preferences
+        with self.assertNumQueries(1):
+            matrix = load_preferences([self.alice, self.bob])
+        self.assertEqual(matrix.get(self.alice.pk, self.t_pep.pk), PersonToppingPreference.LIKE)
+        self.assertEqual(matrix.get(self.alice.pk, self.t_olive.pk), PersonToppingPreference.NEUTRAL)
+        self.assertEqual(matrix.get(self.bob.pk, self.t_olive.pk), PersonToppingPreference.DISLIKE)
+        self.assertIsNone(matrix.explicit(self.bob.pk, self.t_olive.pk))
+        with self.assertNumQueries(0):
+            load_preferences([self.alice, self.bob])
+
+    def test_saved_preference_invalidates_entry(self):
+        from .preferences import load_preferences
+        load_preferences([self.alice])
+        with self.captureOnCommitCallbacks(execute=True):
+            PersonToppingPreference.objects.create(
+                person=self.alice, topping=self.t_olive, preference=PersonToppingPreference.ALLERGY,
+            )
+        matrix = load_preferences([self.alice])
+        self.assertEqual(matrix.get(self.alice.pk, self.t_olive.pk), PersonToppingPreference.ALLERGY)
+
+    def test_topping_delete_invalidates_its_raters_once(self):
+        from .preferences import load_preferences
+        queries = []
+        for n in (1, 6):
+            topping = Topping.objects.create(name=f"Doomed {n}")
+            people = [make_person(f"Rater {n}-{i}", prefs={topping: PersonToppingPreference.LIKE}) for i in range(n)]
+            group = make_group(f"Doomed {n}")
+            for i in range(n):
+                make_restaurant(name=f"Doomed Pizza {n}-{i}", toppings=[topping], group=group)
+            load_preferences(people)
+            with mock.patch('webapp.preferences._refresh') as refresh, \
+                    self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as ctx:
+                topping.delete()
+            refresh.assert_called_once()
+            self.assertLessEqual({p.pk for p in people}, refresh.call_args.args[0])
+            queries.append(len(ctx))
+        # The cascade deletes each table's rows in one statement, however many there are.
+        self.assertEqual(queries[0], queries[1])
+        collector = Collector(using='default')
+        for model in (PersonToppingPreference, RestaurantTopping, GroupMembership):
+            self.assertTrue(collector.can_fast_delete(model.objects.all()), model)
+
+    def test_miss_racing_a_write_does_not_cache_old_ratings(self):
+        from . import preferences
+        read_rows = preferences.read_rows
+
+        def read_then_write(person_ids, using=None):
+            rows = read_rows(person_ids, using)
+            # Another request writes and commits between this miss's read and its cache set.
+            with self.captureOnCommitCallbacks(execute=True):
+                PersonToppingPreference.objects.create(
+                    person=self.alice, topping=self.t_olive, preference=PersonToppingPreference.ALLERGY,
+                )
+            return rows
+
+        with mock.patch('webapp.preferences.read_rows', read_then_write):
+            self.assertIsNone(preferences.load_preferences([self.alice]).explicit(self.alice.pk, self.t_olive.pk))
+        matrix = preferences.load_preferences([self.alice])
+        self.assertEqual(matrix.get(self.alice.pk, self.t_olive.pk), PersonToppingPreference.ALLERGY)
+
+    def test_invalidation_waits_for_commit(self):
+        from .preferences import load_preferences
+        load_preferences([self.alice])
+        with self.captureOnCommitCallbacks() as callbacks:
+            PersonToppingPreference.objects.create(
+                person=self.alice, topping=self.t_olive, preference=PersonToppingPreference.ALLERGY,
+            )
+            # Not committed yet: a reader here is served the cached, committed ratings.
+            with self.assertNumQueries(0):
+                load_preferences([self.alice])
+        self.assertEqual(len(callbacks), 1)
+
+    def test_profile_edit_bulk_write_invalidates_entry(self):
+        from .preferences import load_preferences
+        user = get_user_model().objects.create_user(username="alice", email="alice@test.com", password="testpass")
+        self.alice.user_account = user
+        self.alice.save()
+        load_preferences([self.alice])
+        self.client.force_login(user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('profile_edit'), data={
+                'name': 'Alice', 'email': 'alice@test.com',
+                f'pref_{self.t_pep.pk}': 'dislike', f'pref_{self.t_olive.pk}': 'like',
+            })
+        matrix = load_preferences([self.alice])
+        self.assertEqual(matrix.get(self.alice.pk, self.t_pep.pk), PersonToppingPreference.DISLIKE)
+        self.assertEqual(matrix.get(self.alice.pk, self.t_olive.pk), PersonToppingPreference.LIKE)
+
+
+class PackedPreferenceTests(TestCase):
+    def setUp(self):
+        self.override = override_settings(PACKED_PREFERENCES=True)
+        self.override.enable()
+        self.addCleanup(self.override.disable)
+        self.t_pep = Topping.objects.create(name="Pepperoni")
+        self.t_olive = Topping.objects.create(name="Olive")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice = make_person("Alice", prefs={
+                self.t_pep: PersonToppingPreference.LIKE, self.t_olive: PersonToppingPreference.ALLERGY,
+            })
+
+    def test_pack_round_trip(self):
+        from .preferences import pack_codes, unpack_codes
+        ratings = {3: PersonToppingPreference.ALLERGY, 7: PersonToppingPreference.NEUTRAL, 8: PersonToppingPreference.LIKE}
+        packed = pack_codes(ratings)
+        self.assertEqual(len(packed), 9)
+        self.assertEqual(unpack_codes(packed), ratings)
+        self.assertEqual(pack_codes({}), b'')
+
+    def test_vector_kept_in_sync_and_read_on_cache_miss(self):
+        from .models import PersonPreferenceVector
+        from .preferences import load_preferences, preferences_changed, unpack_codes
+        vector = PersonPreferenceVector.objects.get(person=self.alice)
+        self.assertEqual(unpack_codes(vector.codes), {
+            self.t_pep.pk: PersonToppingPreference.LIKE, self.t_olive.pk: PersonToppingPreference.ALLERGY,
+        })
+        with self.captureOnCommitCallbacks(execute=True):
+            PersonToppingPreference.objects.filter(person=self.alice, topping=self.t_olive).delete()
+            preferences_changed(self.alice.pk)
+        with self.assertNumQueries(1):
+            matrix = load_preferences([self.alice])
+        self.assertIsNone(matrix.explicit(self.alice.pk, self.t_olive.pk))
+        self.assertEqual(matrix.get(self.alice.pk, self.t_pep.pk), PersonToppingPreference.LIKE)
+
+    def test_missing_vector_falls_back_to_rows(self):
+        from .models import PersonPreferenceVector
+        from .preferences import invalidate_preferences, load_preferences
+        PersonPreferenceVector.objects.all().delete()
+        invalidate_preferences(self.alice.pk)
+        matrix = load_preferences([self.alice])
+        self.assertEqual(matrix.get(self.alice.pk, self.t_olive.pk), PersonToppingPreference.ALLERGY)
+        self.assertTrue(PersonPreferenceVector.objects.filter(person=self.alice).exists())
+
+    def test_pack_on_miss_does_not_overwrite_a_newer_vector(self):
+        from .models import PersonPreferenceVector
+        from . import preferences
+        PersonPreferenceVector.objects.all().delete()
+        preferences.invalidate_preferences(self.alice.pk)
+        read_rows = preferences.read_rows
+        raced = []
+
+        def read_then_write(person_ids, using=None):
+            rows = read_rows(person_ids, using)
+            if not raced:  # the re-pack after the commit below reads the real rows
+                raced.append(True)
+                with self.captureOnCommitCallbacks(execute=True):
+                    PersonToppingPreference.objects.filter(person=self.alice, topping=self.t_olive).delete()
+                    preferences.preferences_changed(self.alice.pk)
+            return rows
+
+        with mock.patch('webapp.preferences.read_rows', read_then_write):
+            preferences.load_preferences([self.alice])
+        vector = PersonPreferenceVector.objects.get(person=self.alice)
+        self.assertEqual(preferences.unpack_codes(vector.codes), {self.t_pep.pk: PersonToppingPreference.LIKE})
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.t_pep = Topping.objects.create(name="Pepperoni")
+        self.t_olive = Topping.objects.create(name="Olive")
+        self.group = make_group()
+        self.restaurant = make_restaurant(toppings=[self.t_pep, self.t_olive], group=self.group)
+        self.alice = make_person("Alice", prefs={self.t_pep: PersonToppingPreference.LIKE})
+        self.bob = make_person("Bob", unrated_is_dislike=True, prefs={self.t_olive: PersonToppingPreference.ALLERGY})
+        self.carol = make_person("Carol")
+        for p in (self.alice, self.bob, self.carol):
+            GroupMembership.objects.create(group=self.group, person=p)
+        self.order = make_order(self.restaurant, self.alice, [self.alice, self.bob], group=self.group)
+        pizza = OrderedPizza.objects.create(order=self.order)
+        pizza.toppings.set([self.t_pep])
+        pizza.people.set([self.alice, self.bob])
+        staff = get_user_model().objects.create_user(
+            username="staff", email="staff@test.com", password="testpass", is_staff=True,
+        )
+        self.client.force_login(staff)
+
+    def test_preference_csv(self):
+        url = reverse('staff_preferences_export', kwargs={'group_id': self.group.pk})
+        response = self.client.get(url, {'format': 'csv'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        rows = list(csv.reader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual(rows[0], ['person_id', 'name', 'email', 'unrated', 'Olive', 'Pepperoni'])
+        self.assertEqual(rows[1][1:], ['Alice', 'alice@test.com', 'neutral', '', 'like'])
+        self.assertEqual(rows[2][1:], ['Bob', 'bob@test.com', 'dislike', 'allergy', ''])
+        self.assertEqual(rows[3][1:], ['Carol', 'carol@test.com', 'neutral', '', ''])
+
+    def test_order_history_jsonl(self):
+        response = self.client.get(reverse('staff_orders_export'), {'format': 'jsonl'})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        records = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['order_id'], self.order.pk)
+        self.assertEqual(records[0]['pizzas'][0]['toppings'], ['Pepperoni'])
+        self.assertEqual(records[0]['pizzas'][0]['people'], ['Alice', 'Bob'])
+
+    def test_export_requires_staff(self):
+        user = get_user_model().objects.create_user(username="plain", email="plain@test.com", password="testpass")
+        self.client.force_login(user)
+        response = self.client.get(reverse('staff_orders_export'))
+        self.assertEqual(response.status_code, 302)
+
+    def test_export_orders_command(self):
+        out = StringIO()
+        call_command('export_orders', '--format', 'csv', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertIn('Pepperoni', lines[1])
+
+
+class BulkImportTests(TestCase):
+    def setUp(self):
+        self.t_pep = Topping.objects.create(name="Pepperoni")
+        self.t_olive = Topping.objects.create(name="Olive")
+        self.payload = {
+            'group': 'Office',
+            'people': [
+                {'name': 'Ann', 'email': 'ann@example.com', 'admin': True},
+                {'name': 'Ben', 'email': 'ben@example.com', 'unrated_is_dislike': True},
+            ],
+            'preferences': {'Pepperoni': [1, 'allergy'], 'Olive': [None, -1]},
+            'restaurants': [{'name': 'Corner Slice', 'toppings': ['Pepperoni', 'Olive']}],
+        }
+
+    def test_json_import_creates_everything(self):
+        from .imports import import_data
+        with self.captureOnCommitCallbacks(execute=True):
+            result = import_data(json.dumps(self.payload), 'json')
+        self.assertEqual(result['people'], 2)
+        self.assertEqual(result['preferences'], 3)
+        group = PizzaGroup.objects.get(name='Office')
+        ann = Person.objects.get(user_account__email='ann@example.com')
+        self.assertTrue(GroupMembership.objects.get(group=group, person=ann).is_admin)
+        self.assertFalse(ann.user_account.has_usable_password())
+        self.assertEqual(
+            PersonToppingPreference.objects.get(person__email='ben@example.com', topping=self.t_pep).preference,
+            PersonToppingPreference.ALLERGY,
+        )
+        self.assertFalse(PersonToppingPreference.objects.filter(person=ann, topping=self.t_olive).exists())
+        restaurant = PizzaRestaurant.objects.get(name='Corner Slice', group=group)
+        self.assertEqual(restaurant.toppings.count(), 2)
+
+    def test_reimport_updates_in_place(self):
+        from .imports import import_data
+        import_data(json.dumps(self.payload), 'json')
+        self.payload['preferences']['Pepperoni'] = ['dislike', 0]
+        self.payload['restaurants'][0]['toppings'] = ['Olive']
+        import_data(json.dumps(self.payload), 'json')
+        self.assertEqual(Person.objects.count(), 2)
+        self.assertEqual(GroupMembership.objects.count(), 2)
+        self.assertEqual(
+            PersonToppingPreference.objects.get(person__email='ann@example.com', topping=self.t_pep).preference,
+            PersonToppingPreference.DISLIKE,
+        )
+        self.assertEqual(list(PizzaRestaurant.objects.get().toppings.all()), [self.t_olive])
+
+    def test_invalid_payload_reports_all_errors_and_writes_nothing(self):
+        from .imports import BulkImportError, import_data
+        self.payload['people'].append({'name': '', 'email': 'not-an-email'})
+        self.payload['preferences']['Anchovy'] = [1, 1]
+        with self.assertRaises(BulkImportError) as ctx:
+            import_data(json.dumps(self.payload), 'json')
+        self.assertGreaterEqual(len(ctx.exception.errors), 3)
+        self.assertTrue(any('Anchovy' in e for e in ctx.exception.errors))
+        self.assertFalse(Person.objects.exists())
+        self.assertFalse(PizzaGroup.objects.exists())
+
+    def test_csv_upload_round_trips_export_layout(self):
+        staff = get_user_model().objects.create_user(
+            username="staff", email="staff@test.com", password="testpass", is_staff=True,
+        )
+        self.client.force_login(staff)
+        csv_text = "name,email,unrated,Olive,Pepperoni\nAnn,ann@example.com,neutral,,like\n"
+        response = self.client.post(reverse('staff_import'), {
+            'file': SimpleUploadedFile('people.csv', csv_text.encode()),
+            'group': 'Office',
+        })
+        self.assertEqual(response.status_code, 302)
+        ann = Person.objects.get(email='ann@example.com')
+        self.assertEqual(
+            list(ann.topping_preferences.values_list('topping__name', 'preference')),
+            [('Pepperoni', PersonToppingPreference.LIKE)],
+        )
+
+
+class ToppingMergeTests(TestCase):
+    def test_merge_invalidates_preferences_after_commit(self):
+        from .preferences import load_preferences
+        staff = get_user_model().objects.create_user(
+            username="merger", email="merger@test.com", password="testpass", is_staff=True,
+        )
+        self.client.force_login(staff)
+        old, target = Topping.objects.create(name="Jalapeno"), Topping.objects.create(name="Jalapenos")
+        alice = make_person("MergeAlice", prefs={old: PersonToppingPreference.LIKE})
+        load_preferences([alice])
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(reverse('topping_merge', args=[old.pk]), {'target': target.pk})
+            self.assertRedirects(response, reverse('topping_list'))
+            # Until the merge commits, readers keep getting the committed ratings from the cache.
+            with self.assertNumQueries(0):
+                self.assertEqual(load_preferences([alice]).explicit(alice.pk, old.pk), PersonToppingPreference.LIKE)
+        with self.captureOnCommitCallbacks(execute=True):
+            for callback in callbacks:
+                callback()
+        matrix = load_preferences([alice])
+        self.assertEqual(matrix.explicit(alice.pk, target.pk), PersonToppingPreference.LIKE)
+        self.assertIsNone(matrix.explicit(alice.pk, old.pk))
+
+
+    def test_merge_bumps_no_version_until_commit(self):
+        from .caching import get_versions
+        staff = get_user_model().objects.create_user(
+            username="merger", email="merger@test.com", password="testpass", is_staff=True,
+        )
+        self.client.force_login(staff)
+        old, target = Topping.objects.create(name="Capers"), Topping.objects.create(name="Caper")
+        group = make_group("Merge Group")
+        both = make_restaurant(name="Both", toppings=[old, target], group=group)
+        only_old = make_restaurant(name="Only Old", toppings=[old], group=group)
+        # Alice rated both toppings, so her row for the old one is deleted rather than moved.
+        alice = make_person("MergeAlice", prefs={old: PersonToppingPreference.LIKE, target: PersonToppingPreference.LIKE})
+        bob = make_person("MergeBob", prefs={old: PersonToppingPreference.DISLIKE})
+        names = ['toppings', f'restaurant:{both.pk}', f'restaurant:{only_old.pk}', f'group-restaurants:{group.pk}',
+                 f'person:{alice.pk}', f'person:{bob.pk}']
+        before = get_versions(*names)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post(reverse('topping_merge', args=[old.pk]), {'target': target.pk})
+            self.assertEqual(get_versions(*names), before)
+        for callback in callbacks:
+            callback()
+        after = get_versions(*names)
+        self.assertTrue(all(after[name] != before[name] for name in names), after)
+
+
+class DeltaPreferenceWriteTests(TestCase):
+    def setUp(self):
+        self.t_pep = Topping.objects.create(name="Pepperoni")
+        self.t_olive = Topping.objects.create(name="Olive")
+        self.t_ham = Topping.objects.create(name="Ham")
+        self.alice = make_person("Alice", prefs={
+            self.t_pep: PersonToppingPreference.LIKE, self.t_olive: PersonToppingPreference.DISLIKE,
+        })
+        self.user = get_user_model().objects.create_user(username="alice", email="alice@test.com", password="testpass")
+        self.alice.user_account = self.user
+        self.alice.save()
+        self.client.force_login(self.user)
+
+    def test_write_preferences_touches_only_changed_rows(self):
+        from .preferences import write_preferences
+        current = {self.t_pep.pk: PersonToppingPreference.LIKE, self.t_olive.pk: PersonToppingPreference.DISLIKE}
+        all_ids = [self.t_pep.pk, self.t_olive.pk, self.t_ham.pk]
+        self.assertEqual(write_preferences(self.alice.pk, current, dict(current), all_ids), 0)
+        changed = write_preferences(self.alice.pk, current, {
+            self.t_pep.pk: PersonToppingPreference.LIKE, self.t_ham.pk: PersonToppingPreference.ALLERGY,
+        }, all_ids)
+        self.assertEqual(changed, 2)
+        self.assertEqual(
+            dict(self.alice.topping_preferences.values_list('topping_id', 'preference')),
+            {self.t_pep.pk: PersonToppingPreference.LIKE, self.t_ham.pk: PersonToppingPreference.ALLERGY},
+        )
+
+    def test_unchanged_profile_save_writes_no_preferences(self):
+        data = {
+            'name': 'Alice', 'email': 'alice@test.com',
+            f'pref_{self.t_pep.pk}': 'like', f'pref_{self.t_olive.pk}': 'dislike',
+        }
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.post(reverse('profile_edit'), data)
+        table = PersonToppingPreference._meta.db_table
+        writes = [q['sql'] for q in ctx.captured_queries
+                  if table in q['sql'] and not q['sql'].lstrip().upper().startswith('SELECT')]
+        self.assertEqual(writes, [])
+
+    def test_profile_autosave_sets_and_clears_one_topping(self):
+        url = reverse('profile_preference_autosave', kwargs={'topping_id': self.t_ham.pk})
+        response = self.client.post(url, {f'pref_{self.t_ham.pk}': 'like'})
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(
+            self.alice.topping_preferences.get(topping=self.t_ham).preference, PersonToppingPreference.LIKE,
+        )
+        self.client.post(url, {f'pref_{self.t_ham.pk}': ''})
+        self.assertFalse(self.alice.topping_preferences.filter(topping=self.t_ham).exists())
+        self.assertEqual(self.alice.topping_preferences.count(), 2)
+
+    def test_guest_autosave_requires_session_guest(self):
+        group = make_group()
+        restaurant = make_restaurant(toppings=[self.t_pep, self.t_ham], group=group)
+        order = make_order(restaurant, self.alice, [self.alice], group=group)
+        order.invite_token = uuid.uuid4()
+        order.save()
+        url = reverse('order_join_autosave', kwargs={'invite_token': order.invite_token, 'topping_id': self.t_ham.pk})
+        self.assertEqual(self.client.post(url, {f'pref_{self.t_ham.pk}': '1'}).status_code, 403)
+
+        join_url = reverse('order_join', kwargs={'invite_token': order.invite_token})
+        self.client.post(join_url, {'name': 'Guest', f'pref_{self.t_pep.pk}': '1', f'pref_{self.t_ham.pk}': '0'})
+        guest = Person.objects.get(guest_for_order=order)
+        self.assertEqual(self.client.post(url, {f'pref_{self.t_ham.pk}': '-2'}).status_code, 204)
+        self.assertEqual(guest.topping_preferences.get(topping=self.t_ham).preference, PersonToppingPreference.ALLERGY)
+        self.assertEqual(guest.topping_preferences.get(topping=self.t_pep).preference, PersonToppingPreference.LIKE)
+
+
+class StaffPreferenceMatrixTests(TestCase):
+    def setUp(self):
+        self.t_pep = Topping.objects.create(name="Pepperoni")
+        self.t_olive = Topping.objects.create(name="Olive")
+        self.group = make_group()
+        self.alice = make_person("Alice", prefs={self.t_pep: PersonToppingPreference.LIKE})
+        self.bob = make_person("Bob", unrated_is_dislike=True, prefs={self.t_olive: PersonToppingPreference.ALLERGY})
+        for p in (self.alice, self.bob):
+            GroupMembership.objects.create(group=self.group, person=p)
+        staff = get_user_model().objects.create_user(
+            username="staff", email="staff@test.com", password="testpass", is_staff=True,
+        )
+        self.client.force_login(staff)
+        self.url = reverse('staff_preferences_matrix', kwargs={'group_id': self.group.pk})
+
+    def test_page_shell_renders(self):
+        response = self.client.get(reverse('staff_preferences'), {'group': self.group.pk})
+        self.assertContains(response, self.url)
+        self.assertContains(response, '2 members')
+        self.assertContains(response, 'id="matrix-error"')
+
+    def test_matrix_codes(self):
+        data = self.client.get(self.url).json()
+        self.assertEqual(data['members']['names'], ['Alice', 'Bob'])
+        self.assertEqual(data['members']['unrated_is_dislike'], [0, 1])
+        self.assertEqual(data['toppings']['names'], ['Olive', 'Pepperoni'])
+        # Olive: Alice unrated, Bob allergy; Pepperoni: Alice like, Bob unrated.
+        self.assertEqual(data['codes'], '0140')
+
+    def test_pagination_and_filters(self):
+        data = self.client.get(self.url, {'per_page': 1, 'page': 2}).json()
+        self.assertEqual((data['page'], data['num_pages'], data['member_count']), (2, 2, 2))
+        self.assertEqual(data['members']['names'], ['Bob'])
+        data = self.client.get(self.url, {'member': 'ali', 'topping': 'pep'}).json()
+        self.assertEqual(data['members']['names'], ['Alice'])
+        self.assertEqual(data['toppings']['names'], ['Pepperoni'])
+        self.assertEqual(data['codes'], '4')
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.group = make_group()
+        self.restaurant = make_restaurant(group=self.group)
+        self.host = make_person("Host")
+        self.orders = [make_order(self.restaurant, self.host, [self.host], group=self.group) for _ in range(5)]
+        # Two orders share a timestamp so the id tie-breaker matters.
+        Order.objects.filter(pk=self.orders[2].pk).update(created_at=self.orders[3].created_at)
+
+    def test_pages_cover_every_row_once_in_order(self):
+        from .pagination import keyset_page
+        qs = Order.objects.filter(group=self.group)
+        expected = list(qs.order_by('-created_at', '-id').values_list('pk', flat=True))
+        seen, cursor = [], None
+        while True:
+            page = keyset_page(qs, ['-created_at', '-id'], cursor, per_page=2)
+            seen.extend(o.pk for o in page.items)
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        self.assertEqual(seen, expected)
+
+    def test_malformed_cursor_returns_first_page(self):
+        from .pagination import keyset_page
+        page = keyset_page(Order.objects.all(), ['-created_at', '-id'], 'not-a-cursor', per_page=2)
+        self.assertEqual(len(page.items), 2)
+
+    def test_order_history_and_roster_pages(self):
+        user = get_user_model().objects.create_user(username="host", email="host@test.com", password="testpass")
+        self.host.user_account = user
+        self.host.save()
+        GroupMembership.objects.create(group=self.group, person=self.host)
+        self.client.force_login(user)
+        response = self.client.get(reverse('group_orders', kwargs={'pk': self.group.pk}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['orders']), 5)
+        self.assertFalse(response.context['page'].has_next)
+
+        other = make_group("Other")
+        response = self.client.get(reverse('group_orders', kwargs={'pk': other.pk}))
+        self.assertEqual(response.status_code, 404)
+
+        response = self.client.get(reverse('group_detail', kwargs={'pk': self.group.pk}))
+        self.assertContains(response, 'Host')
+
+
+class ArchiveOrderTests(TestCase):
+    def setUp(self):
+        self.t_pep = Topping.objects.create(name="Pepperoni")
+        self.group = make_group()
+        self.restaurant = make_restaurant(toppings=[self.t_pep], group=self.group)
+        self.alice = make_person("Alice", prefs={self.t_pep: PersonToppingPreference.LIKE})
+        self.order = make_order(self.restaurant, self.alice, [self.alice], group=self.group)
+        self.guest = Person.objects.create(name="Gus", guest_for_order=self.order)
+        PersonToppingPreference.objects.create(person=self.guest, topping=self.t_pep, preference=PersonToppingPreference.LIKE)
+        self.order.people.add(self.guest)
+        pizza = OrderedPizza.objects.create(order=self.order)
+        pizza.toppings.set([self.t_pep])
+        pizza.people.set([self.alice, self.guest])
+        user = get_user_model().objects.create_user(username="alice", email="alice@test.com", password="testpass")
+        self.alice.user_account = user
+        self.alice.save()
+        GroupMembership.objects.create(group=self.group, person=self.alice)
+        self.client.force_login(user)
+
+    def _age(self, days):
+        Order.objects.filter(pk=self.order.pk).update(created_at=timezone.now() - timedelta(days=days))
+
+    def test_command_moves_old_solved_orders(self):
+        from .models import ArchivedOrder
+        self._age(10)
+        call_command('archive_orders', '--days', '30', stdout=StringIO())
+        self.assertTrue(Order.objects.filter(pk=self.order.pk).exists())
+        self._age(400)
+        call_command('archive_orders', '--days', '30', stdout=StringIO())
+        self.assertFalse(Order.objects.filter(pk=self.order.pk).exists())
+        self.assertFalse(OrderedPizza.objects.exists())
+        self.assertFalse(Person.objects.filter(pk=self.guest.pk).exists())
+        self.assertFalse(PersonToppingPreference.objects.filter(person_id=self.guest.pk).exists())
+        self.assertTrue(PersonToppingPreference.objects.filter(person=self.alice).exists())
+        self.assertEqual(ArchivedOrder.objects.get().order_id, self.order.pk)
+
+    def test_unsolved_orders_are_kept(self):
+        from .archive import archive_orders
+        OrderedPizza.objects.all().delete()
+        self.assertEqual(archive_orders([self.order.pk]), 0)
+        self.assertTrue(Order.objects.filter(pk=self.order.pk).exists())
+
+    def test_results_page_reads_archive(self):
+        from .archive import archive_orders
+        archive_orders([self.order.pk])
+        response = self.client.get(reverse('order_results', kwargs={'order_id': self.order.pk}))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'archived on')
+        self.assertContains(response, 'Pepperoni')
+        self.assertContains(response, 'Gus')
+        self.assertNotContains(response, 'Recompute Order')
+
+    def test_archived_results_require_membership(self):
+        from .archive import archive_orders
+        archive_orders([self.order.pk])
+        GroupMembership.objects.filter(person=self.alice).delete()
+        response = self.client.get(reverse('order_results', kwargs={'order_id': self.order.pk}))
+        self.assertEqual(response.status_code, 403)
+
+
+class ReplicaRouterTests(TestCase):
+    def setUp(self):
+        from .routers import ReplicaRouter, begin_request, end_request
+        self.router = ReplicaRouter()
+        token = begin_request()
+        self.addCleanup(end_request, token)
+
+    def _enable(self, cookies=None):
+        from .routers import replica_reads
+        request = RequestFactory().get('/')
+        request.COOKIES.update(cookies or {})
+        replica_reads(lambda request: None)(request)
+
+    def test_reads_stay_on_primary_unless_view_opts_in(self):
+        self.assertEqual(self.router.db_for_read(Topping), 'default')
+        self._enable()
+        # TestCase wraps each test in a transaction on the primary; leave it for the routing check.
+        with mock.patch('webapp.routers.connections') as conns:
+            conns.__getitem__.return_value.in_atomic_block = False
+            self.assertEqual(self.router.db_for_read(Topping), 'replica')
+            self.assertEqual(self.router.db_for_read(get_user_model()), 'default')
+            self.router.db_for_write(Topping)
+            self.assertEqual(self.router.db_for_read(Topping), 'default')
+
+    def test_pin_cookie_and_open_transaction_keep_reads_on_primary(self):
+        self._enable(cookies={'db_pin': '1'})
+        self.assertEqual(self.router.db_for_read(Topping), 'default')
+        self._enable()
+        # Inside TestCase's transaction the primary is mid-atomic block.
+        self.assertEqual(self.router.db_for_read(Topping), 'default')
+
+    @override_settings(DATABASE_ROUTERS=['webapp.routers.ReplicaRouter'])
+    def test_middleware_pins_after_write(self):
+        from .middleware import replica_pin_middleware
+
+        def writing_view(request):
+            Topping.objects.create(name="Basil")
+            return HttpResponse()
+
+        response = replica_pin_middleware(writing_view)(RequestFactory().post('/'))
+        self.assertIn('db_pin', response.cookies)
+        response = replica_pin_middleware(lambda r: HttpResponse())(RequestFactory().get('/'))
+        self.assertNotIn('db_pin', response.cookies)
+
+
+class ReplicaLagTests(TestCase):
+    """A real second database that lacks every row the tests write, like a replica that has not caught up."""
+
+    @classmethod
+    def setUpClass(cls):
+        if connections['default'].vendor != 'sqlite':
+            raise unittest.SkipTest("The lagging replica is a copy of the SQLite test database.")
+        # The alias only exists from here on, so it joins `databases` after TestCase's class setup.
+        super().setUpClass()
+        fd, cls.replica_path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+        connections['default'].ensure_connection()
+        with sqlite3.connect(cls.replica_path) as replica:
+            connections['default'].connection.backup(replica)
+        connections.settings['replica'] = {
+            **connections.settings['default'], 'NAME': cls.replica_path,
+            'TEST': {**connections.settings['default']['TEST'], 'NAME': cls.replica_path},
+        }
+        cls.databases = cls.databases | {'replica'}
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+        cls.databases = cls.databases - {'replica'}
+        os.remove(cls.replica_path)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.topping = Topping.objects.create(name="Peanut")
+        self.guest = make_person("LagGuest", prefs={self.topping: PersonToppingPreference.ALLERGY})
+
+    def test_replica_lacks_the_new_rating(self):
+        from .preferences import load_preferences
+        self.assertFalse(PersonToppingPreference.objects.using('replica').filter(person=self.guest).exists())
+        self.assertIsNone(load_preferences([self.guest], using='replica').explicit(self.guest.pk, self.topping.pk))
+
+    def _replica_routing(self):
+        """Route reads as inside a @replica_reads view, with the primary outside any transaction."""
+        from .routers import _state, begin_request, end_request
+        token = begin_request()
+        self.addCleanup(end_request, token)
+        _state.get().use_replica = True
+        stack = contextlib.ExitStack()
+        stack.enter_context(override_settings(DATABASE_ROUTERS=['webapp.routers.ReplicaRouter']))
+        # TestCase keeps the primary inside a transaction, which would pin reads to it.
+        conns = stack.enter_context(mock.patch('webapp.routers.connections'))
+        conns.__getitem__.return_value.in_atomic_block = False
+        return stack
+
+    def test_solver_reads_the_primary(self):
+        from .solver import _build_prefs
+        with self._replica_routing():
+            _, allergy_pairs = _build_prefs([self.guest], [self.topping])
+        self.assertEqual(allergy_pairs, {(0, 0)})
+
+    def test_replica_reads_until_the_request_writes(self):
+        from .preferences import load_preferences
+        from .routers import _state
+        with self._replica_routing():
+            self.assertIsNone(load_preferences([self.guest]).explicit(self.guest.pk, self.topping.pk))
+            _state.get().wrote = True
+            matrix = load_preferences([self.guest])
+        self.assertEqual(matrix.explicit(self.guest.pk, self.topping.pk), PersonToppingPreference.ALLERGY)
+
+
+class DbPoolStatsTests(TestCase):
+    def test_staff_only(self):
+        user = get_user_model().objects.create_user(username="u", email="u@test.com", password="testpass")
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(reverse('staff_db_pool')).status_code, 302)
+
+    def test_reports_no_pools_without_db_pool(self):
+        staff = get_user_model().objects.create_user(
+            username="staff", email="staff@test.com", password="testpass", is_staff=True,
+        )
+        self.client.force_login(staff)
+        data = self.client.get(reverse('staff_db_pool')).json()
+        self.assertFalse(data['pooled'])
+        self.assertEqual(data['databases'], {})
+        self.assertIn('pid', data)
+
+    def test_pool_options_build_a_pool(self):
+        try:
+            import psycopg_pool  # noqa: F401
+            from django.db.backends.postgresql.base import DatabaseWrapper
+        except ImportError:
+            self.skipTest("psycopg 3 and psycopg_pool are not installed")
+        from pizza_solver import settings as project_settings
+        db = {'ENGINE': 'django.db.backends.postgresql', 'NAME': 'pizza', 'CONN_MAX_AGE': 600}
+        with mock.patch.object(project_settings, 'DB_POOL', True):
+            db = project_settings._pooled(db)
+        wrapper = DatabaseWrapper({**connection.settings_dict, **db}, alias='pool_test')
+        self.addCleanup(DatabaseWrapper._connection_pools.pop, 'pool_test', None)
+        self.assertEqual(wrapper.pool.max_size, 10)
+        self.assertIsNotNone(wrapper.pool._check)
+
+
+# ---------------------------------------------------------------------------
+# Query budgets
+# ---------------------------------------------------------------------------
+
+class QueryBudgetTests(TestCase):
+    """Every URL in webapp.urls states how many queries it may run against a realistically sized group.
+
+    Budgets are for a cold cache and must not grow with the data: an N+1 loop
+    over 30 members, 20 toppings or 8 orders blows straight through them.
+    """
+
+    BUDGETS = {
+        'index': 6,
+        'order_select_group': 6,
+        'new_order': 8,
+        'draft_order': 13,
+        'order_results': 18,
+        'order_recompute': 21,
+        'order_cancel_invite': 17,
+        'order_people_partial': 7,
+        'order_join': 8,
+        'order_join_autosave': 6,
+        'topping_list': 4,
+        'topping_create': 3,
+        'topping_edit': 4,
+        'topping_merge': 21,
+        'topping_delete': 4,
+        'staff_preferences': 7,
+        'staff_preferences_matrix': 7,
+        'staff_preferences_export': 6,
+        'staff_orders_export': 6,
+        'staff_import': 3,
+        'staff_db_pool': 2,
+        'metrics': 0,
+        'staff_profiles': 5,
+        'staff_profile_detail': 4,
+        'staff_profile_download': 3,
+        'restaurant_list': 7,
+        'restaurant_create': 6,
+        'restaurant_edit': 9,
+        'restaurant_clone': 7,
+        'restaurant_delete': 6,
+        'profile_edit': 6,
+        'profile_preference_autosave': 6,
+        'group_list': 5,
+        'group_create': 4,
+        'group_detail': 7,
+        'group_orders': 7,
+        'group_delete': 6,
+        'group_join': 5,
+        'group_reset_invite': 6,
+        'group_remove_member': 9,
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        from .benchmarks import seed
+        cls.fixture = seed(members=30, toppings=20, orders=8)
+
+    def test_middleware_reports_queries_and_repeats(self):
+        from .middleware import query_budget_middleware
+
+        def n_plus_one(request):
+            for topping in Topping.objects.all()[:3]:
+                list(topping.pizzas.all())
+            return HttpResponse()
+
+        response = query_budget_middleware(n_plus_one)(RequestFactory().get('/'))
+        self.assertEqual(response['X-DB-Queries'], '4')
+        self.assertEqual(response['X-DB-Duplicate-Queries'], '2')
+        self.assertIn('db;dur=', response['Server-Timing'])
+
+    def test_every_url_has_a_budget(self):
+        from .benchmarks import url_requests
+        from .urls import urlpatterns
+        names = {p.name for p in urlpatterns}
+        self.assertEqual(names, set(self.BUDGETS))
+        self.assertEqual(names, set(url_requests(self.fixture)))
+
+    def test_views_stay_within_query_budget(self):
+        from .benchmarks import login, timed_request, url_requests
+        login(self.client, self.fixture)
+        for name, (method, url, data) in url_requests(self.fixture).items():
+            with self.subTest(name):
+                cache.clear()
+                response, _, log, _ = timed_request(self.client, method, url, data)
+                self.assertLess(response.status_code, 400)
+                repeated = '\n'.join(f'{n}x {sql}' for n, sql in log.repeated())
+                self.assertLessEqual(log.count, self.BUDGETS[name], f"{name}: {log.count} queries\n{repeated}")
+
+
+class BenchViewsTests(TestCase):
+    def test_baseline_flags_slower_p95_and_extra_queries(self):
+        from .management.commands.bench_views import compare
+        baseline = {'urls': {
+            'index': {'p95_ms': 10.0, 'queries': 6},
+            'topping_list': {'p95_ms': 10.0, 'queries': 4},
+        }}
+        results = {'urls': {
+            'index': {'p95_ms': 11.0, 'queries': 7},
+            'topping_list': {'p95_ms': 13.0, 'queries': 4},
+            'metrics': {'p95_ms': 1.0, 'queries': 0},
+        }}
+        self.assertEqual(compare(results, baseline, threshold=20), [
+            'index: queries 6 -> 7',
+            'topping_list: p95 10.0ms -> 13.0ms',
+        ])
+
+
+class SeedScaleTests(TestCase):
+    def test_seeds_consistent_groups_orders_and_backdated_history(self):
+        call_command('seed_scale', '--users', '60', '--groups', '4', '--orders', '3', stdout=StringIO())
+        self.assertEqual(get_user_model().objects.count(), 60)
+        self.assertTrue(get_user_model().objects.first().check_password('testpass'))
+        self.assertEqual(GroupMembership.objects.filter(is_admin=True).count(), 4)
+        self.assertFalse(Person.objects.filter(pizza_groups__isnull=True).exists())
+        order = Order.objects.annotate(n=Count('people')).filter(n__gt=0).first()
+        self.assertEqual(order.pizzas.count(), order.num_pizzas)
+        self.assertTrue(set(order.restaurant.toppings.all()) >= set(Topping.objects.filter(pizzas__order=order)))
+        self.assertTrue(Order.objects.filter(created_at__lt=timezone.now() - timedelta(days=30)).exists())
+        self.assertGreater(PersonToppingPreference.objects.count(), 60)
+
+    def test_leaves_the_shared_cache_alone(self):
+        from pizza_solver import settings as project_settings
+        shared = CacheHandler(project_settings.CACHES)['default']
+        shared.set('tests:sentinel', 1)
+        self.addCleanup(shared.delete, 'tests:sentinel')
+        call_command('seed_scale', '--users', '4', '--groups', '1', '--orders', '1', stdout=StringIO())
+        self.assertEqual(shared.get('tests:sentinel'), 1)
+
+
+class ProfilingTests(TestCase):
+    def setUp(self):
+        self.staff = get_user_model().objects.create_user(
+            username="staff", email="staff@test.com", password="testpass", is_staff=True,
+        )
+
+    def test_staff_flag_stores_profile(self):
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('topping_list'), {'_profile': '1'})
+        self.assertEqual(response.status_code, 200)
+        profile = RequestProfile.objects.get()
+        self.assertEqual(profile.view_name, 'topping_list')
+        self.assertEqual(profile.trigger, RequestProfile.TRIGGER_FLAG)
+        self.assertEqual(profile.user, self.staff)
+        self.assertGreater(profile.query_count, 0)
+        self.assertIn('cumulative', profile.summary)
+        stats = pstats.Stats()
+        stats.stats = marshal.loads(bytes(profile.stats))
+        self.assertTrue(stats.stats)
+
+    def test_flag_ignored_for_non_staff(self):
+        user = get_user_model().objects.create_user(username="u", email="u@test.com", password="testpass")
+        self.client.force_login(user)
+        self.client.get(reverse('group_list'), {'_profile': '1'})
+        self.assertFalse(RequestProfile.objects.exists())
+
+    @override_settings(PROFILE_SAMPLE_RATE=1.0, PROFILE_KEEP=2)
+    def test_sampling_profiles_async_views_and_prunes(self):
+        restaurant = make_restaurant()
+        order = make_order(restaurant, make_person("Host"), [])
+        order.invite_token = uuid.uuid4()
+        order.save()
+        for _ in range(3):
+            self.client.get(reverse('order_join', args=[order.invite_token]))
+        self.assertEqual(RequestProfile.objects.count(), 2)
+        self.assertEqual(
+            set(RequestProfile.objects.values_list('trigger', 'view_name')),
+            {(RequestProfile.TRIGGER_SAMPLE, 'order_join')},
+        )
+
+    def test_concurrent_profiled_requests_are_both_served(self):
+        from .middleware import profiling_middleware
+        factory = RequestFactory()
+        responses = {}
+
+        def request():
+            req = factory.get(reverse('topping_list'), {'_profile': '1'})
+            req.user = self.staff
+            return req
+
+        def second(req):
+            return HttpResponse("second")
+
+        def first(req):
+            # The second request arrives, on another thread, while this one is being profiled.
+            thread = threading.Thread(target=lambda: responses.update(second=profiling_middleware(second)(request())))
+            thread.start()
+            thread.join()
+            return HttpResponse("first")
+
+        responses['first'] = profiling_middleware(first)(request())
+        self.assertEqual(responses['first'].content, b"first")
+        self.assertEqual(responses['second'].content, b"second")
+        self.assertEqual(RequestProfile.objects.count(), 1)
+
+    def test_busy_profiler_serves_request_unprofiled(self):
+        from . import querylog, profiling
+        self.client.force_login(self.staff)
+        other = profiling.Run()
+        self.assertTrue(other.start())
+        try:
+            response = self.client.get(reverse('topping_list'), {'_profile': '1'})
+        finally:
+            other.stop()
+        self.assertEqual(response.status_code, 200)
+        # Another tool holding the profiler (ValueError on Python 3.12+) is skipped the same way.
+        with mock.patch('cProfile.Profile.enable', side_effect=ValueError("Another profiling tool is already active")):
+            response = self.client.get(reverse('topping_list'), {'_profile': '1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(querylog._current.get())
+        self.assertFalse(RequestProfile.objects.exists())
+        self.client.get(reverse('topping_list'), {'_profile': '1'})
+        self.assertEqual(RequestProfile.objects.count(), 1)
+
+    def test_list_detail_and_download(self):
+        self.client.force_login(self.staff)
+        self.client.get(reverse('topping_list'), {'_profile': '1'})
+        profile = RequestProfile.objects.get()
+        self.assertContains(self.client.get(reverse('staff_profiles')), '/toppings/?_profile=1')
+        self.assertContains(self.client.get(reverse('staff_profile_detail', args=[profile.pk])), 'cumulative')
+        response = self.client.get(reverse('staff_profile_download', args=[profile.pk]))
+        self.assertEqual(response['Content-Disposition'], f'attachment; filename="profile-{profile.pk}.prof"')
+        self.assertEqual(response.content, bytes(profile.stats))
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.override = override_settings(METRICS_DIR=self.dir, METRICS_FLUSH_INTERVAL=0)
+        self.override.enable()
+        self.addCleanup(self.override.disable)
+
+    def test_restricted_to_allowed_ips_and_staff(self):
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(url, REMOTE_ADDR='10.1.2.3').status_code, 403)
+        staff = get_user_model().objects.create_user(
+            username="staff", email="staff@test.com", password="testpass", is_staff=True,
+        )
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get(url, REMOTE_ADDR='10.1.2.3').status_code, 200)
+
+    def test_scrape_runs_no_queries(self):
+        from .querylog import record
+        with record() as log:
+            response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(log.count, 0)
+        self.assertContains(response, '# TYPE pizza_request_duration_seconds histogram')
+        self.assertContains(response, 'pizza_solver_queue_depth 0')
+
+    def test_records_requests_joins_and_solves(self):
+        t_pep = Topping.objects.create(name="Pepperoni")
+        restaurant = make_restaurant(toppings=[t_pep])
+        host = make_person("Host", prefs={t_pep: PersonToppingPreference.LIKE})
+        order = make_order(restaurant, host, [host], num_pizzas=2)
+        order.invite_token = uuid.uuid4()
+        order.save()
+        self.client.post(reverse('order_join', args=[order.invite_token]), {'name': 'Gina'})
+        with mock.patch('webapp.exact.MAX_PARTITIONS', 0):
+            solve_once(order)
+        body = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('pizza_request_duration_seconds_count{view="order_join"}', body)
+        self.assertIn('pizza_guest_joins_total ', body)
+        self.assertIn('pizza_solve_duration_seconds_count{backend="cbc",mode="maximize_likes"}', body)
+        self.assertIn('pizza_solve_model_variables_count{mode="maximize_likes"}', body)
+        self.assertIn('pizza_cache_requests_total{cache="preferences",result="miss"}', body)
+        self.assertIn('pizza_cache_hit_ratio{cache="preferences"}', body)
+
+    def test_sums_other_workers_files(self):
+        from . import metrics
+        other = {
+            'counters': [['pizza_guest_joins_total', [], 5]],
+            'histograms': [['pizza_request_duration_seconds', [['view', 'elsewhere']], [1] + [0] * 11 + [0.004]]],
+        }
+        for n in range(2):
+            with open(os.path.join(self.dir, f'metrics-{n}-test.json'), 'w') as f:
+                json.dump(other, f)
+        counters, histograms, pools = metrics.collect()
+        self.assertGreaterEqual(counters['pizza_guest_joins_total', ()], 10)
+        body = metrics.render()
+        self.assertIn('pizza_request_duration_seconds_bucket{view="elsewhere",le="0.005"} 2', body)
+        self.assertIn('pizza_request_duration_seconds_bucket{view="elsewhere",le="+Inf"} 2', body)
+        self.assertIn('pizza_request_duration_seconds_sum{view="elsewhere"} 0.008', body)
+
+    def test_exports_pool_stats_of_every_worker(self):
+        from . import metrics
+        stopped = {'counters': [], 'histograms': [], 'pools': {
+            'default': {'pool_size': 4, 'pool_available': 4, 'requests_num': 30, 'requests_wait_ms': 7},
+        }}
+        # pid 0 is never a worker, so this file belongs to one that has exited.
+        with open(os.path.join(self.dir, 'metrics-0-test.json'), 'w') as f:
+            json.dump(stopped, f)
+        own = {'default': {'pool_size': 2, 'pool_available': 1, 'requests_num': 12}}
+        with mock.patch('webapp.dbpool.pool_stats', return_value=own):
+            body = metrics.render()
+        self.assertIn('# TYPE pizza_db_pool_pool_size gauge', body)
+        self.assertIn('pizza_db_pool_pool_size{database="default"} 2', body)
+        self.assertIn('pizza_db_pool_pool_available{database="default"} 1', body)
+        self.assertIn('# TYPE pizza_db_pool_requests_num_total counter', body)
+        self.assertIn('pizza_db_pool_requests_num_total{database="default"} 42', body)
+        self.assertIn('pizza_db_pool_requests_wait_ms_total{database="default"} 7', body)
+        self.assertIn('pizza_db_pool_connections_lost_total{database="default"} 0', body)
+
+    def test_no_pool_metrics_without_a_pool(self):
+        from . import metrics
+        self.assertNotIn('pizza_db_pool_', metrics.render())
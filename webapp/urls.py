@@ -11,6 +11,8 @@ urlpatterns = [
     path('orders/<int:order_id>/cancel-invite/', views.order_cancel_invite, name='order_cancel_invite'),
     path('orders/<int:order_id>/people-partial/', views.order_people_partial, name='order_people_partial'),
     path('orders/join/<uuid:invite_token>/', views.order_join, name='order_join'),
+    path('orders/join/<uuid:invite_token>/preferences/<int:topping_id>/', views.order_join_autosave,
+         name='order_join_autosave'),
 
     path('toppings/', views.topping_list, name='topping_list'),
     path('toppings/new/', views.topping_create, name='topping_create'),
@@ -19,6 +21,17 @@ urlpatterns = [
     path('toppings/<int:pk>/delete/', views.topping_delete, name='topping_delete'),
 
     path('staff/preferences/', views.staff_preferences, name='staff_preferences'),
+    path('staff/preferences/<int:group_id>/matrix/', views.staff_preferences_matrix, name='staff_preferences_matrix'),
+    path('staff/preferences/<int:group_id>/export/', views.staff_preferences_export, name='staff_preferences_export'),
+    path('staff/orders/export/', views.staff_orders_export, name='staff_orders_export'),
+    path('staff/import/', views.staff_import, name='staff_import'),
+    path('staff/db-pool/', views.staff_db_pool, name='staff_db_pool'),
+    path('staff/profiles/', views.staff_profiles, name='staff_profiles'),
+    path('staff/profiles/<int:pk>/', views.staff_profile_detail, name='staff_profile_detail'),
+    path('staff/profiles/<int:pk>/download/', views.staff_profile_download, name='staff_profile_download'),
+
+    # No trailing slash: the path Prometheus scrapes by default.
+    path('metrics', views.metrics_endpoint, name='metrics'),
 
     path('restaurants/', views.restaurant_list, name='restaurant_list'),
     path('restaurants/new/', views.restaurant_create, name='restaurant_create'),
@@ -27,10 +40,13 @@ urlpatterns = [
     path('restaurants/<int:pk>/delete/', views.restaurant_delete, name='restaurant_delete'),
 
     path('profile/edit/', views.profile_edit, name='profile_edit'),
+    path('profile/preferences/<int:topping_id>/', views.profile_preference_autosave,
+         name='profile_preference_autosave'),
 
     path('groups/', views.group_list, name='group_list'),
     path('groups/new/', views.group_create, name='group_create'),
     path('groups/<int:pk>/', views.group_detail, name='group_detail'),
+    path('groups/<int:pk>/orders/', views.group_orders, name='group_orders'),
     path('groups/<int:pk>/delete/', views.group_delete, name='group_delete'),
     path('groups/join/<uuid:token>/', views.group_join, name='group_join'),
     path('groups/<int:pk>/reset-invite/', views.group_reset_invite, name='group_reset_invite'),
@@ -1,6 +1,7 @@
 from constance import config
 
 from webapp.models import PersonToppingPreference
+from webapp.preferences import load_preferences
 
 def compute_pizza_scores(pizza_list):
     """Return a dict mapping pizza.pk -> integer score based on preferences."""
@@ -16,23 +17,17 @@ def compute_pizza_scores(pizza_list):
         for t in toppings:
             all_toppings[t.pk] = t
 
-    pref_map = {}
-    if all_people and all_toppings:
-        for person_id, topping_id, pref in PersonToppingPreference.objects.filter(
-            person_id__in=all_people.keys(),
-            topping_id__in=all_toppings.keys(),
-        ).values_list('person_id', 'topping_id', 'preference'):
-            pref_map[(person_id, topping_id)] = pref
+    matrix = load_preferences(all_people.values())
 
+    dislike_weight = config.DISLIKE_WEIGHT  # one settings read, not one per person-topping pair
     scores = {}
     for pizza_pk, (people, toppings) in pizza_data.items():
         score = 0
         for person in people:
-            default = PersonToppingPreference.DISLIKE if person.unrated_is_dislike else PersonToppingPreference.NEUTRAL
             for topping in toppings:
-                pref = pref_map.get((person.pk, topping.pk), default)
+                pref = matrix.get(person.pk, topping.pk)
                 if pref == PersonToppingPreference.DISLIKE:
-                    score += config.DISLIKE_WEIGHT
+                    score += dislike_weight
                 elif pref not in (PersonToppingPreference.NEUTRAL, PersonToppingPreference.ALLERGY):
                     score += pref
         scores[pizza_pk] = score
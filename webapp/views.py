@@ -3,33 +3,64 @@ import re
 import uuid
 
 from allauth.account.views import SignupView as AllauthSignupView
+from asgiref.sync import sync_to_async
+from constance import config
+from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import transaction
+from django.db.models import Exists, OuterRef
 from django.db.models.functions import Lower
-from django.shortcuts import render, redirect, get_object_or_404
+from django.shortcuts import render, redirect, get_object_or_404, aget_object_or_404
 from django.contrib import messages
-from django.http import HttpResponseForbidden
+from django.http import (
+    Http404, HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse, StreamingHttpResponse,
+)
 from django.urls import reverse
+from django.utils.functional import SimpleLazyObject
 from django.views.decorators.http import require_POST
 
 from .forms import (
     NewOrderForm, DraftOrderForm, GuestPreferenceForm,
     MergeToppingForm, PersonProfileForm, PizzaGroupForm, ToppingForm, RestaurantForm,
-    CloneRestaurantForm,
+    CloneRestaurantForm, BulkImportForm,
 )
 from .models import (
     GroupMembership, Order, OrderedPizza,
-    Person, PersonToppingPreference, PizzaGroup, Topping, PizzaRestaurant, RestaurantTopping,
+    Person, PersonToppingPreference, PizzaGroup, Topping, PizzaRestaurant, RequestProfile, RestaurantTopping,
 )
-from .solver import solve
+from . import exports, metrics
+from .archive import load_archived_order
+from .caching import bump_on_commit, restaurant_versions, versions_key
+from .dbpool import pool_report
+from .guests import get_guest_id, set_guest_cookie
+from .imports import BulkImportError, import_data
+from .middleware import person_context_cache_key
+from .pagination import keyset_page
+from .preferences import load_preferences, preferences_changed, write_preferences
+from .routers import replica_reads
+from .solver import solve_once
 from .utils import compute_pizza_scores
 
+# Templates and context processors (auth, constance) run synchronously, so async
+# views load their data with the async ORM and then hand off to render() here.
+arender = sync_to_async(render)
+
 # ---------------------------------------------------------------------------
 # Profile
 # ---------------------------------------------------------------------------
 
 _GROUP_JOIN_RE = re.compile(r'^/groups/join/([0-9a-f-]{36})/?$')
 
+PROFILE_PREFERENCE_VALUES = {
+    'allergy': PersonToppingPreference.ALLERGY,
+    'dislike': PersonToppingPreference.DISLIKE,
+    'neutral': PersonToppingPreference.NEUTRAL,
+    'like': PersonToppingPreference.LIKE,
+}
+
 
 class CustomSignupView(AllauthSignupView):
     def get_success_url(self):
@@ -57,13 +88,10 @@ def profile_edit(request):
         except (ValueError, PizzaGroup.DoesNotExist):
             pass
 
-    toppings = Topping.objects.order_by('name')
-
-    pref_qs = PersonToppingPreference.objects.filter(person=person)
-    allergy_ids = set(pref_qs.filter(preference=PersonToppingPreference.ALLERGY).values_list('topping_id', flat=True))
-    dislike_ids = set(pref_qs.filter(preference=PersonToppingPreference.DISLIKE).values_list('topping_id', flat=True))
-    neutral_ids = set(pref_qs.filter(preference=PersonToppingPreference.NEUTRAL).values_list('topping_id', flat=True))
-    like_ids = set(pref_qs.filter(preference=PersonToppingPreference.LIKE).values_list('topping_id', flat=True))
+    toppings = list(Topping.objects.order_by('name'))
+    current = dict(
+        PersonToppingPreference.objects.filter(person=person).values_list('topping_id', 'preference')
+    )
 
     if request.method == 'POST':
         form = PersonProfileForm(request.POST, instance=person)
@@ -72,27 +100,11 @@ def profile_edit(request):
             new_prefs = {}
 
             for topping in toppings:
-                val_str = request.POST.get(f'pref_{topping.pk}')
-                if val_str == 'allergy':
-                    new_prefs[topping.pk] = PersonToppingPreference.ALLERGY
-                elif val_str == 'dislike':
-                    new_prefs[topping.pk] = PersonToppingPreference.DISLIKE
-                elif val_str == 'neutral':
-                    new_prefs[topping.pk] = PersonToppingPreference.NEUTRAL
-                elif val_str == 'like':
-                    new_prefs[topping.pk] = PersonToppingPreference.LIKE
-
-            to_delete = [t.pk for t in toppings if t.pk not in new_prefs]
-            if to_delete:
-                PersonToppingPreference.objects.filter(person=person, topping_id__in=to_delete).delete()
-            if new_prefs:
-                PersonToppingPreference.objects.bulk_create(
-                    [PersonToppingPreference(person=person, topping_id=tid, preference=pref)
-                     for tid, pref in new_prefs.items()],
-                    update_conflicts=True,
-                    unique_fields=['person', 'topping'],
-                    update_fields=['preference'],
-                )
+                pref = PROFILE_PREFERENCE_VALUES.get(request.POST.get(f'pref_{topping.pk}'))
+                if pref is not None:
+                    new_prefs[topping.pk] = pref
+
+            write_preferences(person.pk, current, new_prefs, [t.pk for t in toppings])
 
             messages.success(request, "Your preferences have been saved.")
             if setup_mode:
@@ -105,21 +117,39 @@ def profile_edit(request):
     return render(request, template, {
         'form': form,
         'toppings': toppings,
-        'allergy_ids': allergy_ids,
-        'dislike_ids': dislike_ids,
-        'neutral_ids': neutral_ids,
-        'like_ids': like_ids,
+        'allergy_ids': {tid for tid, pref in current.items() if pref == PersonToppingPreference.ALLERGY},
+        'dislike_ids': {tid for tid, pref in current.items() if pref == PersonToppingPreference.DISLIKE},
+        'neutral_ids': {tid for tid, pref in current.items() if pref == PersonToppingPreference.NEUTRAL},
+        'like_ids': {tid for tid, pref in current.items() if pref == PersonToppingPreference.LIKE},
+        'autosave': not setup_mode,
     })
 
 
+@login_required
+@require_POST
+def profile_preference_autosave(request, topping_id):
+    """HTMX endpoint: persist a single topping rating from the profile page ('' clears it)."""
+    person = Person.get_from_request(request)
+    topping = get_object_or_404(Topping, pk=topping_id)
+    value = request.POST.get(f'pref_{topping.pk}', '')
+    if value and value not in PROFILE_PREFERENCE_VALUES:
+        return HttpResponseBadRequest("Unknown preference.")
+    current = dict(
+        PersonToppingPreference.objects.filter(person=person, topping=topping).values_list('topping_id', 'preference')
+    )
+    wanted = {topping.pk: PROFILE_PREFERENCE_VALUES[value]} if value else {}
+    write_preferences(person.pk, current, wanted, [topping.pk])
+    return HttpResponse(status=204)
+
+
 # ---------------------------------------------------------------------------
 # Orders
 # ---------------------------------------------------------------------------
 
-def _run_solver(request, order):
+def _run_solver(request, order, recompute=False, quality=None):
     """Run the solver on an order. Returns a redirect response, or None to re-render."""
     try:
-        solve(order)
+        _, reused = solve_once(order, recompute=recompute, quality=quality)
     except NotImplementedError:
         messages.warning(
             request,
@@ -130,25 +160,28 @@ def _run_solver(request, order):
     except ValueError as e:
         messages.error(request, f"Solver error: {e}")
         return None
+    if reused:
+        messages.info(request, "This order was already generated; showing the existing results.")
+        return redirect('order_results', order_id=order.id)
     messages.success(request, "Pizza order generated successfully!")
     return redirect('order_results', order_id=order.id)
 
 @login_required
 def order_select_group(request):
     """Redirect single-group users straight to the order form; multi-group users pick a group."""
-    person = Person.get_from_request(request)
-    groups = list(person.pizza_groups.all())
-    if not groups:
+    group_ids = request.person_context.group_ids
+    if not group_ids:
         messages.info(request, "You need to belong to a group before creating an order.")
         return redirect('group_list')
-    if len(groups) == 1:
-        return redirect('new_order', group_id=groups[0].pk)
+    if len(group_ids) == 1:
+        return redirect('new_order', group_id=next(iter(group_ids)))
     if request.method == 'POST':
         try:
-            group = person.pizza_groups.get(pk=request.POST.get('group'))
-            return redirect('new_order', group_id=group.pk)
-        except PizzaGroup.DoesNotExist:
+            if int(request.POST.get('group', '')) in group_ids:
+                return redirect('new_order', group_id=int(request.POST['group']))
+        except ValueError:
             pass
+    groups = list(PizzaGroup.objects.filter(pk__in=group_ids))
     return render(request, 'webapp/order_select_group.html', {'groups': groups})
 
 
@@ -160,15 +193,16 @@ def new_order(request, group_id):
     """
     person = Person.get_from_request(request)
     selected_group = get_object_or_404(PizzaGroup, pk=group_id)
-    get_object_or_404(GroupMembership, group=selected_group, person=person)
-    can_change_group = person.pizza_groups.count() > 1
+    request.person_context.require_member(selected_group.pk)
+    can_change_group = len(request.person_context.group_ids) > 1
 
     if request.method == 'POST':
         if 'invite_guests' in request.POST:
             restaurant_id = request.POST.get('restaurant')
             if not restaurant_id:
                 messages.error(request, "Please select a restaurant before inviting guests.")
-                form = NewOrderForm(request.POST, host=person, selected_group=selected_group)
+                form = NewOrderForm(request.POST, host=person, selected_group=selected_group,
+                                    allow_exact=request.user.is_staff)
                 return render(request, 'webapp/order_new.html', {
                     'form': form, 'host': person, 'selected_group': selected_group,
                     'can_change_group': can_change_group,
@@ -186,7 +220,8 @@ def new_order(request, group_id):
             order.people.add(person)
             return redirect('draft_order', group_id=selected_group.pk, order_id=order.pk)
 
-        form = NewOrderForm(request.POST, host=person, selected_group=selected_group)
+        form = NewOrderForm(request.POST, host=person, selected_group=selected_group,
+                            allow_exact=request.user.is_staff)
         if form.is_valid():
             data = form.cleaned_data
             target_order = Order.objects.create(
@@ -195,6 +230,7 @@ def new_order(request, group_id):
                 num_pizzas=data['num_pizzas'],
                 optimization_mode=data['optimization_mode'],
                 shareability_bonus_weight=data['shareability_bonus_weight'],
+                solve_quality=data['solve_quality'],
                 group=selected_group,
             )
             target_order.people.set(set(data['people']) | {person})
@@ -202,7 +238,7 @@ def new_order(request, group_id):
             if result is not None:
                 return result
     else:
-        form = NewOrderForm(host=person, selected_group=selected_group)
+        form = NewOrderForm(host=person, selected_group=selected_group, allow_exact=request.user.is_staff)
 
     if form.is_bound:
         current_person_pks = set(int(pk) for pk in (form['people'].value() or []))
@@ -227,8 +263,8 @@ def draft_order(request, group_id, order_id):
     """
     person = Person.get_from_request(request)
     selected_group = get_object_or_404(PizzaGroup, pk=group_id)
-    get_object_or_404(GroupMembership, group=selected_group, person=person)
-    can_change_group = person.pizza_groups.count() > 1
+    request.person_context.require_member(selected_group.pk)
+    can_change_group = len(request.person_context.group_ids) > 1
 
     proto_order = get_object_or_404(Order, pk=order_id, host=person, invite_token__isnull=False)
     if proto_order.pizzas.exists():
@@ -238,12 +274,14 @@ def draft_order(request, group_id, order_id):
     guest_pks = set(proto_order.guest_persons.values_list('pk', flat=True))
 
     if request.method == 'POST':
-        form = DraftOrderForm(request.POST, host=person, selected_group=selected_group, proto_order=proto_order)
+        form = DraftOrderForm(request.POST, host=person, selected_group=selected_group, proto_order=proto_order,
+                              allow_exact=request.user.is_staff)
         if form.is_valid():
             data = form.cleaned_data
             proto_order.num_pizzas = data['num_pizzas']
             proto_order.optimization_mode = data['optimization_mode']
             proto_order.shareability_bonus_weight = data['shareability_bonus_weight']
+            proto_order.solve_quality = data['solve_quality']
             proto_order.save()
             proto_order.people.set(set(data['people']) | {person})
             result = _run_solver(request, proto_order)
@@ -253,11 +291,13 @@ def draft_order(request, group_id, order_id):
         participants_excl_host = proto_order.people.exclude(pk=person.pk)
         form = DraftOrderForm(
             host=person, selected_group=selected_group, proto_order=proto_order,
+            allow_exact=request.user.is_staff,
             initial={
                 'people': list(participants_excl_host.values_list('pk', flat=True)),
                 'num_pizzas': proto_order.num_pizzas,
                 'optimization_mode': proto_order.optimization_mode,
                 'shareability_bonus_weight': proto_order.shareability_bonus_weight,
+                'solve_quality': proto_order.solve_quality,
             },
         )
 
@@ -279,27 +319,59 @@ def draft_order(request, group_id, order_id):
     })
 
 
-def order_results(request, order_id):
+@replica_reads
+async def order_results(request, order_id):
     """Results page for a solved order. Unsolved orders redirect back to create_order."""
-    order = get_object_or_404(Order, pk=order_id)
-    person = getattr(request.user, 'person_profile', None) if request.user.is_authenticated else None
-    if not person or not person.pizza_groups.filter(pk=order.group_id).exists():
+    order = await Order.objects.select_related('restaurant', 'host').filter(pk=order_id).afirst()
+    if order is None:
+        return await _archived_order_results(request, order_id)
+    person = await request.person_context.aperson()
+    if not person or order.group_id not in await request.person_context.amemberships():
         return HttpResponseForbidden("You don't have permission to view this order.")
-    if not order.pizzas.exists():
+    if not await order.pizzas.aexists():
         if order.invite_token:
-            return redirect('draft_order', group_id=order.group.pk, order_id=order.pk)
-        return redirect('new_order', group_id=order.group.pk)
-    pizza_list = list(order.pizzas.prefetch_related('toppings', 'people').all())
-    guest_person_ids = set(order.guest_persons.values_list('pk', flat=True))
-    if request.user.is_staff:
-        scores = compute_pizza_scores(pizza_list)
-        pizzas_with_scores = [(p, scores[p.pk]) for p in pizza_list]
-    else:
-        pizzas_with_scores = [(p, None) for p in pizza_list]
-    return render(request, 'webapp/order_results.html', {
+            return redirect('draft_order', group_id=order.group_id, order_id=order.pk)
+        return redirect('new_order', group_id=order.group_id)
+    is_staff = (await request.auser()).is_staff
+
+    # The results fragment is cached per order version, so the pizzas are only
+    # loaded (lazily, during rendering) when the fragment has to be rebuilt.
+    def pizzas_with_scores():
+        pizza_list = list(order.pizzas.prefetch_related('toppings', 'people'))
+        scores = compute_pizza_scores(pizza_list) if is_staff else {}
+        return [(p, scores.get(p.pk)) for p in pizza_list]
+
+    return await arender(request, 'webapp/order_results.html', {
+        'order': order,
+        'pizzas_with_scores': SimpleLazyObject(pizzas_with_scores),
+        'guest_person_ids': SimpleLazyObject(lambda: set(order.guest_persons.values_list('pk', flat=True))),
+        'fragment_timeout': settings.FRAGMENT_CACHE_TIMEOUT,
+        'cache_key': await sync_to_async(_results_cache_key)(order, is_staff),
+    })
+
+
+def _results_cache_key(order, is_staff):
+    """Vary the results fragment on the restaurant, the people's names and ratings, and for staff on the score weights."""
+    person_versions = [f'person:{pk}' for pk in order.people.values_list('pk', flat=True)]
+    key = versions_key('toppings', f'restaurant:{order.restaurant_id}', *person_versions)
+    return f'{key}-{config.DISLIKE_WEIGHT}' if is_staff else key
+
+
+async def _archived_order_results(request, order_id):
+    """Results page for an order moved to cold storage by archive_orders."""
+    order = await sync_to_async(load_archived_order)(order_id)
+    if order is None:
+        raise Http404("No Order matches the given query.")
+    person = await request.person_context.aperson()
+    if not person or order.group_id not in await request.person_context.amemberships():
+        return HttpResponseForbidden("You don't have permission to view this order.")
+    is_staff = (await request.auser()).is_staff
+    return await arender(request, 'webapp/order_results.html', {
         'order': order,
-        'pizzas_with_scores': pizzas_with_scores,
-        'guest_person_ids': guest_person_ids,
+        'pizzas_with_scores': [(pizza, score if is_staff else None) for pizza, score in order.pizzas_with_scores],
+        'guest_person_ids': order.guest_person_ids,
+        'fragment_timeout': settings.FRAGMENT_CACHE_TIMEOUT,
+        'cache_key': 'archived',
     })
 
 
@@ -307,10 +379,16 @@ def order_results(request, order_id):
 @staff_member_required
 @require_POST
 def recompute_order(request, order_id):
-    """Delete existing pizza assignments and re-run the solver. Staff only."""
+    """Replace existing pizza assignments by re-running the solver. Staff only.
+
+    An optional solve_quality field re-solves at that tier, e.g. 'exact' for a hard order.
+    The tier applies to this run only; the order keeps its own for later recomputes.
+    """
     order = get_object_or_404(Order, pk=order_id)
-    order.pizzas.all().delete()
-    return _run_solver(request, order)
+    quality = request.POST.get('solve_quality')
+    if quality not in dict(Order.SOLVE_QUALITY_CHOICES):
+        quality = None
+    return _run_solver(request, order, recompute=True, quality=quality) or redirect('order_results', order_id=order.pk)
 
 
 # ---------------------------------------------------------------------------
@@ -322,8 +400,8 @@ def recompute_order(request, order_id):
 def order_cancel_invite(request, order_id):
     """Host-only POST: delete the proto-order (and its guests), redirect to create_order."""
     order = get_object_or_404(Order, pk=order_id, invite_token__isnull=False)
-    person = get_object_or_404(Person, user_account=request.user)
-    if order.host != person:
+    person = Person.get_from_request(request)
+    if order.host_id != person.pk:
         return HttpResponseForbidden("Only the host can cancel this invite.")
     if order.pizzas.exists():
         return redirect('order_results', order_id=order.pk)
@@ -333,71 +411,73 @@ def order_cancel_invite(request, order_id):
 
 
 @login_required
-def order_people_partial(request, order_id):
+@replica_reads
+async def order_people_partial(request, order_id):
     """Partial HTML for the people-selector tags; used by HTMX polling on the create page."""
-    order = get_object_or_404(Order, pk=order_id, invite_token__isnull=False)
-    person = get_object_or_404(Person, user_account=request.user)
-    if order.host != person:
+    order = await aget_object_or_404(Order, pk=order_id, invite_token__isnull=False)
+    person = await request.person_context.aperson()
+    if order.host_id != person.pk:
         return HttpResponseForbidden("Only the host can view this.")
     guest_persons = order.guest_persons.all()
-    group_members_excl_host = order.group.members.exclude(pk=person.pk)
+    group_members_excl_host = Person.objects.filter(pizza_groups=order.group_id).exclude(pk=person.pk)
     # TODO: figure out why this isn't redundant
-    people = (group_members_excl_host | guest_persons).distinct()
-    return render(request, 'webapp/_people_tags_partial.html', {
+    people = [p async for p in (group_members_excl_host | guest_persons).distinct()]
+    return await arender(request, 'webapp/_people_tags_partial.html', {
         'people': people,
-        'guest_pks': set(guest_persons.values_list('pk', flat=True)),
-        'current_person_pks': set(order.people.exclude(pk=person.pk).values_list('pk', flat=True)),
+        'guest_pks': {pk async for pk in guest_persons.values_list('pk', flat=True)},
+        'current_person_pks': {
+            pk async for pk in order.people.exclude(pk=person.pk).values_list('pk', flat=True)
+        },
     })
 
 
-def order_join(request, invite_token):
-    """No-auth guest join page. Session dedup prevents duplicate entries."""
-    order = get_object_or_404(Order, invite_token=invite_token)
-    toppings = list(order.restaurant.toppings.all().order_by('name'))
+async def order_join(request, invite_token):
+    """No-auth guest join page. A signed per-order cookie prevents duplicate entries."""
+    order = await aget_object_or_404(Order.objects.select_related('restaurant'), invite_token=invite_token)
+    toppings = [t async for t in order.restaurant.toppings.order_by('name')]
     all_topping_pks = {t.pk for t in toppings}
-    session_key = f'guest_person_{order.pk}'
 
-    if order.pizzas.exists():
-        return render(request, 'webapp/guests/join.html', {
+    if await order.pizzas.aexists():
+        return await arender(request, 'webapp/guests/join.html', {
             'order': order,
             'already_solved': True,
         })
 
-    existing_pk = request.session.get(session_key)
+    existing_pk = get_guest_id(request, order)
     guest = None
     if existing_pk:
-        guest = Person.objects.filter(pk=existing_pk, guest_for_order=order).first()
+        guest = await Person.objects.filter(pk=existing_pk, guest_for_order=order).afirst()
     if request.method == 'POST':
         # create the guest if they don't exist
         if not guest:
             name = request.POST.get('name', '').strip()
             if not name:
-                return render(request, 'webapp/guests/join.html', {
+                return await arender(request, 'webapp/guests/join.html', {
                     'order': order,
                     'toppings': toppings,
                     'error': 'Please enter your name.',
                     'neutral_ids': all_topping_pks,
                 })
-            guest = Person.objects.create(name=name, email='', guest_for_order=order)
-            order.people.add(guest)
-            request.session[session_key] = guest.pk
+            guest = await Person.objects.acreate(name=name, email='', guest_for_order=order)
+            await order.people.aadd(guest)
+            metrics.inc('pizza_guest_joins_total')
 
-        prefs = []
+        wanted = {}
         for topping in toppings:
             val = request.POST.get(f'pref_{topping.pk}', '0')
             try:
-                pref_val = int(val)
+                wanted[topping.pk] = int(val)
             except ValueError:
-                pref_val = 0
-            prefs.append(PersonToppingPreference(person=guest, topping=topping, preference=pref_val))
-        PersonToppingPreference.objects.bulk_create(
-            prefs,
-            update_conflicts=True,
-            unique_fields=['person', 'topping'],
-            update_fields=['preference'],
-        )
+                wanted[topping.pk] = 0
+        current = {}
+        if existing_pk:
+            current = {
+                topping_id: pref async for topping_id, pref in
+                guest.topping_preferences.filter(topping__in=all_topping_pks).values_list('topping_id', 'preference')
+            }
+        await sync_to_async(write_preferences)(guest.pk, current, wanted, all_topping_pks)
         messages.success(request, f"Your preferences have been saved!")
-        return redirect('order_join', invite_token=invite_token)
+        return set_guest_cookie(redirect('order_join', invite_token=invite_token), order, guest.pk)
 
     allergy_ids = set()
     dislike_ids = set()
@@ -405,17 +485,19 @@ def order_join(request, invite_token):
     like_ids = set()
     if guest:
         # existing + get -> get split toppings for display + render
-        pref_qs = guest.topping_preferences.filter(topping__in=toppings)
-        allergy_ids = set(
-            pref_qs.filter(preference=PersonToppingPreference.ALLERGY).values_list('topping_id', flat=True))
-        dislike_ids = set(
-            pref_qs.filter(preference=PersonToppingPreference.DISLIKE).values_list('topping_id', flat=True))
-        neutral_ids = set(
-            pref_qs.filter(preference=PersonToppingPreference.NEUTRAL).values_list('topping_id', flat=True))
-        like_ids = set(
-            pref_qs.filter(preference=PersonToppingPreference.LIKE).values_list('topping_id', flat=True))
-
-    return render(request, 'webapp/guests/join.html', {
+        buckets = {
+            PersonToppingPreference.ALLERGY: allergy_ids,
+            PersonToppingPreference.DISLIKE: dislike_ids,
+            PersonToppingPreference.NEUTRAL: set(),
+            PersonToppingPreference.LIKE: like_ids,
+        }
+        pref_qs = guest.topping_preferences.filter(topping__in=all_topping_pks)
+        async for topping_id, pref in pref_qs.values_list('topping_id', 'preference'):
+            if pref in buckets:
+                buckets[pref].add(topping_id)
+        neutral_ids = buckets[PersonToppingPreference.NEUTRAL]
+
+    return await arender(request, 'webapp/guests/join.html', {
         'order': order,
         'toppings': toppings,
         'guest': guest,
@@ -426,11 +508,36 @@ def order_join(request, invite_token):
     })
 
 
+@require_POST
+async def order_join_autosave(request, invite_token, topping_id):
+    """HTMX endpoint: persist a single topping rating for the returning guest in this browser."""
+    order = await aget_object_or_404(Order, invite_token=invite_token)
+    existing_pk = get_guest_id(request, order)
+    if not existing_pk or await order.pizzas.aexists():
+        return HttpResponseForbidden("Preferences can no longer be changed.")
+    guest = await aget_object_or_404(Person, pk=existing_pk, guest_for_order=order)
+    if not await RestaurantTopping.objects.filter(restaurant_id=order.restaurant_id, topping_id=topping_id).aexists():
+        raise Http404("No Topping matches the given query.")
+    try:
+        pref = int(request.POST.get(f'pref_{topping_id}', ''))
+    except ValueError:
+        return HttpResponseBadRequest("Unknown preference.")
+    if pref not in PROFILE_PREFERENCE_VALUES.values():
+        return HttpResponseBadRequest("Unknown preference.")
+    current = {
+        tid: p async for tid, p in
+        guest.topping_preferences.filter(topping_id=topping_id).values_list('topping_id', 'preference')
+    }
+    await sync_to_async(write_preferences)(guest.pk, current, {topping_id: pref}, [topping_id])
+    return HttpResponse(status=204)
+
+
 # ---------------------------------------------------------------------------
 # Groups
 # ---------------------------------------------------------------------------
 
 @login_required
+@replica_reads
 def group_list(request):
     person = Person.get_from_request(request)
     memberships = GroupMembership.objects.filter(person=person).select_related('group')
@@ -452,18 +559,51 @@ def group_create(request):
     return render(request, 'webapp/groups/form.html', {'form': form, 'action': 'Create'})
 
 
+ROSTER_PAGE_SIZE = 100
+ORDER_HISTORY_PAGE_SIZE = 25
+
+
 @login_required
+@replica_reads
 def group_detail(request, pk):
     group = get_object_or_404(PizzaGroup, pk=pk)
-    person = Person.get_from_request(request)
-    membership = get_object_or_404(GroupMembership, group=group, person=person)
-    memberships = GroupMembership.objects.filter(group=group).select_related('person')
+    is_admin = request.person_context.require_member(group.pk)
+    cursor = request.GET.get('after')
+    # Lazy, so a cached member table costs no roster query.
+    page = SimpleLazyObject(lambda: keyset_page(
+        GroupMembership.objects.filter(group=group).select_related('person'),
+        ['person'], cursor, per_page=ROSTER_PAGE_SIZE,
+    ))
     invite_url = request.build_absolute_uri(f'/groups/join/{group.invite_token}/')
     return render(request, 'webapp/groups/detail.html', {
         'group': group,
-        'memberships': memberships,
-        'is_admin': membership.is_admin,
+        'page': page,
+        'cursor': cursor or '',
+        'is_admin': is_admin,
         'invite_url': invite_url,
+        'fragment_timeout': settings.FRAGMENT_CACHE_TIMEOUT,
+        'cache_key': versions_key(f'group-members:{group.pk}'),
+    })
+
+
+@login_required
+@replica_reads
+def group_orders(request, pk):
+    """A group's order history, newest first, keyset-paginated on (created_at, id)."""
+    group = get_object_or_404(PizzaGroup, pk=pk)
+    request.person_context.require_member(group.pk)
+    cursor = request.GET.get('after')
+    page = keyset_page(
+        Order.objects.filter(group=group).select_related('restaurant', 'host').annotate(
+            has_pizzas=Exists(OrderedPizza.objects.filter(order=OuterRef('pk'))),
+        ),
+        ['-created_at', '-id'], cursor, per_page=ORDER_HISTORY_PAGE_SIZE,
+    )
+    return render(request, 'webapp/groups/orders.html', {
+        'group': group,
+        'orders': page.items,
+        'page': page,
+        'is_first_page': not cursor,
     })
 
 
@@ -483,9 +623,7 @@ def group_join(request, token):
 @require_POST
 def group_reset_invite(request, pk):
     group = get_object_or_404(PizzaGroup, pk=pk)
-    person = get_object_or_404(Person, user_account=request.user)
-    membership = get_object_or_404(GroupMembership, group=group, person=person)
-    if not membership.is_admin:
+    if not request.person_context.require_member(group.pk):
         return HttpResponseForbidden("Only admins can reset the invite link.")
     group.invite_token = uuid.uuid4()
     group.save()
@@ -497,12 +635,14 @@ def group_reset_invite(request, pk):
 @require_POST
 def group_remove_member(request, pk, person_pk):
     group = get_object_or_404(PizzaGroup, pk=pk)
-    requester = get_object_or_404(Person, user_account=request.user)
-    requester_membership = get_object_or_404(GroupMembership, group=group, person=requester)
-    if not requester_membership.is_admin:
+    if not request.person_context.require_member(group.pk):
         return HttpResponseForbidden("Only admins can remove members.")
     target_person = get_object_or_404(Person, pk=person_pk)
+    # A queryset delete sends no signals (see webapp.signals).
     GroupMembership.objects.filter(group=group, person=target_person).delete()
+    bump_on_commit(f'group-members:{group.pk}')
+    if target_person.user_account_id:
+        transaction.on_commit(lambda: cache.delete(person_context_cache_key(target_person.user_account_id)))
     messages.success(request, f"{target_person.name} removed from {group.name}.")
     return redirect('group_detail', pk=pk)
 
@@ -510,9 +650,7 @@ def group_remove_member(request, pk, person_pk):
 @login_required
 def group_delete(request, pk):
     group = get_object_or_404(PizzaGroup, pk=pk)
-    person = get_object_or_404(Person, user_account=request.user)
-    membership = get_object_or_404(GroupMembership, group=group, person=person)
-    if not membership.is_admin:
+    if not request.person_context.require_member(group.pk):
         return HttpResponseForbidden("Only admins can delete groups.")
     if request.method == 'POST':
         name = group.name
@@ -527,9 +665,14 @@ def group_delete(request, pk):
 # ---------------------------------------------------------------------------
 
 @login_required
+@replica_reads
 def topping_list(request):
     toppings = Topping.objects.order_by(Lower('name'))
-    return render(request, 'webapp/toppings/list.html', {'toppings': toppings})
+    return render(request, 'webapp/toppings/list.html', {
+        'toppings': toppings,
+        'fragment_timeout': settings.FRAGMENT_CACHE_TIMEOUT,
+        'cache_key': versions_key('toppings'),
+    })
 
 
 @login_required
@@ -571,26 +714,34 @@ def topping_merge(request, pk):
         if form.is_valid():
             target = form.cleaned_data['target']
 
-            for pref in PersonToppingPreference.objects.filter(topping=topping):
-                if PersonToppingPreference.objects.filter(person=pref.person, topping=target).exists():
-                    pref.delete()
-                else:
-                    pref.topping = target
-                    pref.save()
-
-            for rt in RestaurantTopping.objects.filter(topping=topping):
-                if RestaurantTopping.objects.filter(restaurant=rt.restaurant, topping=target).exists():
-                    rt.delete()
-                else:
-                    rt.topping = target
-                    rt.save()
-
-            for pizza in OrderedPizza.objects.filter(toppings=topping):
-                pizza.toppings.add(target)
-                pizza.toppings.remove(topping)
-
-            name = str(topping)
-            topping.delete()
+            # Set-based: a fixed number of statements however many people, restaurants
+            # and past pizzas use the topping. Where both toppings are present the
+            # target's row wins.
+            with transaction.atomic():
+                prefs = PersonToppingPreference.objects.filter(topping=topping)
+                person_ids = list(prefs.values_list('person_id', flat=True))
+                rated_target = PersonToppingPreference.objects.filter(topping=target).values('person_id')
+                prefs.filter(person_id__in=rated_target).delete()
+                prefs.update(topping=target)
+
+                menu_rows = RestaurantTopping.objects.filter(topping=topping)
+                restaurants = list(menu_rows.values_list('restaurant_id', 'restaurant__group_id'))
+                on_target = RestaurantTopping.objects.filter(topping=target).values('restaurant_id')
+                menu_rows.filter(restaurant_id__in=on_target).delete()
+                menu_rows.update(topping=target)
+
+                PizzaTopping = OrderedPizza.toppings.through
+                PizzaTopping.objects.bulk_create([
+                    PizzaTopping(orderedpizza_id=pizza_id, topping_id=target.pk)
+                    for pizza_id in PizzaTopping.objects.filter(topping=topping).values_list('orderedpizza_id', flat=True)
+                ], ignore_conflicts=True)
+
+                name = str(topping)
+                topping.delete()
+                # update() and queryset deletes send no signals. Both calls wait for the merge
+                # to commit, so nobody re-caches the pre-merge rows under the new versions.
+                preferences_changed(*person_ids)
+                bump_on_commit(*restaurant_versions(restaurants))
             messages.success(request, f"Topping '{name}' merged into '{target}'.")
             return redirect('topping_list')
     else:
@@ -617,77 +768,196 @@ def topping_delete(request, pk):
     return render(request, 'webapp/toppings/confirm_delete.html', {'topping': topping})
 
 
+MATRIX_MEMBERS_PER_PAGE = 50
+MATRIX_MAX_MEMBERS_PER_PAGE = 200
+
+
 @login_required
 @staff_member_required
+@replica_reads
 def staff_preferences(request):
+    """Page shell for the preference matrix; the cells are fetched from staff_preferences_matrix."""
     all_groups = PizzaGroup.objects.order_by(Lower('name'))
 
     selected_group = None
-    members = []
-    toppings = []
-    matrix = []
+    member_count = 0
+    topping_count = 0
 
     group_pk = request.GET.get('group')
     if group_pk:
         try:
             selected_group = PizzaGroup.objects.get(pk=group_pk)
-        except PizzaGroup.DoesNotExist:
+        except (PizzaGroup.DoesNotExist, ValueError):
             pass
 
     if selected_group is not None:
-        members = list(
-            selected_group.members
-            .filter(guest_for_order__isnull=True)
-            .order_by(Lower('name'))
-        )
-        toppings = list(Topping.objects.order_by(Lower('name')))
+        member_count = selected_group.members.filter(guest_for_order__isnull=True).count()
+        topping_count = Topping.objects.count()
 
-        prefs_qs = PersonToppingPreference.objects.filter(
-            person_id__in=[m.pk for m in members],
-            topping_id__in=[t.pk for t in toppings],
-        ).values('person_id', 'topping_id', 'preference')
+    return render(request, 'webapp/staff/preferences.html', {
+        'all_groups': all_groups,
+        'selected_group': selected_group,
+        'member_count': member_count,
+        'topping_count': topping_count,
+        'members_per_page': MATRIX_MEMBERS_PER_PAGE,
+    })
 
-        pref_lookup = {(row['topping_id'], row['person_id']): row['preference'] for row in prefs_qs}
 
-        pref_label = {
-            PersonToppingPreference.ALLERGY: 'allergy',
-            PersonToppingPreference.DISLIKE: 'dislike',
-            PersonToppingPreference.NEUTRAL: 'neutral',
-            PersonToppingPreference.LIKE:    'like',
-        }
-        default_label = {
-            m.pk: 'dislike' if m.unrated_is_dislike else 'neutral'
-            for m in members
-        }
+@login_required
+@staff_member_required
+@replica_reads
+def staff_preferences_matrix(request, group_id):
+    """One page of a group's preference matrix as compact JSON.
+
+    Query params: page, per_page (members per page), member and topping
+    (case-insensitive name filters). The response lists the page's members and
+    the matching toppings, plus "codes": one digit per cell, row-major by
+    topping, where 0 = unrated and 1-4 = allergy/dislike/neutral/like.
+    """
+    group = get_object_or_404(PizzaGroup, pk=group_id)
+    members = group.members.filter(guest_for_order__isnull=True).order_by(Lower('name'), 'pk')
+    toppings = Topping.objects.order_by(Lower('name'))
+    if request.GET.get('member'):
+        members = members.filter(name__icontains=request.GET['member'])
+    if request.GET.get('topping'):
+        toppings = toppings.filter(name__icontains=request.GET['topping'])
 
-        matrix = []
-        for t in toppings:
-            cells = []
-            for m in members:
-                explicit = pref_lookup.get((t.pk, m.pk))
-                if explicit is None:
-                    cells.append({'label': default_label[m.pk], 'is_default': True})
-                else:
-                    cells.append({'label': pref_label[explicit], 'is_default': False})
-            matrix.append({'topping': t, 'cells': cells})
+    try:
+        per_page = min(max(int(request.GET.get('per_page', MATRIX_MEMBERS_PER_PAGE)), 1), MATRIX_MAX_MEMBERS_PER_PAGE)
+    except ValueError:
+        per_page = MATRIX_MEMBERS_PER_PAGE
+    page = Paginator(members, per_page).get_page(request.GET.get('page'))
+    members = list(page.object_list)
+    toppings = list(toppings.values_list('pk', 'name'))
+
+    pref_matrix = load_preferences(members)
+    codes = []
+    for tid, _ in toppings:
+        for m in members:
+            pref = pref_matrix.explicit(m.pk, tid)
+            codes.append('0' if pref is None else str(pref + 3))
+    return JsonResponse({
+        'page': page.number,
+        'num_pages': page.paginator.num_pages,
+        'member_count': page.paginator.count,
+        'members': {
+            'ids': [m.pk for m in members],
+            'names': [m.name for m in members],
+            'unrated_is_dislike': [int(m.unrated_is_dislike) for m in members],
+        },
+        'toppings': {
+            'ids': [tid for tid, _ in toppings],
+            'names': [name for _, name in toppings],
+        },
+        'codes': ''.join(codes),
+    })
 
-    return render(request, 'webapp/staff/preferences.html', {
-        'all_groups': all_groups,
-        'selected_group': selected_group,
-        'members': members,
-        'toppings': toppings,
-        'matrix': matrix,
+
+def _export_response(request, lines, filename):
+    fmt = request.GET.get('format', 'csv')
+    if fmt not in exports.FORMATS:
+        raise Http404("Unknown export format.")
+    response = StreamingHttpResponse(lines(fmt), content_type=exports.CONTENT_TYPES[fmt])
+    response['Content-Disposition'] = f'attachment; filename="{filename}.{fmt}"'
+    return response
+
+
+@login_required
+@staff_member_required
+def staff_preferences_export(request, group_id):
+    group = get_object_or_404(PizzaGroup, pk=group_id)
+    return _export_response(
+        request, lambda fmt: exports.group_preferences(group, fmt), f'group-{group.pk}-preferences',
+    )
+
+
+@login_required
+@staff_member_required
+def staff_orders_export(request):
+    group = None
+    if request.GET.get('group'):
+        group = get_object_or_404(PizzaGroup, pk=request.GET['group'])
+    filename = f'group-{group.pk}-orders' if group else 'orders'
+    return _export_response(request, lambda fmt: exports.order_history(fmt, group), filename)
+
+
+@login_required
+@staff_member_required
+def staff_db_pool(request):
+    """Connection pool counters of the worker that serves this request."""
+    return JsonResponse({'pooled': settings.DB_POOL, **pool_report()})
+
+
+def metrics_endpoint(request):
+    """Prometheus metrics for METRICS_ALLOWED_IPS (no DB access) or logged-in staff."""
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS and not request.user.is_staff:
+        return HttpResponseForbidden("Forbidden")
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+PROFILES_PER_PAGE = 50
+
+
+@login_required
+@staff_member_required
+def staff_profiles(request):
+    profiles = RequestProfile.objects.select_related('user').defer('summary', 'stats')
+    page = Paginator(profiles, PROFILES_PER_PAGE).get_page(request.GET.get('page'))
+    return render(request, 'webapp/staff/profiles.html', {
+        'page': page,
+        'sample_rate': settings.PROFILE_SAMPLE_RATE,
     })
 
 
+@login_required
+@staff_member_required
+def staff_profile_detail(request, pk):
+    profile = get_object_or_404(RequestProfile.objects.select_related('user').defer('stats'), pk=pk)
+    return render(request, 'webapp/staff/profile_detail.html', {'profile': profile})
+
+
+@login_required
+@staff_member_required
+def staff_profile_download(request, pk):
+    profile = get_object_or_404(RequestProfile.objects.only('stats'), pk=pk)
+    response = HttpResponse(bytes(profile.stats), content_type='application/octet-stream')
+    response['Content-Disposition'] = f'attachment; filename="profile-{profile.pk}.prof"'
+    return response
+
+
+@login_required
+@staff_member_required
+def staff_import(request):
+    errors = []
+    form = BulkImportForm(request.POST or None, request.FILES or None)
+    if request.method == 'POST' and form.is_valid():
+        upload = form.cleaned_data['file']
+        try:
+            result = import_data(
+                upload.text, upload.format,
+                group_name=form.cleaned_data['group'],
+                create_toppings=form.cleaned_data['create_toppings'],
+            )
+        except BulkImportError as e:
+            errors = e.errors
+        else:
+            messages.success(
+                request,
+                f"Imported {result['people']} people, {result['preferences']} preferences and "
+                f"{result['restaurants']} restaurant menus.",
+            )
+            return redirect('staff_import')
+    return render(request, 'webapp/staff/import.html', {'form': form, 'errors': errors})
+
+
 # ---------------------------------------------------------------------------
 # Restaurant CRUD
 # ---------------------------------------------------------------------------
 
 @login_required
+@replica_reads
 def restaurant_list(request):
-    person = get_object_or_404(Person, user_account=request.user)
-    group_ids = list(person.pizza_groups.values_list('pk', flat=True))
+    group_ids = request.person_context.group_ids
     restaurants = (
         PizzaRestaurant.objects
         .filter(group__in=group_ids)
@@ -698,22 +968,18 @@ def restaurant_list(request):
     return render(request, 'webapp/restaurants/list.html', {
         'restaurants': restaurants,
         'can_clone': len(group_ids) > 1,
+        'fragment_timeout': settings.FRAGMENT_CACHE_TIMEOUT,
+        'cache_key': versions_key(*(f'group-restaurants:{pk}' for pk in sorted(group_ids))),
     })
 
 
 @login_required
 def restaurant_create(request):
-    person = get_object_or_404(Person, user_account=request.user)
-    groups = list(person.pizza_groups.all())
+    groups = list(PizzaGroup.objects.filter(pk__in=request.person_context.group_ids))
 
     def _get_selected_group(data):
-        try:
-            group_pk = data.get('group')
-            if group_pk:
-                return person.pizza_groups.get(pk=group_pk)
-        except PizzaGroup.DoesNotExist:
-            pass
-        return None
+        group_pk = data.get('group')
+        return next((g for g in groups if str(g.pk) == group_pk), None)
 
     if request.method == 'POST':
         selected_group = _get_selected_group(request.POST)
@@ -722,13 +988,16 @@ def restaurant_create(request):
             return redirect('restaurant_create')
         form = RestaurantForm(request.POST)
         if form.is_valid():
-            restaurant = form.save(commit=False)
-            restaurant.group = selected_group
-            restaurant.save()
-            RestaurantTopping.objects.bulk_create([
-                RestaurantTopping(restaurant=restaurant, topping=topping)
-                for topping in form.cleaned_data['toppings']
-            ])
+            with transaction.atomic():
+                restaurant = form.save(commit=False)
+                restaurant.group = selected_group
+                restaurant.save()
+                RestaurantTopping.objects.bulk_create([
+                    RestaurantTopping(restaurant=restaurant, topping=topping)
+                    for topping in form.cleaned_data['toppings']
+                ])
+                # bulk_create sends no signals; bump once the menu rows are committed too.
+                bump_on_commit(*restaurant_versions([(restaurant.pk, restaurant.group_id)]))
             messages.success(request, f"Restaurant '{restaurant}' created.")
             return redirect('restaurant_list')
     else:
@@ -749,20 +1018,22 @@ def restaurant_create(request):
 @login_required
 def restaurant_edit(request, pk):
     restaurant = get_object_or_404(PizzaRestaurant, pk=pk)
-    person = get_object_or_404(Person, user_account=request.user)
-    if not restaurant.group or not person.pizza_groups.filter(pk=restaurant.group_id).exists():
+    if not restaurant.group_id or not request.person_context.is_member(restaurant.group_id):
         return HttpResponseForbidden("You don't have permission to edit this restaurant.")
     if request.method == 'POST':
         form = RestaurantForm(request.POST, instance=restaurant)
         if form.is_valid():
-            restaurant = form.save()
-            selected = set(form.cleaned_data['toppings'])
-            existing = set(restaurant.toppings.all())
-            RestaurantTopping.objects.filter(restaurant=restaurant, topping__in=existing - selected).delete()
-            RestaurantTopping.objects.bulk_create([
-                RestaurantTopping(restaurant=restaurant, topping=topping)
-                for topping in selected - existing
-            ])
+            with transaction.atomic():
+                restaurant = form.save()
+                selected = set(form.cleaned_data['toppings'])
+                existing = set(restaurant.toppings.all())
+                RestaurantTopping.objects.filter(restaurant=restaurant, topping__in=existing - selected).delete()
+                RestaurantTopping.objects.bulk_create([
+                    RestaurantTopping(restaurant=restaurant, topping=topping)
+                    for topping in selected - existing
+                ])
+                # Queryset deletes and bulk_create send no signals; bump once the menu rows are committed.
+                bump_on_commit(*restaurant_versions([(restaurant.pk, restaurant.group_id)]))
             messages.success(request, f"Restaurant '{restaurant}' updated.")
             return redirect('restaurant_list')
     else:
@@ -779,8 +1050,7 @@ def restaurant_edit(request, pk):
 @login_required
 def restaurant_delete(request, pk):
     restaurant = get_object_or_404(PizzaRestaurant, pk=pk)
-    person = get_object_or_404(Person, user_account=request.user)
-    if not restaurant.group or not person.pizza_groups.filter(pk=restaurant.group_id).exists():
+    if not restaurant.group_id or not request.person_context.is_member(restaurant.group_id):
         return HttpResponseForbidden("You don't have permission to delete this restaurant.")
     if request.method == 'POST':
         name = str(restaurant)
@@ -793,11 +1063,10 @@ def restaurant_delete(request, pk):
 @login_required
 def restaurant_clone(request, pk):
     restaurant = get_object_or_404(PizzaRestaurant, pk=pk)
-    person = get_object_or_404(Person, user_account=request.user)
-    if not restaurant.group or not person.pizza_groups.filter(pk=restaurant.group_id).exists():
+    person = Person.get_from_request(request)
+    if not restaurant.group_id or not request.person_context.is_member(restaurant.group_id):
         return HttpResponseForbidden("You don't have permission to clone this restaurant.")
-    other_groups = list(person.pizza_groups.exclude(pk=restaurant.group_id))
-    if not other_groups:
+    if not request.person_context.group_ids - {restaurant.group_id}:
         messages.error(request, "You need to be in at least one other group to clone a restaurant.")
         return redirect('restaurant_list')
     if request.method == 'POST':
@@ -805,11 +1074,14 @@ def restaurant_clone(request, pk):
         if form.is_valid():
             target_group = form.cleaned_data['target_group']
             name = form.cleaned_data['name']
-            new_restaurant = PizzaRestaurant.objects.create(name=name, group=target_group)
-            RestaurantTopping.objects.bulk_create([
-                RestaurantTopping(restaurant=new_restaurant, topping=topping)
-                for topping in restaurant.toppings.all()
-            ])
+            with transaction.atomic():
+                new_restaurant = PizzaRestaurant.objects.create(name=name, group=target_group)
+                RestaurantTopping.objects.bulk_create([
+                    RestaurantTopping(restaurant=new_restaurant, topping=topping)
+                    for topping in restaurant.toppings.all()
+                ])
+                # bulk_create sends no signals; bump once the menu rows are committed too.
+                bump_on_commit(*restaurant_versions([(new_restaurant.pk, new_restaurant.group_id)]))
             messages.success(request, f"Restaurant '{new_restaurant}' cloned to {target_group}.")
             return redirect('restaurant_list')
     else: